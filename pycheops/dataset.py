@@ -38,13 +38,18 @@ import matplotlib.pyplot as plt
 from .instrument import transit_noise
 from ftplib import FTP
 from .models import TransitModel, FactorModel, EclipseModel
+from .models import _model_jacobian, _ModelEvaluator
 from uncertainties import UFloat
 from lmfit import Parameter, Parameters, minimize, Minimizer,fit_report
 from lmfit import __version__ as _lmfit_version_
 from lmfit import Model
 from scipy.interpolate import interp1d, LSQUnivariateSpline
 import matplotlib.pyplot as plt
-from emcee import EnsembleSampler
+from emcee import EnsembleSampler, State
+from emcee.moves import DEMove, DESnookerMove
+from emcee.backends import Backend
+import os
+import pickle
 import corner
 import copy
 from celerite import terms, GP
@@ -52,6 +57,7 @@ from sys import stdout
 from astropy.coordinates import SkyCoord, get_body, Angle
 from lmfit.printfuncs import gformat
 from scipy.signal import medfilt
+from scipy.special import ndtr, ndtri
 from .utils import lcbin, mode
 import astropy.units as u
 from uncertainties import ufloat, UFloat
@@ -62,6 +68,8 @@ from astropy.convolution import convolve, Gaussian1DKernel
 from .instrument import CHEOPS_ORBIT_MINUTES
 from scipy.stats import skewnorm
 from scipy.optimize import minimize as scipy_minimize
+from numba import jit, set_num_threads, threading_layer
+from multiprocessing import get_context, cpu_count
 from . import __version__
 from .funcs import rhostar, massradius
 
@@ -69,6 +77,10 @@ try:
     from dace.cheops import Cheops
 except ModuleNotFoundError: 
     pass
+try:
+    import dynesty
+except ModuleNotFoundError: 
+    dynesty = None
 
 _file_key_re = re.compile(r'CH_PR(\d{2})(\d{4})_TG(\d{4})(\d{2})_V(\d{4})')
 
@@ -101,10 +113,173 @@ def _make_interp(t,x,scale=None):
         raise ValueError('scale must be None, max or range')
     return interp1d(t,z,bounds_error=False, fill_value=(z[0],z[-1]))
 
+#----
+
+# Jacobian of the residuals returned by _chisq_prior in lmfit_transit and
+# lmfit_eclipse, passed to minimize() as Dfun. The partial derivatives of the
+# priors on constrained parameters, e.g., logrho, and of the priors in the
+# Priors object priors are calculated numerically.
+#
+# For the linear parameters in lin, the values that minimise chi-squared
+# depend on the other parameters, so the partial derivatives of the model
+# are projected onto the subspace orthogonal to the partial derivatives
+# w.r.t. the linear parameters (Kaufman, 1975, BIT 15, 49). This neglects
+# the change in these partial derivatives with the other parameters, but
+# the gradient of chi-squared is still exact because the linear parameters
+# are at their optimum values, so this does not change the best fit.
+def _chisq_prior_jacobian(params, model, time, flux, flux_err, lin=(),
+        priors=None):
+    vn = [p for p in params if params[p].vary]
+    lin = list(lin)
+    if lin:
+        params = params.copy()
+        _, a, A = _linear_solve(model, params, time, flux, lin,
+                s2=flux_err**2)
+        for n, v in zip(lin, a):
+            params[n].value = v
+    _, jac = _model_jacobian(model, params, time, vn+lin)
+    zero = np.zeros_like(flux_err)
+    J = np.array([jac.get(n, zero)/flux_err for n in vn]).T
+    if lin:
+        X = np.array([jac.get(n, zero)/flux_err for n in lin]).T
+        # Partial derivatives of the optimum linear parameter values
+        dadx = -np.linalg.solve(A, X.T @ J)
+        J = J + X @ dadx
+    J = -J
+
+    # Values of all the parameters offset from the current values of each
+    # free parameter in turn for numerical derivatives
+    def _offsets():
+        pars = params.copy()
+        for j, n in enumerate(vn):
+            v = pars[n].value
+            h = 1e-6*(abs(v) + 1e-3)
+            hi = min(v+h, pars[n].max)
+            lo = max(v-h, pars[n].min)
+            pv = []
+            for x in (hi, lo):
+                pars[n].value = x
+                pars.update_constraints()
+                d = pars.valuesdict()
+                for k, m in enumerate(lin):
+                    d[m] = a[k] + (x-v)*dadx[k,j]
+                pv.append(d)
+            pars[n].value = v
+            yield j, pv[0], pv[1], hi - lo
+
+    rows = []
+    for p in params:
+        u = params[p].user_data
+        if not isinstance(u, UFloat):
+            continue
+        row = np.zeros(len(vn))
+        if params[p].vary:
+            row[vn.index(p)] = -1/u.s
+        elif p in lin:
+            row = -dadx[lin.index(p)]/u.s
+        elif params[p].expr is not None:
+            for j, v_hi, v_lo, dx in _offsets():
+                row[j] = -(v_hi[p] - v_lo[p])/dx/u.s
+        rows.append(row)
+    if priors:
+        R = np.zeros((len(priors), len(vn)))
+        for j, v_hi, v_lo, dx in _offsets():
+            R[:,j] = (priors.residual(v_hi) - priors.residual(v_lo))/dx
+        rows += list(R)
+    if len(rows) > 0:
+        J = np.vstack((J, rows))
+    return J
+
+# Glint model used by lmfit_transit and lmfit_eclipse, with a method
+# eval_batch() to evaluate it for many values of glint_scale in one call
+def _glint_func(t, glint_scale, f_theta=None, f_glint=None):
+    return glint_scale * f_glint(f_theta(t))
+
+class _GlintModel(Model):
+    def __init__(self, f_theta=None, f_glint=None, **kwargs):
+        kwargs.update({'independent_vars': ['t'], 'name': 'glint_func'})
+        super(_GlintModel, self).__init__(_glint_func, f_theta=f_theta,
+                f_glint=f_glint, **kwargs)
+
+    def eval_batch(self, theta, t):
+        theta = np.atleast_2d(np.asarray(theta, dtype=float))
+        return theta[:,:1]*self.opts['f_glint'](self.opts['f_theta'](t))
+
+# Analytic solution for the parameters on which the model depends linearly,
+# i.e., the detrending coefficients in FactorModel and glint_scale, given the
+# values of the other parameters.
+def _linear_names(model, params):
+    # Names of the free parameters on which the model depends linearly
+    names = []
+    for m in model.components:
+        if isinstance(m, FactorModel):
+            names += [m.prefix+n for n in m._coeff_names]
+    if 'glint_scale' in model.param_names:
+        names.append('glint_scale')
+    return [n for n in names if n in params and params[n].vary]
+
+def _linear_solve(model, params, time, flux, lin, s2=None, gp=None):
+    # Values of the linear parameters in lin that maximise the likelihood
+    # including Gaussian priors from ufloat user_data values. The noise is
+    # either white with variance s2 or described by the celerite GP object
+    # gp. Returns the model with these values, the values and the inverse
+    # of their covariance matrix. 
+    f, jac = _model_jacobian(model, params, time, lin)
+    zero = np.zeros_like(f)
+    X = np.array([jac.get(n, zero) for n in lin]).T
+    a_0 = np.array([params[n].value for n in lin])
+    u = [params[n].user_data for n in lin]
+    mu = np.array([x.n if isinstance(x, UFloat) else 0 for x in u])
+    sigma = np.array([x.s if isinstance(x, UFloat) else np.inf for x in u])
+    return _linear_lsq(flux, f, X, a_0, mu, sigma, s2, gp)
+
+def _linear_lsq(flux, f, X, a_0, mu, sigma, s2=None, gp=None):
+    # Solution of the linear least-squares problem for _linear_solve given
+    # the model f for linear parameter values a_0 and its partial
+    # derivatives X w.r.t. these parameters. Gaussian priors on the linear
+    # parameters are given by mu and sigma, with sigma=inf for no prior.
+    y = flux - f + X @ a_0
+    if gp is None:
+        WX = X/s2[:,None]
+    else:
+        WX = gp.apply_inverse(X).reshape(X.shape)
+    A = X.T @ WX
+    b = WX.T @ y
+    A[np.diag_indices_from(A)] += 1/sigma**2
+    b += mu/sigma**2
+    a = np.linalg.solve(A, b)
+    return flux - y + X @ a, a, A
+
+def _linear_lsq_batch(flux, f, X, a_0, mu, sigma, s2):
+    # As _linear_lsq for white noise with a leading dimension on f, X, a_0
+    # and s2 for many sets of values of the other parameters.
+    y = flux - f + (X @ a_0[:,:,None])[:,:,0]
+    WX = X/s2[:,:,None]
+    XT = X.transpose(0,2,1)
+    A = XT @ WX
+    b = (XT/s2[:,None,:] @ y[:,:,None])[:,:,0]
+    A += np.diag(1/sigma**2)
+    b += mu/sigma**2
+    a = np.linalg.solve(A, b[:,:,None])[:,:,0]
+    return flux - y + (X @ a[:,:,None])[:,:,0], a, A
+
+def _linear_update(params, model, time, flux, lin, s2=None, gp=None,
+        vary=True):
+    # Set the values of the linear parameters in params to their optimum
+    # values given the other parameters, and their standard errors from the
+    # conditional covariance matrix. Returns the model for these values.
+    fit, a, A = _linear_solve(model, params, time, flux, lin, s2, gp)
+    err = np.sqrt(np.diag(np.linalg.inv(A)))
+    for n, v, e in zip(lin, a, err):
+        params[n].set(value=v, vary=vary)
+        params[n].stderr = e
+    return fit
+
 # Prior on (D, W, b) for transit/eclipse fitting.
 # This prior assumes uniform priors on cos(i), log(k) and log(aR). The
 # factor 2kW is the absolute value of the determinant of the Jacobian, 
 # J = d(D, W, b)/d(cosi, k, aR)
+@jit(nopython=True)
 def _log_prior(D, W, b):
     if (D < 2e-6) or (D > 0.2): return -np.inf
     if (b < 0) or (b > 1): return -np.inf
@@ -114,97 +289,468 @@ def _log_prior(D, W, b):
     if (aR < 2): return -np.inf
     return -np.log(2*k*W) - np.log(k) - np.log(aR)
 
-# Target functions for emcee
-def _log_posterior_jitter(pos, model, time, flux, flux_err,  params, vn,
-        return_fit):
-
-    # Check for pos[i] within valid range has to be done here
-    # because it gets set to the limiting value if out of range by the
-    # assignment to a parameter with min/max defined.
-    parcopy = params.copy()
-    for i, p in enumerate(vn):
-        v = pos[i]
-        if (v < parcopy[p].min) or (v > parcopy[p].max):
+# Target function for emcee. The model and the values of the parameters
+# are calculated from pos by the _ModelEvaluator object ev. The noise is
+# either white noise with standard errors flux_err plus jitter or, if gp is
+# not None, is described by the celerite GP object gp.
+# Proposals outside the support of the prior are rejected before the model is
+# evaluated.
+def _log_posterior(pos, ev, flux, flux_err, gp, return_fit,
+        marginalise=False, priors=None):
+
+    v = ev.values(pos)
+    lin = len(ev.ilin) > 0
+    if not return_fit:
+        lnprior = _log_prior_array(v, ev)
+        if (priors is not None) and not lin:
+            lnprior += priors.log_prior(ev.valuesdict(v))
+        if not np.isfinite(lnprior):
             return -np.inf
-        parcopy[p].value = v
-    fit = model.eval(parcopy, t=time)
+
+    if gp is None:
+        jitter = np.exp(v[ev.index['log_sigma']])
+        s2 = flux_err**2 + jitter**2
+    else:
+        s2 = None
+        _set_gp_parameters(gp, ev.valuesdict(v))
+    if lin:
+        f, X = ev.linear(v)
+        fit, a, A = _linear_lsq(flux, f, X, v[ev.ilin], ev.lin_mu,
+                ev.lin_sigma, s2, gp)
+        v[ev.ilin] = a
+        ev.update(v)
+    else:
+        fit = ev.eval(v)
     if return_fit:
         return fit
 
     if False in np.isfinite(fit):
         return -np.inf
 
-    # Also check parameter range here so we catch "derived" parameters
-    # that are out of range.
-    lnprior = _log_prior(parcopy['D'], parcopy['W'], parcopy['b'])
-    if not np.isfinite(lnprior):
-        return -np.inf
-
-    for p in parcopy:
-        v = parcopy[p].value
-        if (v < parcopy[p].min) or (v > parcopy[p].max):
-            return -np.inf
-        if np.isnan(v):
+    if lin:
+        # Priors on the linear parameters and priors from priors for their
+        # optimum values
+        lnprior += -0.5*np.sum(((ev.lin_mu - a)/ev.lin_sigma)**2)
+        if priors is not None:
+            lnprior += priors.log_prior(ev.valuesdict(v))
+        if not np.isfinite(lnprior):
             return -np.inf
-        u = parcopy[p].user_data
-        if isinstance(u, UFloat):
-            lnprior += -0.5*((u.n - v)/u.s)**2
-    if not np.isfinite(lnprior):
-        return -np.inf
 
-    jitter = np.exp(parcopy['log_sigma'].value)
-    s2 =flux_err**2 + jitter**2
-    lnlike = -0.5*(np.sum((flux-fit)**2/s2 + np.log(2*np.pi*s2)))
+    if gp is None:
+        lnlike = -0.5*(np.sum((flux-fit)**2/s2 + np.log(2*np.pi*s2)))
+    else:
+        lnlike = gp.log_likelihood(flux-fit)
+    if lin and marginalise:
+        m = len(ev.ilin)
+        lnlike += 0.5*m*np.log(2*np.pi) - 0.5*np.linalg.slogdet(A)[1]
     return lnlike + lnprior
 
-#----
-
-def _log_posterior_SHOTerm(pos, model, time, flux, flux_err,  params, vn, gp, 
-        return_fit):
-
-    # Check for pos[i] within valid range has to be done here
-    # because it gets set to the limiting value if out of range by the
-    # assignment to a parameter with min/max defined.
-    parcopy = params.copy()
-    for i, p in enumerate(vn):
-        v = pos[i]
-        if (v < parcopy[p].min) or (v > parcopy[p].max):
-            return -np.inf
-        parcopy[p].value = v
-    fit = model.eval(parcopy, t=time)
+# Vectorised version of _log_posterior for emcee with vectorize=True. Each
+# row of pos is the position of one walker and the result is an array of
+# log-posterior values. The models for all positions inside the support of
+# the prior are evaluated in one call to ev.eval_batch() or ev.linear_batch().
+def _log_posterior_batch(pos, ev, flux, flux_err, gp, return_fit,
+        marginalise=False, priors=None):
+
+    pos = np.atleast_2d(pos)
+    V = ev.values_batch(pos)
+    lin = len(ev.ilin) > 0
+    lnpost = np.full(len(V), -np.inf)
+    if return_fit:
+        ok = np.ones(len(V), dtype=bool)
+        lnprior = np.zeros(len(V))
+    else:
+        lnprior = _log_prior_array_batch(V, ev)
+        if (priors is not None) and not lin:
+            lnprior += priors.log_prior(ev.valuesdict(V.T))
+        ok = np.isfinite(lnprior)
+        if not ok.any():
+            return lnpost
+    V = V[ok]
+    lnprior = lnprior[ok]
+
+    if gp is None:
+        jitter = np.exp(V[:,ev.index['log_sigma']])
+        s2 = flux_err**2 + jitter[:,None]**2
+    if lin:
+        f, X = ev.linear_batch(V)
+        a_0 = V[:,ev.ilin]
+        if gp is None:
+            fit, a, A = _linear_lsq_batch(flux, f, X, a_0, ev.lin_mu,
+                    ev.lin_sigma, s2)
+        else:
+            fit = np.empty_like(f)
+            a = np.empty_like(a_0)
+            A = np.empty((len(V), len(ev.ilin), len(ev.ilin)))
+            for i, v in enumerate(V):
+                _set_gp_parameters(gp, ev.valuesdict(v))
+                fit[i], a[i], A[i] = _linear_lsq(flux, f[i], X[i], a_0[i],
+                        ev.lin_mu, ev.lin_sigma, None, gp)
+        V[:,ev.ilin] = a
+        ev.update_batch(V)
+    else:
+        fit = ev.eval_batch(V)
     if return_fit:
         return fit
 
-    if False in np.isfinite(fit):
-        return -np.inf
-    
-    # Also check parameter range here so we catch "derived" parameters
-    # that are out of range.
-    lnprior = _log_prior(parcopy['D'], parcopy['W'], parcopy['b'])
-    if not np.isfinite(lnprior):
-        return -np.inf
-    for p in parcopy:
-        v = parcopy[p].value
-        if (v < parcopy[p].min) or (v > parcopy[p].max):
-            return -np.inf
-        if np.isnan(v):
+    if lin:
+        lnprior += -0.5*np.sum(((ev.lin_mu - a)/ev.lin_sigma)**2, axis=1)
+        if priors is not None:
+            lnprior += priors.log_prior(ev.valuesdict(V.T))
+
+    if gp is None:
+        lnlike = -0.5*np.sum((flux-fit)**2/s2 + np.log(2*np.pi*s2), axis=1)
+    else:
+        lnlike = np.empty(len(V))
+        for i, v in enumerate(V):
+            _set_gp_parameters(gp, ev.valuesdict(v))
+            lnlike[i] = gp.log_likelihood(flux-fit[i])
+    if lin and marginalise:
+        m = len(ev.ilin)
+        lnlike += 0.5*m*np.log(2*np.pi) - 0.5*np.linalg.slogdet(A)[1]
+    lp = lnlike + lnprior
+    lp[~np.isfinite(fit).all(axis=1) | ~np.isfinite(lnprior)] = -np.inf
+    lnpost[ok] = lp
+    return lnpost
+
+# Posterior probability distribution of the free parameters that does not
+# depend on the sampler used. Calling the object returns the log-posterior
+# for an array of positions, one per row, calculated with
+# _log_posterior_batch or, if vectorize is False, with _log_posterior for
+# each position in turn. The methods log_prior() and log_likelihood() split
+# the log-posterior into its two parts, and prior_transform() maps points in
+# the unit cube to the independent priors on the free parameters for nested
+# sampling, i.e., uniform within the bounds or Gaussian, truncated at the
+# bounds, for parameters with a ufloat value as user_data. The other terms
+# in the log-prior, e.g., the prior on (D, W, b), are included in
+# log_likelihood_nested(), the log-likelihood used with prior_transform().
+# All these methods also accept a single position, in which case the result
+# is a scalar and the log-posterior is calculated with _log_posterior.
+# Objects of this class can be pickled and sent to the processes of a
+# multiprocessing pool.
+class _LogPosterior(object):
+    def __init__(self, args, kwargs, vectorize=True):
+        self.args = args
+        self.kwargs = kwargs
+        self.vectorize = vectorize
+        ev = args[0]
+        self.lo = ev.lo[ev.ivary]
+        self.hi = ev.hi[ev.ivary]
+        self.mu = np.zeros(len(ev.ivary))
+        self.sigma = np.full(len(ev.ivary), np.inf)
+        for i, j in enumerate(ev.ivary):
+            if j in ev.iprior:
+                k = list(ev.iprior).index(j)
+                self.mu[i] = ev.prior_mu[k]
+                self.sigma[i] = ev.prior_sigma[k]
+
+    def __call__(self, pos):
+        pos = np.asarray(pos, dtype=float)
+        if pos.ndim == 1:
+            return _log_posterior(pos, *self.args, **self.kwargs)
+        if self.vectorize:
+            return _log_posterior_batch(pos, *self.args, **self.kwargs)
+        return np.array([_log_posterior(p, *self.args, **self.kwargs)
+            for p in pos])
+
+    def log_prior(self, pos):
+        # Excludes the priors on the linear parameters, which depend on their
+        # optimum values for the other parameters
+        pos = np.asarray(pos, dtype=float)
+        if pos.ndim == 1:
+            return self.log_prior(pos[None,:])[0]
+        ev = self.args[0]
+        V = ev.values_batch(pos)
+        lnprior = _log_prior_array_batch(V, ev)
+        priors = self.kwargs.get('priors')
+        if (priors is not None) and len(ev.ilin) == 0:
+            ok = np.isfinite(lnprior)
+            if ok.any():
+                lnprior[ok] += priors.log_prior(ev.valuesdict(V[ok].T))
+        return lnprior
+
+    def log_likelihood(self, pos):
+        lnprior = self.log_prior(pos)
+        ok = np.isfinite(lnprior)
+        return np.where(ok, self(pos) - np.where(ok, lnprior, 0), -np.inf)
+
+    def prior_transform(self, u):
+        u = np.asarray(u, dtype=float)
+        g = np.isfinite(self.sigma)
+        if np.any(~g & ~(np.isfinite(self.lo) & np.isfinite(self.hi))):
+            raise ValueError('Free parameters without a Gaussian prior '
+                    'must have finite bounds for nested sampling')
+        lo = np.where(g, 0, self.lo)
+        hi = np.where(g, 1, self.hi)
+        x = lo + u*(hi - lo)
+        if g.any():
+            mu, sigma = self.mu[g], self.sigma[g]
+            a = ndtr((self.lo[g] - mu)/sigma)
+            b = ndtr((self.hi[g] - mu)/sigma)
+            x[...,g] = mu + sigma*ndtri(a + u[...,g]*(b - a))
+        return x
+
+    def log_likelihood_nested(self, pos):
+        # The Gaussian priors on the free parameters are sampled by
+        # prior_transform(), so they are removed from the log-posterior
+        z = (np.asarray(pos, dtype=float) - self.mu)/self.sigma
+        return self(pos) + 0.5*np.sum(z**2, axis=-1)
+
+# Log-posterior function for emcee with vectorize=True that splits the walker
+# positions into nchunks arrays that are processed in parallel by pool. For a
+# pool created with _pool_init as the initializer, func is _pool_call and the
+# _LogPosterior object is sent to each process once, when it is started.
+class _PoolLogPosterior(object):
+    def __init__(self, pool, func, nchunks):
+        self.pool = pool
+        self.func = func
+        self.nchunks = nchunks
+
+    def __call__(self, pos):
+        chunks = np.array_split(pos, min(self.nchunks, len(pos)))
+        return np.concatenate(list(self.pool.map(self.func, chunks)))
+
+_pool_func = None
+
+def _pool_context():
+    # Processes forked after the numba threads have been started may hang on
+    # exit, e.g., if models.PARALLEL is True, so the processes are started
+    # with spawn in this case. Otherwise, the default method is used so that
+    # forked processes inherit the compiled functions.
+    try:
+        threading_layer()
+    except ValueError:
+        # The threading layer has not been initialised
+        return get_context()
+    return get_context('spawn')
+
+def _pool_init(func):
+    # The processes of the pool use one thread each
+    global _pool_func
+    _pool_func = func
+    set_num_threads(1)
+
+def _pool_call(pos):
+    return _pool_func(pos)
+
+def _pool_call_nested(pos):
+    return _pool_func.log_likelihood_nested(pos)
+
+def _pool_prior_transform(u):
+    return _pool_func.prior_transform(u)
+
+def _start_pool(posterior, nprocs, pool):
+    # Starts a pool of nprocs processes, each with a copy of the _LogPosterior
+    # object posterior, if nprocs > 1 and pool is None. Returns the pool, the
+    # number of groups into which the positions are split, and True if the
+    # pool was started here, in which case it must be closed by the caller.
+    if pool is None and nprocs is not None and nprocs > 1:
+        pool = _pool_context().Pool(nprocs, initializer=_pool_init,
+                initargs=(posterior,))
+        return pool, nprocs, True
+    if pool is not None and nprocs is None:
+        nprocs = getattr(pool, '_processes', None) or cpu_count()
+    return pool, nprocs, False
+
+# Backend for emcee that keeps the chain in memory, as emcee.backends.Backend,
+# and also writes it to disk so that an interrupted run can be resumed. The
+# walker positions and log-posterior values for every step are appended to
+# the binary file filename. Every checkpoint steps, the new steps are
+# written to this file and then the file filename+'.state' is replaced with
+# a pickle of the number of steps written, the acceptance counts, the
+# random number generator state and the dictionary info, which is used by
+# emcee_sampler to store the position of the walkers during the burn-in
+# phase, etc. Steps in the chain file beyond the number given in the state
+# file are ignored, so the store is consistent if the process is killed at
+# any point.
+class _ChainStore(Backend):
+
+    def __init__(self, filename, checkpoint=16):
+        super(_ChainStore, self).__init__()
+        self.filename = str(filename)
+        self.checkpoint = max(1, int(checkpoint))
+        self.info = {}
+        self._nsaved = 0
+
+    def exists(self):
+        return os.path.exists(self.filename+'.state')
+
+    def reset(self, nwalkers, ndim):
+        super(_ChainStore, self).reset(nwalkers, ndim)
+        self.info = {}
+        self._nsaved = 0
+        open(self.filename, 'wb').close()
+        self.write()
+
+    def save_step(self, state, accepted):
+        super(_ChainStore, self).save_step(state, accepted)
+        if self.iteration - self._nsaved >= self.checkpoint:
+            self.write()
+
+    def write(self, **info):
+        self.info.update(info)
+        i, j = self._nsaved, self.iteration
+        m = self.nwalkers*self.ndim
+        with open(self.filename, 'r+b') as f:
+            f.seek(i*self._stepsize())
+            np.hstack([self.chain[i:j].reshape(j-i, m),
+                self.log_prob[i:j]]).astype(float).tofile(f)
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+        state = {'nwalkers':self.nwalkers, 'ndim':self.ndim, 'iteration':j,
+                'accepted':self.accepted, 'random_state':self.random_state,
+                'info':self.info}
+        tmpfile = self.filename+'.state.tmp'
+        with open(tmpfile, 'wb') as f:
+            pickle.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpfile, self.filename+'.state')
+        self._nsaved = j
+
+    def load(self):
+        with open(self.filename+'.state', 'rb') as f:
+            state = pickle.load(f)
+        self.nwalkers = state['nwalkers']
+        self.ndim = state['ndim']
+        n = state['iteration']
+        m = self._stepsize()//8
+        x = np.fromfile(self.filename, dtype=float, count=n*m).reshape(n, m)
+        self.chain = x[:,:-self.nwalkers].reshape(n, self.nwalkers,
+                self.ndim).copy()
+        self.log_prob = x[:,-self.nwalkers:].copy()
+        self.accepted = state['accepted']
+        self.random_state = state['random_state']
+        self.info = state['info']
+        self.iteration = n
+        self.blobs = None
+        self.initialized = True
+        self._nsaved = n
+
+    def _stepsize(self):
+        # Number of bytes per step in the chain file
+        return 8*self.nwalkers*(self.ndim+1)
+
+    def grow(self, ngrow, blobs):
+        if blobs is not None:
+            raise ValueError('Blobs are not supported by _ChainStore')
+        super(_ChainStore, self).grow(ngrow, blobs)
+
+def _chain_store(backend, checkpoint, resume, nwalkers, var_names, thin):
+    # _ChainStore for emcee_sampler, with the chain loaded from the file
+    # backend if resume is True and the file exists, or a new, empty chain.
+    store = _ChainStore(backend, checkpoint)
+    if resume and store.exists():
+        store.load()
+        if ((store.shape != (nwalkers, len(var_names))) or 
+                (store.info.get('var_names') != var_names) or
+                (store.info.get('thin') != thin)):
+            raise ValueError('Chain in {} is for different '
+                'parameters, nwalkers or thin'.format(backend))
+    else:
+        store.reset(nwalkers, len(var_names))
+        store.write(var_names=var_names, thin=thin, burn=0, burn_state=None)
+    return store
+
+def _burn_in(sampler, pos, burn, progress, store=None):
+    # Run sampler from pos for burn steps without storing the chain and
+    # return the final state. With a _ChainStore, the run starts from the
+    # state saved in store, if any, and the state of the walkers is saved
+    # every store.checkpoint steps.
+    nburn, checkpoint = 0, burn
+    if store is not None:
+        if store.info['burn_state'] is not None:
+            pos = State(*store.info['burn_state'])
+        nburn, checkpoint = store.info['burn'], store.checkpoint
+    if progress and nburn < burn:
+        print('Running burn-in ..')
+        stdout.flush()
+    while nburn < burn:
+        n = min(checkpoint, burn-nburn)
+        pos = sampler.run_mcmc(pos, n, store=False,
+            skip_initial_state_check=True, progress=progress)
+        nburn += n
+        if store is not None:
+            store.write(burn=nburn, burn_state=(pos.coords, pos.log_prob,
+                None, pos.random_state))
+    return pos
+
+def _autocorr_converged(sampler, tau_last, ntau, rtol):
+    # Returns True if the chain from sampler is longer than ntau times the
+    # largest autocorrelation time and the autocorrelation times differ by
+    # less than a fraction rtol from tau_last. Otherwise returns the
+    # autocorrelation times.
+    if sampler.iteration == 0:
+        return None
+    tau = sampler.get_autocorr_time(tol=0)
+    if tau_last is None or not np.all(np.isfinite(tau)):
+        return tau
+    if ((ntau*np.max(tau) < sampler.iteration) and
+            np.all(np.abs(tau - tau_last) < rtol*tau)):
+        return True
+    return tau
+
+def _run_adaptive(sampler, pos, n, ntau, rtol, check, progress):
+    # Run sampler from pos, or from the last sample if pos is None, for up
+    # to n steps or until the chain has converged according to
+    # _autocorr_converged, which is checked every check steps. Returns True
+    # if the chain has converged.
+    if pos is None:
+        pos = sampler.get_last_sample()
+    tau = _autocorr_converged(sampler, None, ntau, rtol)
+    if tau is True:
+        return True
+    for _ in sampler.sample(pos, iterations=n, progress=progress,
+            skip_initial_state_check=True):
+        if sampler.iteration % check == 0:
+            tau = _autocorr_converged(sampler, tau, ntau, rtol)
+            if tau is True:
+                return True
+    return False
+
+def _log_prior_array(v, ev):
+    # Log-prior for the array of parameter values v from the bounds and
+    # Gaussian priors stored in ev plus the prior on (D, W, b), excluding the
+    # priors on linear parameters. The bounds on constrained parameters such
+    # as aR are also checked here.
+    i = ev.index
+    return _log_prior_bounds(v, ev.lo, ev.hi, ev.iprior, ev.prior_mu,
+            ev.prior_sigma, i['D'], i['W'], i['b'])
+
+@jit(nopython=True)
+def _log_prior_bounds(v, lo, hi, iprior, mu, sigma, iD, iW, ib):
+    for j in range(len(v)):
+        # Also rejects NaN values
+        if not ((v[j] >= lo[j]) and (v[j] <= hi[j])):
             return -np.inf
-        u = parcopy[p].user_data
-        if isinstance(u, UFloat):
-            lnprior += -0.5*((u.n - v)/u.s)**2
+    lnprior = _log_prior(v[iD], v[iW], v[ib])
     if not np.isfinite(lnprior):
         return -np.inf
-
-    resid = flux-fit
-    gp.set_parameter('kernel:terms[0]:log_S0',
-            parcopy['log_S0'].value)
-    gp.set_parameter('kernel:terms[0]:log_Q',
-            parcopy['log_Q'].value)
-    gp.set_parameter('kernel:terms[0]:log_omega0',
-            parcopy['log_omega0'].value)
-    gp.set_parameter('kernel:terms[1]:log_sigma',
-            parcopy['log_sigma'].value)
-    return gp.log_likelihood(resid) + lnprior
+    for j in range(len(iprior)):
+        lnprior += -0.5*((mu[j] - v[iprior[j]])/sigma[j])**2
+    return lnprior
+
+def _log_prior_array_batch(V, ev):
+    # As _log_prior_array for each row of the array of values V
+    i = ev.index
+    return _log_prior_bounds_batch(V, ev.lo, ev.hi, ev.iprior, ev.prior_mu,
+            ev.prior_sigma, i['D'], i['W'], i['b'])
+
+@jit(nopython=True)
+def _log_prior_bounds_batch(V, lo, hi, iprior, mu, sigma, iD, iW, ib):
+    lnprior = np.empty(V.shape[0])
+    for k in range(V.shape[0]):
+        lnprior[k] = _log_prior_bounds(V[k], lo, hi, iprior, mu, sigma,
+                iD, iW, ib)
+    return lnprior
+
+def _set_gp_parameters(gp, values):
+    # values is a dictionary of parameter values
+    gp.set_parameter('kernel:terms[0]:log_S0', values['log_S0'])
+    gp.set_parameter('kernel:terms[0]:log_Q', values['log_Q'])
+    gp.set_parameter('kernel:terms[0]:log_omega0', values['log_omega0'])
+    gp.set_parameter('kernel:terms[1]:log_sigma', values['log_sigma'])
     
 #---------------
 
@@ -671,7 +1217,8 @@ class Dataset(object):
             dfdx=None, dfdy=None, d2fdx2=None, d2fdy2=None,
             dfdsinphi=None, dfdcosphi=None, dfdsin2phi=None, dfdcos2phi=None,
             dfdsin3phi=None, dfdcos3phi=None, dfdt=None, d2fdt2=None, 
-            glint_scale=None, logrhoprior=None):
+            glint_scale=None, logrhoprior=None, jacobian=True, linear=False,
+            priors=None):
         """
         Fit a transit to the light curve in the current dataset.
 
@@ -695,18 +1242,54 @@ class Dataset(object):
         correspond to the amplitude of the flux variation due to the
         correlation with the relevant parameter.
 
+        By default, the least-squares fit uses analytical partial derivatives
+        of the model w.r.t. the parameters where these are available, e.g.,
+        for the transit parameters of a circular orbit and the detrending
+        coefficients. Set jacobian=False to use numerical derivatives for all
+        parameters.
+
+        The model depends linearly on the detrending coefficients dfdx, etc.,
+        and on glint_scale, for given values of the other parameters. With
+        linear=True, the free parameters of this type are not varied by the
+        least-squares algorithm. Instead, their values are found by weighted
+        linear least-squares for every trial set of the other parameters,
+        including Gaussian priors specified as ufloat values. The limits of
+        the prior interval for these parameters are ignored. The standard
+        errors for these parameters are taken from their covariance matrix at
+        fixed values of the other parameters, so they do not include the
+        effect of correlations with the other parameters.
+
+        Priors other than uniform or Gaussian priors can be specified with a
+        models.Priors object, e.g., priors.add('b', 'log(1-b**2)'). The
+        expression for each prior is evaluated with the values of the
+        parameters in the fit, including constrained parameters such as aR.
+        For the least-squares fit, each prior with log-value lnp adds a
+        residual sqrt(-2*lnp) to the fit, so lnp must not be greater than 0.
+        The priors are also used by emcee_sampler().
+
         """
 
         def _chisq_prior(params, *args):
-            r =  (flux - model.eval(params, t=time))/flux_err
+            if lin:
+                fit, a, _ = _linear_solve(model, params, time, flux, lin,
+                        s2=flux_err**2)
+                v = dict(zip(lin, a))
+            else:
+                fit = model.eval(params, t=time)
+                v = {}
+            r =  (flux - fit)/flux_err
             for p in params:
                 u = params[p].user_data
                 if isinstance(u, UFloat):
-                    r = np.append(r, (u.n - params[p].value)/u.s)
+                    r = np.append(r, (u.n - v.get(p, params[p].value))/u.s)
+            if priors is not None:
+                pv = params.valuesdict()
+                pv.update(v)
+                r = np.append(r, priors.residual(pv))
             return r
 
         try:
-            time = self.lc['time']
+            time = np.array(self.lc['time'])
             flux = self.lc['flux']
             flux_err = self.lc['flux_err']
             xoff = self.lc['xoff']
@@ -716,6 +1299,8 @@ class Dataset(object):
             contam = self.lc['contam']
         except AttributeError:
             raise AttributeError("Use get_lightcurve() to load data first.")
+        # Read-only times are identified by the model caches without hashing
+        time.flags.writeable = False
 
         params = Parameters()
         if T_0 is None:
@@ -818,16 +1403,35 @@ class Dataset(object):
                 f_glint = self.f_glint
             except AttributeError:
                 raise AttributeError("Use add_glint() to first.")
-            def glint_func(t, glint_scale, f_theta=None, f_glint=None ):
-                return glint_scale * f_glint(f_theta(t))
-            GlintModel = Model(glint_func, independent_vars=['t'],
-                f_theta=f_theta, f_glint=f_glint)
-            model += GlintModel
-
-
+            model += _GlintModel(f_theta=f_theta, f_glint=f_glint)
+
+
+        # Linear parameters are not varied by the least-squares fit 
+        lin = _linear_names(model, params) if linear else []
+        for n in lin:
+            params[n].set(vary=False, min=-np.inf, max=np.inf)
+
+        # The Jacobian does not account for constraints on model parameters
+        if any([params[p].expr is not None for p in model.param_names
+                if p in params]):
+            jacobian = False
+        def _jacobian(params, *args):
+            return _chisq_prior_jacobian(params, *args, lin=lin,
+                    priors=priors)
+        Dfun = _jacobian if jacobian else None
         result = minimize(_chisq_prior, params,nan_policy='propagate',
-                args=(model, time, flux, flux_err))
+                args=(model, time, flux, flux_err), Dfun=Dfun)
+        if lin:
+            _linear_update(result.params, model, time, flux, lin,
+                    s2=flux_err**2)
+            m = len(lin)
+            result.nvarys += m
+            result.nfree -= m
+            result.redchi = result.chisqr/result.nfree
+            result.aic += 2*m
+            result.bic += np.log(result.ndata)*m
         self.model = model
+        result.priors = priors
         fit = model.eval(result.params,t=time)
         result.bestfit = fit
         result.rms = (flux-fit).std()
@@ -970,18 +1574,45 @@ class Dataset(object):
             c=None, dfdx=None, dfdy=None, d2fdx2=None, d2fdy2=None,
             dfdsinphi=None, dfdcosphi=None, dfdsin2phi=None, dfdcos2phi=None,
             dfdsin3phi=None, dfdcos3phi=None, dfdt=None, d2fdt2=None,
-            glint_scale=None):
+            glint_scale=None, jacobian=True, linear=False, priors=None):
+        """
+        Fit an eclipse to the light curve in the current dataset.
+
+        Parameters are specified as for lmfit_transit().
+
+        By default, the least-squares fit uses analytical partial derivatives
+        of the model w.r.t. the parameters where these are available. Set
+        jacobian=False to use numerical derivatives for all parameters.
+
+        The detrending coefficients and glint_scale are calculated by linear
+        least-squares if linear=True, as for lmfit_transit().
+
+        Additional priors can be specified with a models.Priors object, as
+        for lmfit_transit().
+
+        """
 
         def _chisq_prior(params, *args):
-            r =  (flux - model.eval(params, t=time))/flux_err
+            if lin:
+                fit, a, _ = _linear_solve(model, params, time, flux, lin,
+                        s2=flux_err**2)
+                v = dict(zip(lin, a))
+            else:
+                fit = model.eval(params, t=time)
+                v = {}
+            r =  (flux - fit)/flux_err
             for p in params:
                 u = params[p].user_data
                 if isinstance(u, UFloat):
-                    r = np.append(r, (u.n - params[p].value)/u.s)
+                    r = np.append(r, (u.n - v.get(p, params[p].value))/u.s)
+            if priors is not None:
+                pv = params.valuesdict()
+                pv.update(v)
+                r = np.append(r, priors.residual(pv))
             return r
 
         try:
-            time = self.lc['time']
+            time = np.array(self.lc['time'])
             flux = self.lc['flux']
             flux_err = self.lc['flux_err']
             xoff = self.lc['xoff']
@@ -991,6 +1622,8 @@ class Dataset(object):
             contam = self.lc['contam']
         except AttributeError:
             raise AttributeError("Use get_lightcurve() to load data first.")
+        # Read-only times are identified by the model caches without hashing
+        time.flags.writeable = False
 
         params = Parameters()
         if T_0 is None:
@@ -1087,15 +1720,34 @@ class Dataset(object):
                 f_glint = self.f_glint
             except AttributeError:
                 raise AttributeError("Use add_glint() to first.")
-            def glint_func(t, glint_scale, f_theta=None, f_glint=None ):
-                return glint_scale * f_glint(f_theta(t))
-            GlintModel = Model(glint_func, independent_vars=['t'],
-                f_theta=f_theta, f_glint=f_glint)
-            model += GlintModel
-
+            model += _GlintModel(f_theta=f_theta, f_glint=f_glint)
+
+        # Linear parameters are not varied by the least-squares fit 
+        lin = _linear_names(model, params) if linear else []
+        for n in lin:
+            params[n].set(vary=False, min=-np.inf, max=np.inf)
+
+        # The Jacobian does not account for constraints on model parameters
+        if any([params[p].expr is not None for p in model.param_names
+                if p in params]):
+            jacobian = False
+        def _jacobian(params, *args):
+            return _chisq_prior_jacobian(params, *args, lin=lin,
+                    priors=priors)
+        Dfun = _jacobian if jacobian else None
         result = minimize(_chisq_prior, params,nan_policy='propagate',
-                args=(model, time, flux, flux_err))
+                args=(model, time, flux, flux_err), Dfun=Dfun)
+        if lin:
+            _linear_update(result.params, model, time, flux, lin,
+                    s2=flux_err**2)
+            m = len(lin)
+            result.nvarys += m
+            result.nfree -= m
+            result.redchi = result.chisqr/result.nfree
+            result.aic += 2*m
+            result.bic += np.log(result.ndata)*m
         self.model = model
+        result.priors = priors
         fit = model.eval(result.params,t=time)
         result.bestfit = fit
         result.rms = (flux-fit).std()
@@ -1138,17 +1790,20 @@ class Dataset(object):
 
     # ----------------------------------------------------------------
 
-    def emcee_sampler(self, params=None,
-            steps=128, nwalkers=64, burn=256, thin=4, log_sigma=None, 
-            add_shoterm=False, log_omega0=None, log_S0=None, log_Q=None,
-            init_scale=1e-3, progress=True):
-
+    def _sampler_setup(self, method, params, log_sigma, add_shoterm,
+            log_omega0, log_S0, log_Q, linear, priors, vectorize):
+        # Set-up common to emcee_sampler and nested_sampler. Returns a copy of
+        # the last lmfit result as a template for the result, the parameters
+        # and the names of the linear parameters, the values and scales of
+        # the free parameters, and the _LogPosterior object.
         try:
             time = np.array(self.lc['time'])
             flux = np.array(self.lc['flux'])
             flux_err = np.array(self.lc['flux_err'])
         except AttributeError:
             raise AttributeError("Use get_lightcurve() to load data first.")
+        # Read-only times are identified by the model caches without hashing
+        time.flags.writeable = False
 
         try:
             model = self.model
@@ -1157,10 +1812,10 @@ class Dataset(object):
                     "Use lmfit_transit() or lmfit_eclipse() first.")
 
         # Make a copy of the lmfit Minimizer result as a template for the
-        # output of this method
+        # output of the sampler
         result = copy.copy(self.lmfit)
-        result.method ='emcee'
-        # Remove components on result not relevant for emcee
+        result.method = method
+        # Remove components on result not relevant for the sampler
         result.status = None
         result.success = None
         result.message = None
@@ -1204,6 +1859,19 @@ class Dataset(object):
             params['log_sigma'] = _kw_to_Parameter('log_sigma', log_sigma)
         params.add('sigma_w',expr='exp(log_sigma)*1e6')
 
+        if linear:
+            lin = _linear_names(model, params)
+            for n in lin:
+                params[n].set(vary=False, min=-np.inf, max=np.inf)
+            kwargs = {'marginalise':linear != 'solve'}
+        else:
+            lin = []
+            kwargs = {}
+        if priors is None:
+            priors = getattr(self.lmfit, 'priors', None)
+        if priors:
+            kwargs['priors'] = priors
+
         vv = []
         vs = []
         vn = []
@@ -1231,7 +1899,10 @@ class Dataset(object):
         vv = np.array(vv)
         vs = np.array(vs)
 
-        args=(model, time, flux, flux_err,  params, vn)
+        # Model and parameter values for the posterior are calculated
+        # without copying params
+        ev = _ModelEvaluator(model, params, vn, time, lin)
+        args=(ev, flux, flux_err)
         p = list(params.keys())
         if 'log_S0' in p and 'log_omega0' in p and 'log_Q' in p :
             kernel = terms.SHOTerm(log_S0=params['log_S0'].value,
@@ -1241,51 +1912,27 @@ class Dataset(object):
 
             gp = GP(kernel, mean=0, fit_mean=False)
             gp.compute(time, flux_err)
-            log_posterior_func = _log_posterior_SHOTerm
-            args += (gp,)
         else:
-            log_posterior_func = _log_posterior_jitter
             gp = None
+        args += (gp,)
         return_fit = False
         args += (return_fit, )
-    
-        # Initialize sampler positions ensuring all walkers produce valid
-        # function values.
-        pos = []
-        n_varys = len(vv)
-
-        for i in range(nwalkers):
-            params_tmp = params.copy()
-            lnlike_i = -np.inf
-            while lnlike_i == -np.inf:
-                pos_i = vv + vs*np.random.randn(n_varys)*init_scale
-                lnlike_i = log_posterior_func(pos_i, *args)
-
-            pos.append(pos_i)
-
-        sampler = EnsembleSampler(nwalkers, n_varys, log_posterior_func,
-            args=args)
-        if progress:
-            print('Running burn-in ..')
-            stdout.flush()
-        pos, _, _ = sampler.run_mcmc(pos, burn, store=False, 
-            skip_initial_state_check=True, progress=progress)
-        sampler.reset()
-        if progress:
-            print('Running sampler ..')
-            stdout.flush()
-        state = sampler.run_mcmc(pos, steps, thin_by=thin,
-            skip_initial_state_check=True, progress=progress)
-
-        flatchain = sampler.get_chain(flat=True).reshape((-1, len(vn)))
-        pos_i = flatchain[np.argmax(sampler.get_log_prob()),:]
+        posterior = _LogPosterior(args, kwargs, vectorize)
+        return result, params, lin, vv, vs, posterior
+
+    def _sampler_result(self, result, params, lin, posterior, sampler,
+            flatchain, lnprob):
+        # Store the best fit, the parameter values and their standard errors
+        # from the samples flatchain with log-posterior values lnprob in
+        # result, and save the result and the sampler.
+        ev, flux, flux_err, gp = posterior.args[:4]
+        time = ev.t
+        vn = result.var_names
+        n_varys = len(vn)
+        pos_i = flatchain[np.argmax(lnprob),:]
         return_fit = True
-        if gp is None:
-            fit = _log_posterior_jitter(pos_i, model, time, flux, flux_err,
-                    params, vn, return_fit)
-        else:
-            fit = _log_posterior_SHOTerm(pos_i, model, time, flux, flux_err,
-                    params, vn, gp, return_fit)
+        fit = _log_posterior(pos_i, ev, flux, flux_err, gp, return_fit,
+                **posterior.kwargs)
 
         # Use scaled resiudals for consistency with lmfit
         result.residual = (flux - fit)/flux_err
@@ -1303,6 +1950,18 @@ class Dataset(object):
             parbest[n].value = pos_i[i]
             parbest[n].stderr = 0.5 * (std_u - std_l)
             parbest[n].correl = {}
+        if lin:
+            # Optimum values of the linear parameters for the best fit
+            if gp is None:
+                s2 = flux_err**2 + np.exp(2*parbest['log_sigma'].value)
+            else:
+                _set_gp_parameters(gp, parbest.valuesdict())
+                s2 = None
+            _linear_update(parbest, self.model, time, flux, lin, s2, gp,
+                    False)
+            for n in lin:
+                params[n].value = parbest[n].value
+                params[n].stderr = parbest[n].stderr
         result.params = params
         result.params_best = parbest
         corrcoefs = np.corrcoef(flatchain.T)
@@ -1311,15 +1970,14 @@ class Dataset(object):
                 if i != j:
                     result.params[n].correl[n2] = corrcoefs[i, j]
                     result.params_best[n].correl[n2] = corrcoefs[i, j]
-        result.lnprob = np.copy(sampler.get_log_prob())
+        result.lnprob = np.copy(lnprob)
         result.errorbars = True
         result.nvarys = n_varys
-        result.nfev = nwalkers*steps*thin
         result.ndata = len(time)
         result.nfree = len(time) - n_varys
         result.chisqr = np.sum((flux-fit)**2/flux_err**2)
         result.redchi = result.chisqr/(len(time) - n_varys)
-        loglmax = np.max(sampler.get_log_prob())
+        loglmax = np.max(lnprob)
         result.aic = 2*n_varys - 2*loglmax
         result.bic = np.log(len(time))*n_varys - 2*loglmax
         result.covar = np.cov(flatchain.T)
@@ -1330,6 +1988,301 @@ class Dataset(object):
         self.gp = gp
         return result
 
+    def emcee_sampler(self, params=None,
+            steps=128, nwalkers=64, burn=256, thin=4, log_sigma=None, 
+            add_shoterm=False, log_omega0=None, log_S0=None, log_Q=None,
+            init_scale=1e-3, progress=True, linear=False, priors=None,
+            vectorize=True, nprocs=None, pool=None, backend=None,
+            resume=False, checkpoint=16, adaptive=False, ntau=50,
+            tau_rtol=0.01, check=100, max_steps=10000, method='emcee'):
+        """
+        Sample the posterior probability distribution of the model parameters
+
+        The model and initial parameter values are taken from the last fit
+        using lmfit_transit() or lmfit_eclipse().
+
+        With linear='solve' or linear='marginalise', the free detrending
+        coefficients and glint_scale, on which the model depends linearly, are
+        not included in the parameters sampled with emcee. For every sample
+        of the other parameters, these linear parameters are set to the values
+        that maximise the likelihood including Gaussian priors specified as
+        ufloat values. With linear='marginalise' (or linear=True), the
+        posterior is also integrated analytically over the linear parameters
+        assuming uniform priors on those parameters without a Gaussian prior.
+        These uniform priors are improper, i.e., the marginal posterior is
+        only defined up to a constant factor. The limits of the prior
+        interval for the linear parameters are ignored. In result.params and
+        result.params_best, the values of the linear parameters are the
+        optimum values for the best-fit values of the other parameters, and
+        their standard errors are calculated for fixed values of the other
+        parameters.
+
+        The log-prior from a models.Priors object is added to the
+        log-posterior for every sample. By default, the priors used by the
+        last fit with lmfit_transit() or lmfit_eclipse() are applied. 
+
+        With vectorize=True (default), the log-posterior is calculated for
+        all the walkers in one call, with the transit, trend and glint models
+        evaluated for all the walkers at once. The initial positions of the
+        walkers are drawn and checked in batches of nwalkers positions.
+
+        To run the sampler in parallel, set nprocs to the number of processes
+        to use. The walkers are then split into nprocs groups and the
+        log-posterior for each group is calculated in a separate process. The
+        model, the data and the other arguments of the log-posterior function
+        are sent to each process once, when it is started, and the processes
+        are closed when the sampler has finished. Alternatively, pool can be
+        any object with a map() method, e.g., a multiprocessing pool created
+        by the user. In this case, the arguments of the log-posterior
+        function are sent with each group of walkers and the number of groups
+        is nprocs (default is pool._processes, if available, or the number of
+        CPUs).
+
+        If backend is a file name, the chain is also written to this file as
+        the sampler runs, together with a second file with the same name plus
+        the extension '.state' that contains the state of the sampler. The
+        files are updated every checkpoint steps of the burn-in phase and
+        every checkpoint samples of the chain. With resume=True, a run that
+        was interrupted is continued from the last update, e.g., after a job
+        has been stopped by a time limit. The same call can also be used to
+        extend a run that has finished, in which case steps is the total
+        number of samples in the extended chain. The parameters sampled,
+        nwalkers and thin must be the same as for the original run. With
+        resume=False, any existing chain in the file is overwritten.
+
+        With adaptive=True, the options burn, steps and thin are not used.
+        Instead, the sampler is run until the chain has converged, up to a
+        maximum of max_steps steps. Every check steps, the integrated
+        autocorrelation time, tau, is estimated for each parameter. The chain
+        has converged when it is longer than ntau times the largest value of
+        tau and the values of tau have changed by less than a fraction
+        tau_rtol since the last check. The first 2*max(tau) steps are then
+        discarded as burn-in and the chain is thinned by min(tau)/2.
+
+        The autocorrelation times (in steps) and the effective sample sizes
+        for the parameters are stored in result.tau and result.ess, in the
+        order given by result.var_names. The number of burn-in steps and the
+        thinning factor are stored in result.burn and result.thin. For
+        adaptive=True, result.converged is False if the chain did not
+        converge within max_steps steps.
+
+        The sampling algorithm is set by method. The default, 'emcee', is
+        the affine-invariant ensemble sampler from emcee. With
+        method='demcmc', the walkers are instead updated using differential
+        evolution moves (80%) and snooker moves (20%), which can be more
+        efficient for multi-modal or strongly correlated posteriors. All the
+        options above apply to both of these methods. For nested sampling,
+        use nested_sampler().
+
+        """
+
+        if method not in ('emcee', 'demcmc'):
+            raise ValueError('method must be emcee or demcmc')
+
+        result, params, lin, vv, vs, posterior = self._sampler_setup(method,
+                params, log_sigma, add_shoterm, log_omega0, log_S0, log_Q,
+                linear, priors, vectorize)
+        vn = result.var_names
+
+        # Initialize sampler positions ensuring all walkers produce valid
+        # function values.
+        n_varys = len(vv)
+        pos = np.empty((0, n_varys))
+        while len(pos) < nwalkers:
+            pos_i = vv + vs*np.random.randn(nwalkers, n_varys)*init_scale
+            lnpost_i = posterior(pos_i)
+            pos = np.vstack([pos, pos_i[lnpost_i > -np.inf]])
+        pos = pos[:nwalkers]
+
+        pool, nprocs, close_pool = _start_pool(posterior, nprocs, pool)
+        if pool is None:
+            log_posterior_func = posterior
+        elif close_pool:
+            log_posterior_func = _PoolLogPosterior(pool, _pool_call, nprocs)
+        else:
+            log_posterior_func = _PoolLogPosterior(pool, posterior, nprocs)
+
+        if method == 'demcmc':
+            moves = [(DEMove(), 0.8), (DESnookerMove(), 0.2)]
+        else:
+            moves = None
+
+        # In adaptive mode, the whole chain is stored and the burn-in and
+        # thinning are set after the sampler has finished
+        if adaptive:
+            burn, steps, thin = 0, max_steps, 1
+
+        def _run(sampler, pos, n):
+            # Run the sampler for n samples from pos, or until convergence
+            if progress:
+                print('Running sampler ..')
+                stdout.flush()
+            if adaptive:
+                return _run_adaptive(sampler, pos, n, ntau, tau_rtol, check,
+                        progress)
+            sampler.run_mcmc(pos, n, thin_by=thin,
+                skip_initial_state_check=True, progress=progress)
+
+        store = None
+        converged = None
+        try:
+            if backend is None:
+                sampler = EnsembleSampler(nwalkers, n_varys,
+                        log_posterior_func, vectorize=True, moves=moves)
+                pos = _burn_in(sampler, pos, burn, progress)
+                converged = _run(sampler, pos, steps)
+            else:
+                store = _chain_store(backend, checkpoint, resume, nwalkers,
+                        vn, thin)
+                sampler = EnsembleSampler(nwalkers, n_varys,
+                        log_posterior_func, vectorize=True, moves=moves,
+                        backend=store)
+                if store.iteration == 0:
+                    pos = _burn_in(sampler, pos, burn, progress, store)
+                else:
+                    # Continue from the last sample in the chain
+                    pos = None
+                if store.iteration < steps:
+                    converged = _run(sampler, pos, steps-store.iteration)
+                elif adaptive:
+                    converged = _run(sampler, pos, 0)
+        finally:
+            if store is not None and store.initialized:
+                store.write()
+            if close_pool:
+                pool.close()
+                pool.join()
+
+        # Autocorrelation times in steps and effective sample sizes
+        nsteps = thin*sampler.iteration
+        tau = sampler.get_autocorr_time(tol=0)
+        if adaptive:
+            # Keep at least half the chain if it has not converged
+            burn = min(int(np.ceil(2*np.max(tau))), nsteps//2)
+            thin = max(1, int(0.5*np.min(tau)))
+            discard, thin_by = burn, thin
+        else:
+            tau = thin*tau
+            discard, thin_by = 0, 1
+        ess = nwalkers*(nsteps - discard)/tau
+        result.tau = tau
+        result.ess = ess
+        result.burn = burn
+        result.thin = thin
+        if adaptive:
+            result.converged = converged
+        result.nfev = nwalkers*(nsteps + burn*(not adaptive))
+
+        flatchain = sampler.get_chain(flat=True, discard=discard,
+                thin=thin_by).reshape((-1, len(vn)))
+        lnprob = sampler.get_log_prob(discard=discard, thin=thin_by)
+        return self._sampler_result(result, params, lin, posterior, sampler,
+                flatchain, lnprob)
+
+    # ----------------------------------------------------------------
+
+    def nested_sampler(self, params=None, nlive=500, dlogz=None,
+            log_sigma=None, add_shoterm=False, log_omega0=None, log_S0=None,
+            log_Q=None, progress=True, linear=False, priors=None,
+            vectorize=True, nprocs=None, pool=None, backend=None,
+            resume=False):
+        """
+        Sample the posterior probability distribution of the model parameters
+        by nested sampling and calculate the evidence
+
+        The posterior is sampled using dynesty with nlive live points until
+        the estimated remaining contribution to the evidence is less than
+        dlogz (dynesty default if None). dynesty is an optional dependency,
+        e.g., pip install pycheops[nested].
+
+        The model and initial parameter values are taken from the last fit
+        using lmfit_transit() or lmfit_eclipse(). The options params,
+        log_sigma, add_shoterm, log_omega0, log_S0, log_Q, linear, priors,
+        vectorize, nprocs and pool are as for emcee_sampler().
+
+        Free parameters with a ufloat prior have a Gaussian prior, truncated
+        at their bounds if these are set, and the others have a uniform prior
+        between their bounds, which must be finite. The other terms in the
+        prior, e.g., the prior on (D, W, b) and priors, are treated as part
+        of the likelihood. 
+
+        With linear='marginalise' (or linear=True), the linear parameters
+        without a Gaussian prior have an improper uniform prior, as for
+        emcee_sampler(), so the evidence is not normalised. The values of
+        logz for models with different numbers of these parameters cannot be
+        compared. For model comparison, either specify a Gaussian prior as a
+        ufloat for each linear parameter or use linear=False, so that these
+        parameters are sampled with uniform priors between their bounds.
+
+        The log of the evidence and its error are stored in result.logz and
+        result.logzerr. result.chain is a set of equally-weighted samples
+        from the posterior and result.ess is the effective number of
+        samples. The result is stored in the same attributes of the dataset
+        as the result of emcee_sampler(), with result.method='nested'.
+
+        If backend is a file name, the state of the sampler is saved to this
+        file every 60 seconds, and a run can be resumed from this file with
+        resume=True.
+
+        """
+
+        if dynesty is None:
+            raise ModuleNotFoundError('nested_sampler requires dynesty, '
+                    'e.g., pip install pycheops[nested]')
+
+        result, params, lin, vv, vs, posterior = self._sampler_setup(
+                'nested', params, log_sigma, add_shoterm, log_omega0, log_S0,
+                log_Q, linear, priors, vectorize)
+        n_varys = len(vv)
+
+        pool, nprocs, close_pool = _start_pool(posterior, nprocs, pool)
+        if close_pool:
+            loglike = _pool_call_nested
+            prior_transform = _pool_prior_transform
+        else:
+            loglike = posterior.log_likelihood_nested
+            prior_transform = posterior.prior_transform
+        queue_size = None if pool is None else nprocs
+
+        try:
+            if resume and backend is not None and os.path.exists(backend):
+                sampler = dynesty.NestedSampler.restore(backend, pool=pool)
+            else:
+                rstate = np.random.default_rng(np.random.randint(2**32))
+                # Slice sampling copes with the sharp edges of the prior on
+                # (D, W, b) better than uniform sampling
+                sampler = dynesty.NestedSampler(loglike, prior_transform,
+                        n_varys, nlive=nlive, sample='rslice', pool=pool,
+                        queue_size=queue_size, rstate=rstate)
+                resume = False
+            sampler.run_nested(dlogz=dlogz, print_progress=progress,
+                    checkpoint_file=backend, resume=resume)
+        finally:
+            if close_pool:
+                pool.close()
+                pool.join()
+
+        # Equally-weighted samples from the weighted samples of the nested
+        # sampler
+        res = sampler.results
+        w = np.exp(res.logwt - res.logz[-1])
+        w /= w.sum()
+        rstate = np.random.default_rng(np.random.randint(2**32))
+        i = dynesty.utils.resample_equal(np.arange(len(w)), w, rstate)
+        flatchain = res.samples[i]
+        z = (flatchain - posterior.mu)/posterior.sigma
+        lnprob = res.logl[i] - 0.5*np.sum(z**2, axis=1)
+        result.logz = res.logz[-1]
+        result.logzerr = res.logzerr[-1]
+        result.nlive = nlive
+        result.ess = np.full(n_varys, 1/np.sum(w**2))
+        result.tau = None
+        result.burn = 0
+        result.thin = 1
+        result.nfev = np.sum(res.ncall)
+        return self._sampler_result(result, params, lin, posterior, sampler,
+                flatchain, lnprob)
+
     # ----------------------------------------------------------------
 
     def emcee_report(self, **kwargs):
@@ -1371,8 +2324,12 @@ class Dataset(object):
         The parameters to be plotted at specified by the keyword plotkeys, or
         plotkeys='all' to plot every jump parameter.
 
+        Not available for results from nested_sampler().
+
         """
 
+        if self.emcee.method == 'nested':
+            raise ValueError('No walkers to plot for nested sampling')
         params = self.emcee.params
         samples = self.sampler.get_chain()
 
@@ -1416,7 +2373,7 @@ class Dataset(object):
         if plotkeys == 'all':
             plotkeys = varkeys
 
-        chain = self.sampler.get_chain(flat=True)
+        chain = self.emcee.chain
         xs = []
         for key in plotkeys:
             if key in varkeys:
@@ -2112,23 +3069,29 @@ class Dataset(object):
         Fsc = np.zeros_like(T)
         Nmn = np.zeros_like(T)
 
-        for i,_t in enumerate(T):
-            if local:
+        if local:
+            for i,_t in enumerate(T):
                 j = (np.abs(time-_t) < (width/48)).nonzero()[0]
                 _n,_f = transit_noise(time[j], flux[j], flux_err[j], T_0=_t,
                               width=width, method='scaled')
                 _m = transit_noise(time[j], flux[j], flux_err[j], T_0=_t,
                            width=width, method='minerr')
-            else:
-                _n,_f = transit_noise(time, flux, flux_err, T_0=_t,
-                              width=width, method='scaled')
-                _m = transit_noise(time, flux, flux_err, T_0=_t,
-                           width=width, method='minerr')
-            if np.isfinite(_n):
-                Nsc[i] = _n
-                Fsc[i] = _f
-            if np.isfinite(_m):
-                Nmn[i] = _m
+                if np.isfinite(_n):
+                    Nsc[i] = _n
+                    Fsc[i] = _f
+                if np.isfinite(_m):
+                    Nmn[i] = _m
+        else:
+            # All noise estimates for each method are done in one call
+            _n,_f = transit_noise(time, flux, flux_err, T_0=T,
+                          width=width, method='scaled')
+            _m = transit_noise(time, flux, flux_err, T_0=T,
+                       width=width, method='minerr')
+            msk = np.isfinite(_n)
+            Nsc[msk] = _n[msk]
+            Fsc[msk] = _f[msk]
+            msk = np.isfinite(_m)
+            Nmn[msk] = _m[msk]
 
         msk = (Nsc > 0) 
         Tsc = T[msk]
@@ -58,8 +58,9 @@ from __future__ import (absolute_import, division, print_function,
                                 unicode_literals)
 from .constants import *
 import numpy as np
-from scipy.optimize import brent
-from numba import vectorize
+from functools import lru_cache
+from numba import vectorize, jit
+from numba import config as config_numba
 from uncertainties import ufloat, UFloat
 from uncertainties.umath import sqrt as usqrt
 import requests
@@ -74,12 +75,11 @@ from time import localtime, mktime
 from os.path import getmtime
 from .core import load_config
 from matplotlib.patches import Ellipse
-from scipy.signal import argrelextrema
 
 
 
 __all__ = [ 'a_rsun','f_m','m1sin3i','m2sin3i','asini','rhostar','g_2',
-        'K_kms','m_comp','transit_width','esolve','t2z',
+        'K_kms','m_comp','transit_width','esolve','kepler_solve','t2z',
         'tzero2tperi', 'vrad', 'xyz_planet']
 
 _arsun   = (GM_SunN*mean_solar_day**2/(4*np.pi**2))**(1/3.)/R_SunN
@@ -265,6 +265,34 @@ def transit_width(r, k, b, P=1):
 
 #---------------
 
+@jit(nopython=True, nogil=True, inline='always')
+def _esolve_point(M, ecc):
+    # Markley's method for a single value of M and ecc
+    M = M % (2*np.pi)
+    if ecc == 0:
+        return M
+    if M > np.pi:
+        M = 2*np.pi - M
+        flip = True
+    else:
+        flip = False
+    alpha = (3*np.pi + 1.6*(np.pi-np.abs(M))/(1+ecc) )/(np.pi - 6/np.pi)
+    d = 3*(1 - ecc) + alpha*ecc
+    r = 3*alpha*d * (d-1+ecc)*M + M**3
+    q = 2*alpha*d*(1-ecc) - M**2
+    w = (np.abs(r) + np.sqrt(q**3 + r**2))**(2/3)
+    E = (2*r*w/(w**2 + w*q + q**2) + M) / d
+    f_0 = E - ecc*np.sin(E) - M
+    f_1 = 1 - ecc*np.cos(E)
+    f_2 = ecc*np.sin(E)
+    f_3 = 1-f_1
+    d_3 = -f_0/(f_1 - 0.5*f_0*f_2/f_1)
+    d_4 = -f_0/(f_1 + 0.5*d_3*f_2 + (d_3**2)*f_3/6)
+    E = E -f_0/(f_1 + 0.5*d_4*f_2 + d_4**2*f_3/6 - d_4**3*f_2/24)
+    if flip:
+        E =  2*np.pi - E
+    return E
+
 @vectorize(nopython=True)
 def esolve(M, ecc):
     """
@@ -293,31 +321,156 @@ def esolve(M, ecc):
      Maximum error = 8.88e-16
 
     """
-    M = M % (2*np.pi)
-    if ecc == 0:
-        return M
-    if M > np.pi:
-        M = 2*np.pi - M
-        flip = True
-    else:
-        flip = False
-    alpha = (3*np.pi + 1.6*(np.pi-np.abs(M))/(1+ecc) )/(np.pi - 6/np.pi)
-    d = 3*(1 - ecc) + alpha*ecc
-    r = 3*alpha*d * (d-1+ecc)*M + M**3
-    q = 2*alpha*d*(1-ecc) - M**2
-    w = (np.abs(r) + np.sqrt(q**3 + r**2))**(2/3)
-    E = (2*r*w/(w**2 + w*q + q**2) + M) / d
-    f_0 = E - ecc*np.sin(E) - M
-    f_1 = 1 - ecc*np.cos(E)
-    f_2 = ecc*np.sin(E)
-    f_3 = 1-f_1
-    d_3 = -f_0/(f_1 - 0.5*f_0*f_2/f_1)
-    d_4 = -f_0/(f_1 + 0.5*d_3*f_2 + (d_3**2)*f_3/6)
-    E = E -f_0/(f_1 + 0.5*d_4*f_2 + d_4**2*f_3/6 - d_4**3*f_2/24)
-    if flip:
-        E =  2*np.pi - E
+    return _esolve_point(M, ecc)
+
+#---------------
+
+# Kepler solver selection for kepler_solve(), used by t2z, vrad and
+# xyz_planet. KEPLER_SOLVER is one of 'auto', 'exact', 'parallel' or 'table'.
+# With 'auto', the multi-threaded solver is used for arrays with at least
+# KEPLER_PARALLEL_MIN_SIZE elements if more than one thread is available,
+# and the lookup table is used for arrays with at least KEPLER_TABLE_MIN_SIZE
+# elements if the accuracy target KEPLER_TOL is no smaller than 
+# KEPLER_TABLE_TOL_MIN.
+KEPLER_SOLVER = 'auto'
+KEPLER_TOL = 1e-12
+KEPLER_PARALLEL_MIN_SIZE = 65536
+KEPLER_TABLE_MIN_SIZE = 4096
+KEPLER_TABLE_TOL_MIN = 1e-14
+# Size of the lookup table in M (0 to pi) and ecc (0 to 1)
+_KEPLER_TABLE_NM = 1025
+_KEPLER_TABLE_NE = 101
+
+def _esolve_func(M, ecc):
+    return _esolve_point(M, ecc)
+
+# The multi-threaded ufunc is compiled when it is first used, so that the
+# numba threads are not started on import, e.g., before a process is forked.
+_esolve_parallel_ufunc = []
+
+def _esolve_parallel(M, ecc):
+    if not _esolve_parallel_ufunc:
+        _esolve_parallel_ufunc.append(vectorize(['float64(float64, float64)'],
+            nopython=True, target='parallel')(_esolve_func))
+    return _esolve_parallel_ufunc[0](M, ecc)
+
+@jit(nopython=True, nogil=True)
+def _kepler_table_build(nM, ne):
+    tab = np.empty((ne, nM))
+    for j in range(ne):
+        ecc = min(j/(ne-1), 1-1e-12)
+        for i in range(nM):
+            tab[j,i] = _esolve_point(np.pi*i/(nM-1), ecc)
+    return tab
+
+@lru_cache(maxsize=1)
+def _kepler_table():
+    return _kepler_table_build(_KEPLER_TABLE_NM, _KEPLER_TABLE_NE)
+
+@jit(nopython=True, nogil=True, inline='always')
+def _lagrange4(u):
+    # Weights for cubic interpolation at u (0<=u<=1) between the 2nd and 3rd
+    # of 4 equally-spaced points
+    return (-u*(u-1)*(u-2)/6, (u+1)*(u-1)*(u-2)/2, 
+            -(u+1)*u*(u-2)/2, (u+1)*u*(u-1)/6)
+
+@jit(nopython=True, nogil=True, inline='always')
+def _cubic(r, i, w0, w1, w2, w3):
+    return w0*r[i] + w1*r[i+1] + w2*r[i+2] + w3*r[i+3]
+
+@jit(nopython=True, nogil=True)
+def _esolve_table(M, ecc, tab, tol):
+    # Bicubic interpolation in the table of E(M, ecc) followed by one Newton
+    # step. Values where the estimated error after the Newton step exceeds
+    # tol are recalculated with Markley's method.
+    ne, nM = tab.shape
+    E = np.empty(len(M))
+    for i in range(len(M)):
+        e = ecc[i]
+        m = M[i] % (2*np.pi)
+        if e == 0:
+            E[i] = m
+            continue
+        if (e < 0) or (e >= 1):
+            E[i] = _esolve_point(m, e)
+            continue
+        flip = m > np.pi
+        if flip:
+            m = 2*np.pi - m
+        x = m*(nM-1)/np.pi
+        ix = min(max(int(x)-1, 0), nM-4)
+        y = e*(ne-1)
+        iy = min(max(int(y)-1, 0), ne-4)
+        wx0, wx1, wx2, wx3 = _lagrange4(x-ix-1)
+        wy0, wy1, wy2, wy3 = _lagrange4(y-iy-1)
+        Ei = (wy0*_cubic(tab[iy], ix, wx0, wx1, wx2, wx3) + 
+              wy1*_cubic(tab[iy+1], ix, wx0, wx1, wx2, wx3) + 
+              wy2*_cubic(tab[iy+2], ix, wx0, wx1, wx2, wx3) + 
+              wy3*_cubic(tab[iy+3], ix, wx0, wx1, wx2, wx3))
+        sinE = np.sin(Ei)
+        f_1 = 1 - e*np.cos(Ei)
+        d = -(Ei - e*sinE - m)/f_1
+        if 0.5*e*abs(sinE)*d**2/f_1 > tol:
+            Ei = _esolve_point(m, e)
+        else:
+            Ei = Ei + d
+        if flip:
+            Ei = 2*np.pi - Ei
+        E[i] = Ei
     return E
 
+def kepler_solve(M, ecc, solver=None, tol=None):
+    """
+    Solve Kepler's equation M = E - ecc.sin(E) for arrays of M
+
+    :param M: mean anomaly (scalar or array)
+    :param ecc: eccentricity (scalar or array)
+    :param solver: 'exact', 'parallel', 'table' or 'auto' (default is the
+      module-level value KEPLER_SOLVER)
+    :param tol: accuracy target for E (default is KEPLER_TOL)
+
+    :returns: eccentric anomaly, E
+
+    The 'exact' solver is :func:`esolve`. The 'parallel' solver uses the
+    same algorithm applied to the elements of the array in parallel. The
+    'table' solver uses bicubic interpolation in a precomputed table of E as
+    a function of M and ecc followed by one Newton-Raphson iteration. The
+    error after this iteration is estimated for each point and the exact
+    solver is used for points where this estimate exceeds tol, e.g., for
+    small values of M at very high eccentricity. 
+
+    With solver='auto' the solver is selected based on the size of the
+    array and the accuracy target - see KEPLER_SOLVER, KEPLER_TOL,
+    KEPLER_PARALLEL_MIN_SIZE, KEPLER_TABLE_MIN_SIZE and KEPLER_TABLE_TOL_MIN.
+
+    """
+    if solver is None:
+        solver = KEPLER_SOLVER
+    if tol is None:
+        tol = KEPLER_TOL
+    if np.ndim(M) == 0 and np.ndim(ecc) == 0:
+        return esolve(M, ecc)
+    shape = np.broadcast_shapes(np.shape(M), np.shape(ecc))
+    size = int(np.prod(shape))
+    if solver == 'auto':
+        if (size >= KEPLER_PARALLEL_MIN_SIZE and 
+                config_numba.NUMBA_NUM_THREADS > 1):
+            solver = 'parallel'
+        elif size >= KEPLER_TABLE_MIN_SIZE and tol >= KEPLER_TABLE_TOL_MIN:
+            solver = 'table'
+        else:
+            solver = 'exact'
+    if solver == 'exact':
+        return esolve(M, ecc)
+    if solver == 'parallel':
+        return _esolve_parallel(M, ecc)
+    if solver == 'table':
+        M = np.broadcast_to(np.asarray(M, dtype=np.float64), shape)
+        ecc = np.broadcast_to(np.asarray(ecc, dtype=np.float64), shape)
+        E = _esolve_table(M.ravel(), ecc.ravel(), _kepler_table(), tol)
+        return E.reshape(shape)
+    raise ValueError('Invalid Kepler solver {}'.format(solver))
+
 #---------------
 
 def t2z(t, tzero, P, sini, rstar, ecc=0, omdeg=90, returnMask=False):
@@ -341,6 +494,10 @@ def t2z(t, tzero, P, sini, rstar, ecc=0, omdeg=90, returnMask=False):
 
     :returns: z [, mask]
 
+    If t is a single-precision (float32) array then so is z. The error in z
+    due to the limited precision of t is about 6e-8*|t|*2*pi/(P*rstar), so
+    t should be measured from a reference time close to the observations.
+
     :Example:
     
     >>> from pycheops.funcs import t2z
@@ -365,19 +522,447 @@ def t2z(t, tzero, P, sini, rstar, ecc=0, omdeg=90, returnMask=False):
     else:
         tp = tzero2tperi(tzero,P,sini,ecc,omdeg)
         M = 2*np.pi*(t-tp)/P
-        E = esolve(M,ecc)
+        E = kepler_solve(M,ecc)
         nu = 2*np.arctan(np.sqrt((1+ecc)/(1-ecc))*np.tan(E/2))
         omrad = np.pi*omdeg/180
         # Equation (5.63) from Hilditch
         z = (((1-ecc**2)/
             (1+ecc*np.cos(nu))*np.sqrt(1-np.sin(omrad+nu)**2*sini**2))/rstar)
+    if np.asarray(t).dtype == np.float32:
+        z = np.asarray(z, dtype=np.float32)
     if returnMask:
         return z, np.sin(nu + omrad)*sini < 0
     else:
         return z
 
+@jit(nopython=True, nogil=True, inline='always')
+def _t2z_point(t, tzero, tperi, P, sini, rstar, ecc, sinom, cosom):
+    # Scalar version of t2z for use in compiled light curve models. Returns
+    # z and a flag that is True if the planet is further from the observer
+    # than the star. tperi, sinom and cosom are not used if ecc == 0.
+    # To minimise the number of calls to trigonometric functions, the true
+    # anomaly nu is only calculated implicitly via cos(nu) and sin(nu).
+    if ecc == 0:
+        cosnu = np.cos(2*np.pi*(t-tzero)/P)
+        z = np.sqrt(1 - cosnu**2*sini**2)/rstar
+        return z, cosnu*sini < 0
+    E = esolve(2*np.pi*(t-tperi)/P, ecc)
+    z, r, sinwnu = _E2z_point(E, sini, rstar, ecc, sinom, cosom)
+    return z, sinwnu*sini < 0
+
+@jit(nopython=True, nogil=True, inline='always')
+def _E2z_point(E, sini, rstar, ecc, sinom, cosom):
+    # z, star-planet separation r (in units of the semi-major axis) and
+    # sin(omega + nu) from the eccentric anomaly E
+    return _cs2z_point(np.cos(E), np.sin(E), sini, rstar, ecc, sinom, cosom)
+
+@jit(nopython=True, nogil=True, inline='always')
+def _cs2z_point(cosE, sinE, sini, rstar, ecc, sinom, cosom):
+    # As _E2z_point, given cos(E) and sin(E). For circular orbits with
+    # sinom=1 and cosom=0, E is the phase angle from mid-transit.
+    # 1 - ecc*cos(E) = (1-ecc**2)/(1+ecc*cos(nu)) 
+    r = 1 - ecc*cosE
+    cosnu = (cosE - ecc)/r
+    sinnu = np.sqrt(1-ecc**2)*sinE/r
+    # sin(omega + nu)
+    sinwnu = sinom*cosnu + cosom*sinnu
+    z = r*np.sqrt(1-sinwnu**2*sini**2)/rstar
+    return z, r, sinwnu
+
+@jit(nopython=True, nogil=True, inline='always')
+def _shift_anomaly(cosE, sinE, ecc, dM):
+    # cos(E') and sin(E') for the eccentric anomaly E' at mean anomaly M+dM
+    # given cos(E) and sin(E) at mean anomaly M. E'-E is found by
+    # Newton-Raphson iteration, which usually converges in one or two steps
+    # if dM is small.
+    if ecc == 0:
+        d = dM
+    else:
+        esinE = ecc*sinE
+        ecosE = ecc*cosE
+        d = dM/(1-ecosE)
+        for _ in range(8):
+            sind = np.sin(d)
+            cosd = np.cos(d)
+            f = d - esinE*(cosd-1) - ecosE*sind - dM
+            dd = f/(1 + esinE*sind - ecosE*cosd)
+            d -= dd
+            if np.abs(dd) < 1e-12: break
+    sind = np.sin(d)
+    cosd = np.cos(d)
+    return cosE*cosd - sinE*sind, sinE*cosd + cosE*sind
+
+@jit(nopython=True, nogil=True)
+def _contact_window(ecc, sinom, cosom, rstar, k):
+    # Interval of mean anomaly outside which z > 1+k or the planet is behind
+    # the star, returned as the phase of the centre of the interval relative
+    # to periastron and the half-width of the interval, both in units of the
+    # orbital period. The half-width is 0.5 if no such interval exists. This
+    # uses z >= r*|cos(omega+nu)|/rstar and r >= 1-ecc.
+    # For circular orbits the phase is relative to the time of mid-transit.
+    x = (1+k)*rstar/(1-ecc)
+    if x >= 1:
+        return 0.0, 0.5
+    if ecc == 0:
+        return 0.0, np.arcsin(x)/(2*np.pi) + 1e-9
+    omrad = np.arctan2(sinom, cosom)
+    dnu = np.arcsin(x)
+    M = np.empty(2)
+    for i,nu in enumerate((0.5*np.pi-dnu-omrad, 0.5*np.pi+dnu-omrad)):
+        E = 2*np.arctan(np.sqrt((1-ecc)/(1+ecc))*np.tan(0.5*nu))
+        M[i] = (E - ecc*np.sin(E))/(2*np.pi)
+    w = (M[1] - M[0]) % 1
+    # Small margin to allow for rounding errors
+    return M[0] + 0.5*w, min(0.5, 0.5*w + 1e-9)
+
 #---------
 
+@jit(nopython=True, nogil=True)
+def _orbit_arrays(t, tperi, P, sini, rstar, ecc, sinom, cosom, dt):
+    # z, behind-the-star flag, r and cos(phase angle) for the times t, and z
+    # and the flag for the times t-dt (if dt != 0) from a single solution of
+    # Kepler's equation per point. The eccentric anomaly at t-dt is found
+    # by Newton-Raphson iteration starting from E(t), which usually converges
+    # in one or two steps because 2*pi*dt/P is small.
+    n = len(t)
+    z = np.empty(n)
+    m = np.empty(n, dtype=np.bool_)
+    r = np.empty(n)
+    cosb = np.empty(n)
+    z_dt = np.empty(n)
+    m_dt = np.empty(n, dtype=np.bool_)
+    w = 2*np.pi/P
+    for i in range(n):
+        if ecc == 0:
+            E = w*(t[i]-tperi)
+        else:
+            E = esolve(w*(t[i]-tperi), ecc)
+        z[i], r[i], sinwnu = _E2z_point(E, sini, rstar, ecc, sinom, cosom)
+        m[i] = sinwnu*sini < 0
+        cosb[i] = -sini*sinwnu
+        if dt != 0:
+            # Solve E' - ecc.sin(E') = M - w.dt for d = E'-E
+            d = -w*dt/r[i]
+            if ecc > 0:
+                esinE = ecc*np.sin(E)
+                ecosE = 1 - r[i]
+                for _ in range(8):
+                    sind = np.sin(d)
+                    cosd = np.cos(d)
+                    f = d - esinE*(cosd-1) - ecosE*sind + w*dt
+                    dd = f/(1 + esinE*sind - ecosE*cosd)
+                    d -= dd
+                    if np.abs(dd) < 1e-12: break
+            z_dt[i], _, sinwnu = _E2z_point(E+d,sini,rstar,ecc,sinom,cosom)
+            m_dt[i] = sinwnu*sini < 0
+    return z, m, r, cosb, z_dt, m_dt
+
+class OrbitGeometry(object):
+    """
+    Star-planet geometry for an array of times in a Keplerian orbit
+
+    The time of periastron is calculated when the object is created. The
+    attributes z, mask, r and beta are calculated together by solve(), or
+    the first time any one of them is used, with one solution of Kepler's
+    equation per point. The same OrbitGeometry object can be used for all
+    the components of a model, e.g., transits, eclipses and phase effects.
+
+    If the light travel time correction a_c is not 0, the attributes z_ltt
+    and mask_ltt are z and mask for the times t-a_c, calculated by
+    Newton-Raphson iteration starting from the solution of Kepler's equation
+    for the times t, i.e., without a second full solution of Kepler's
+    equation.
+
+    The transit and eclipse light curves in pycheops.models use these arrays
+    if the object has already been solved and there is no exposure time
+    integration. Otherwise, they only evaluate points near the contact
+    points for sorted times, and solve Kepler's equation for these points
+    individually.
+
+    :param t: array of times
+    :param tzero: time of inferior conjunction, i.e., mid-transit
+    :param P: orbital period
+    :param sini: sine of orbital inclination
+    :param rstar: scaled stellar radius, R_star/a
+    :param ecc: eccentricity (optional, default=0)
+    :param omdeg: longitude of periastron in degrees (optional, default=90)
+    :param a_c: light travel time correction in the same units as P
+
+    N.B. omdeg is the longitude of periastron for the star's orbit
+
+    Attributes:
+
+    * z: star-planet separation relative to scaled stellar radius
+    * mask: True where the planet is further from the observer than the star
+    * r: star-planet separation in units of the semi-major axis
+    * beta: phase angle of the planet in radians, i.e., 0 at full phase
+    * z_ltt, mask_ltt: z and mask for the times t-a_c
+    * solved: True if the arrays above have been calculated
+
+    :Example:
+
+    >>> from pycheops.funcs import OrbitGeometry
+    >>> from numpy import linspace
+    >>> t = linspace(0,1,1000)
+    >>> g = OrbitGeometry(t, 0, 1, 0.999, 0.1, 0.1, 90, a_c=0.0001)
+    >>> transit = (g.z < 1) & ~g.mask
+    >>> eclipse = (g.z_ltt < 1) & g.mask_ltt
+
+    """
+    def __init__(self, t, tzero, P, sini, rstar, ecc=0, omdeg=90, a_c=0):
+        t = np.asarray(t)
+        # Single-precision times are used as they are
+        self.t = t if t.dtype == np.float32 else t.astype(float, copy=False)
+        self.tzero = tzero
+        self.P = P
+        self.sini = sini
+        self.rstar = rstar
+        self.ecc = ecc
+        self.omdeg = omdeg
+        self.a_c = a_c
+        self.omrad = omdeg*np.pi/180
+        if ecc > 0:
+            self.tperi = float(tzero2tperi(tzero, P, sini, ecc, omdeg))
+            self.sinom = np.sin(self.omrad)
+            self.cosom = np.cos(self.omrad)
+        else:
+            # Circular orbits use omega=90, i.e., t=tzero at nu=0
+            self.tperi = tzero
+            self.sinom = 1.0
+            self.cosom = 0.0
+        self._arrays = None
+
+    def contact_window(self, k, eclipse=False):
+        """
+        Phase window outside which the planet-star separation z > 1+k
+
+        :param k: planet-star radius ratio
+        :param eclipse: window for eclipses if True, otherwise transits
+
+        :returns: phase of the window centre relative to the time of
+          periastron and half-width of the window (units of P)
+
+        """
+        s = -1 if eclipse else 1
+        ph_c, dph = _contact_window(self.ecc, s*self.sinom, s*self.cosom,
+                self.rstar, k)
+        if eclipse and (self.ecc == 0):
+            ph_c += 0.5
+        return ph_c, dph
+
+    def solve(self):
+        """
+        Calculate z, mask, r, beta, z_ltt and mask_ltt for all the times
+
+        """
+        if self._arrays is None:
+            self._arrays = _orbit_arrays(self.t, self.tperi, self.P,
+                    self.sini, self.rstar, self.ecc, self.sinom, self.cosom,
+                    self.a_c)
+        return self._arrays
+
+    @property
+    def solved(self):
+        return self._arrays is not None
+
+    @property
+    def z(self):
+        return self.solve()[0]
+
+    @property
+    def mask(self):
+        return self.solve()[1]
+
+    @property
+    def r(self):
+        return self.solve()[2]
+
+    @property
+    def beta(self):
+        return np.arccos(self.solve()[3])
+
+    @property
+    def z_ltt(self):
+        if self.a_c == 0:
+            return self.z
+        return self.solve()[4]
+
+    @property
+    def mask_ltt(self):
+        if self.a_c == 0:
+            return self.mask
+        return self.solve()[5]
+
+#---------
+
+@jit(nopython=True, nogil=True, inline='always')
+def _delta(th, sin2i, omrad, ecc):
+    # Equation (4.9) from Hilditch
+    return (1-ecc**2)*(
+            np.sqrt(1-sin2i*np.sin(th+omrad)**2)/(1+ecc*np.cos(th)))
+
+@jit(nopython=True, nogil=True)
+def _brent(f, args, xa, xb, xc):
+    # Minimum of f(x, *args) bracketed by (xa, xb, xc) for a compiled
+    # function f using the same algorithm and tolerance as
+    # scipy.optimize.brent (tol=1.48e-8). Returns x and f(x, *args).
+    tol = 1.48e-8
+    _mintol = 1.0e-11
+    _cg = 0.3819660
+    x = w = v = xb
+    fw = fv = fx = f(x, *args)
+    a, b = (xa, xc) if xa < xc else (xc, xa)
+    deltax = 0.0
+    rat = 0.0
+    for _ in range(500):
+        tol1 = tol*abs(x) + _mintol
+        tol2 = 2.0*tol1
+        xmid = 0.5*(a+b)
+        if abs(x-xmid) < (tol2 - 0.5*(b-a)):
+            break
+        if abs(deltax) <= tol1:
+            # Golden section step
+            deltax = a-x if x >= xmid else b-x
+            rat = _cg*deltax
+        else:
+            # Parabolic step
+            tmp1 = (x-w)*(fx-fv)
+            tmp2 = (x-v)*(fx-fw)
+            p = (x-v)*tmp2 - (x-w)*tmp1
+            tmp2 = 2.0*(tmp2-tmp1)
+            if tmp2 > 0.0:
+                p = -p
+            tmp2 = abs(tmp2)
+            dx_temp = deltax
+            deltax = rat
+            if ((p > tmp2*(a-x)) and (p < tmp2*(b-x)) and
+                    (abs(p) < abs(0.5*tmp2*dx_temp))):
+                rat = p/tmp2
+                u = x + rat
+                if ((u-a) < tol2) or ((b-u) < tol2):
+                    rat = tol1 if xmid-x >= 0 else -tol1
+            else:
+                deltax = a-x if x >= xmid else b-x
+                rat = _cg*deltax
+        if abs(rat) < tol1:
+            u = x + tol1 if rat >= 0 else x - tol1
+        else:
+            u = x + rat
+        fu = f(u, *args)
+        if fu > fx:
+            if u < x:
+                a = u
+            else:
+                b = u
+            if (fu <= fw) or (w == x):
+                v, w, fv, fw = w, u, fw, fu
+            elif (fu <= fv) or (v == x) or (v == w):
+                v, fv = u, fu
+        else:
+            if u >= x:
+                a = x
+            else:
+                b = x
+            v, w, x = w, x, u
+            fv, fw, fx = fw, fx, fu
+    return x, fx
+
+@jit(nopython=True, nogil=True)
+def _brentq(f, args, xa, xb):
+    # Root of f(x, *args) in the interval (xa, xb) for a compiled function f
+    # using the same algorithm and tolerances as scipy.optimize.brentq
+    xtol = 2e-12
+    rtol = 4*np.finfo(np.float64).eps
+    xpre, xcur = xa, xb
+    xblk = fblk = spre = scur = 0.0
+    fpre = f(xpre, *args)
+    fcur = f(xcur, *args)
+    if fpre == 0:
+        return xpre
+    if fcur == 0:
+        return xcur
+    for _ in range(100):
+        if (fpre != 0) and (fcur != 0) and ((fpre < 0) != (fcur < 0)):
+            xblk = xpre
+            fblk = fpre
+            spre = scur = xcur - xpre
+        if abs(fblk) < abs(fcur):
+            xpre, xcur, xblk = xcur, xblk, xcur
+            fpre, fcur, fblk = fcur, fblk, fcur
+        delta = 0.5*(xtol + rtol*abs(xcur))
+        sbis = 0.5*(xblk - xcur)
+        if (fcur == 0) or (abs(sbis) < delta):
+            return xcur
+        if (abs(spre) > delta) and (abs(fcur) < abs(fpre)):
+            if xpre == xblk:
+                # Interpolate
+                stry = -fcur*(xcur - xpre)/(fcur - fpre)
+            else:
+                # Extrapolate
+                dpre = (fpre - fcur)/(xpre - xcur)
+                dblk = (fblk - fcur)/(xblk - xcur)
+                stry = -fcur*(fblk*dblk - fpre*dpre)/(dblk*dpre*(fblk - fpre))
+            if 2*abs(stry) < min(abs(spre), 3*abs(sbis) - delta):
+                spre = scur
+                scur = stry
+            else:
+                spre = scur = sbis
+        else:
+            spre = scur = sbis
+        xpre = xcur
+        fpre = fcur
+        if abs(scur) > delta:
+            xcur += scur
+        else:
+            xcur += delta if sbis > 0 else -delta
+        fcur = f(xcur, *args)
+    return xcur
+
+@jit(nopython=True, nogil=True)
+def _tzero2tperi_phase(sini, ecc, omdeg):
+    # Mean anomaly at the time of mid-transit, i.e., (tzero-tperi)*2*pi/P
+    omrad = omdeg*np.pi/180
+    sin2i = sini**2
+    theta = 0.5*np.pi-omrad
+    if (1-sin2i) > np.finfo(np.float64).eps :
+        ta = theta-0.125*np.pi
+        tb = theta
+        tc = theta+0.125*np.pi
+        fa = _delta(ta, sin2i, omrad, ecc)
+        fb = _delta(tb, sin2i, omrad, ecc)
+        fc = _delta(tc, sin2i, omrad, ecc)
+        if ((fb>fa) or (fb>fc)):
+            # Grid search for the local minimum closest to tb on a periodic
+            # grid, so minima close to theta=0 are also found
+            n_ = 1024
+            t_ = np.arange(n_)*(2*np.pi/n_)
+            d_ = _delta(t_, sin2i, omrad, ecc)
+            i_ = -1
+            for j in range(n_):
+                if (d_[j] < d_[j-1]) and (d_[j] < d_[(j+1) % n_]):
+                    if (i_ < 0) or (np.abs(t_[j]-tb) < np.abs(t_[i_]-tb)):
+                        i_ = j
+            if i_ < 0:
+                raise ValueError('tzero2tperi grid search fail')
+            ta,tb,tc = (t_[i_]-0.01, t_[i_], t_[i_]+0.01)
+        theta, _ = _brent(_delta, (sin2i, omrad, ecc), ta, tb, tc)
+    if theta == np.pi:
+        E = np.pi 
+    else:
+        E = 2*np.arctan(np.sqrt((1-ecc)/(1+ecc))*np.tan(theta/2))
+    return E - ecc*np.sin(E)
+
+@jit(nopython=True, nogil=True)
+def _tzero2tperi_array(tzero, P, sini, ecc, omdeg):
+    tperi = np.empty_like(tzero)
+    for i in range(len(tzero)):
+        M = _tzero2tperi_phase(sini[i], ecc[i], omdeg[i])
+        tperi[i] = tzero[i] - M*P[i]/(2*np.pi)
+    return tperi
+
+# Memo of _tzero2tperi_phase for scalar arguments. 
+_tzero2tperi_memo = lru_cache(maxsize=1024)(_tzero2tperi_phase)
+
 def tzero2tperi(tzero,P,sini,ecc,omdeg):
     """
     Calculate time of periastron from time of mid-transit
@@ -392,6 +977,12 @@ def tzero2tperi(tzero,P,sini,ecc,omdeg):
 
     :returns: time of periastron prior to tzero
 
+    The calculation is done with compiled code. The input values can be
+    arrays, in which case they are broadcast against each other and the
+    result is an array. For scalar input values, the result of the
+    calculation that depends only on sini, ecc and omdeg is stored in a
+    cache so that repeated calls with the same orbital shape are fast.
+
     :Example:
      >>> from pycheops.funcs import tzero2tperi
      >>> tzero = 54321.6789
@@ -403,42 +994,14 @@ def tzero2tperi(tzero,P,sini,ecc,omdeg):
      54321.6762764
 
     """
-    def _delta(th, sin2i, omrad, ecc):
-        # Equation (4.9) from Hilditch
-        return (1-ecc**2)*(
-                np.sqrt(1-sin2i*np.sin(th+omrad)**2)/(1+ecc*np.cos(th)))
-
-    omrad = omdeg*np.pi/180
-    sin2i = sini**2
-    theta = 0.5*np.pi-omrad
-    if (1-sin2i) > np.finfo(0.).eps :
-        ta = theta-0.125*np.pi
-        tb = theta
-        tc = theta+0.125*np.pi
-        fa = _delta(ta, sin2i, omrad, ecc)
-        fb = _delta(tb, sin2i, omrad, ecc)
-        fc = _delta(tc, sin2i, omrad, ecc)
-        if ((fb>fa)|(fb>fc)):
-            t_ = np.linspace(0,2*np.pi,1024)
-            d_ = _delta(t_, sin2i, omrad, ecc)
-            try:
-                i_= argrelextrema(d_, np.less)[0]
-                t_ = t_[i_]
-                if len(t_)>1:
-                    i_ = (np.abs(t_ - tb)).argmin()
-                    t_ = t_[i_]
-                ta,tb,tc = (t_-0.01, t_, t_+0.01)
-            except:
-                print(sin2i, omrad, ecc)
-                print(ta, tb, tc)
-                print(fa, fb, fc)
-                raise ValueError('tzero2tperi grid search fail')
-        theta = brent(_delta, args=(sin2i, omrad, ecc), brack=(ta, tb, tc))
-    if theta == np.pi:
-        E = np.pi 
-    else:
-        E = 2*np.arctan(np.sqrt((1-ecc)/(1+ecc))*np.tan(theta/2))
-    return tzero - (E - ecc*np.sin(E))*P/(2*np.pi)
+    if np.isscalar(sini) and np.isscalar(ecc) and np.isscalar(omdeg):
+        M = _tzero2tperi_memo(float(sini), float(ecc), float(omdeg))
+        return tzero - M*P/(2*np.pi)
+    b = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in 
+        (tzero, P, sini, ecc, omdeg)])
+    shape = b[0].shape
+    tperi = _tzero2tperi_array(*[x.ravel() for x in b])
+    return tperi.reshape(shape)
 
 #---------------
 
@@ -480,7 +1043,7 @@ def vrad(t,tzero,P,K,ecc=0,omdeg=90,sini=1, primary=True):
     """
     tp = tzero2tperi(tzero,P,sini,ecc,omdeg)
     M = 2*np.pi*(t-tp)/P
-    E = esolve(M,ecc)
+    E = kepler_solve(M,ecc)
     nu = 2*np.arctan(np.sqrt((1+ecc)/(1-ecc))*np.tan(E/2))
     omrad = np.pi*omdeg/180
     if not primary:
@@ -530,7 +1093,7 @@ def xyz_planet(t, tzero, P, sini, ecc=0, omdeg=90):
     else:
         tp = tzero2tperi(tzero,P,sini,ecc,omdeg)
         M = 2*np.pi*(t-tp)/P
-        E = esolve(M,ecc)
+        E = kepler_solve(M,ecc)
         nu = 2*np.arctan(np.sqrt((1+ecc)/(1-ecc))*np.tan(E/2))
         r = (1-ecc**2)/(1+ecc*np.cos(nu))
         omrad = np.pi*omdeg/180
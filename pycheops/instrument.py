@@ -36,7 +36,8 @@ import pickle
 from numpy import int as np_int 
 from astropy.table import Table
 from .core import load_config
-from .models import TransitModel, scaled_transit_fit, minerr_transit_fit
+from .models import TransitModel, scaled_transit_fit_batch
+from .models import minerr_transit_fit_batch
 import warnings 
 
 __all__ = [ 'response', 'visibility', 'exposure_time', 'transit_noise',
@@ -235,7 +236,10 @@ def transit_noise(time, flux, flux_err, T_0=None, width=3,
     darkening parameters h_1 and h_2. Default values for h_1 and h_2 are solar
     values.
 
-    If T_0 is not specifed that the median value of time is used.
+    If T_0 is not specifed that the median value of time is used. If T_0 is
+    an array, the noise is calculated for each value of T_0 with the
+    iterations for all values done together using the batch versions of the
+    transit fitting functions in models, and the values returned are arrays.
 
     If there are insufficient data for the calculation the function returns
     values returned are np.nan, np.nan
@@ -246,7 +250,7 @@ def transit_noise(time, flux, flux_err, T_0=None, width=3,
 
     :param flux_err: Standard error estimate(s) for flux - array of scalar
 
-    :param T_0: Centre of time window for noise estimate
+    :param T_0: Centre of time window for noise estimate - scalar or array
 
     :param width: Width of time window for noise estimate in hours
 
@@ -270,64 +274,76 @@ def transit_noise(time, flux, flux_err, T_0=None, width=3,
 
     if T_0 is None:
         T_0 = np.median(time)
+    scalar = np.ndim(T_0) == 0
+    T_0 = np.atleast_1d(np.asarray(T_0, dtype=float))
 
     # Use orbital period = 10* data duration so there is certainly 1 transit
     P = 10*(max(time)-min(time))
 
-    j = (np.abs(time-T_0) < (width/48)).nonzero()[0]
-    if len(j) < 4:
-        if method == 'scaled':
-            return np.nan, np.nan
-        else:
-            return np.nan
+    # Initial estimate of the noise for the windows with enough data
+    e_depth = np.full(len(T_0), np.nan)
+    for i, _t in enumerate(T_0):
+        j = (np.abs(time-_t) < (width/48)).nonzero()[0]
+        if len(j) >= 4:
+            e_depth[i] = np.median(flux_err[j])/np.sqrt(len(j))
 
     ITMAX = 10
     it = 1
-    e_depth = np.median(flux_err[j])/np.sqrt(len(j))
-    depth_in = 0
+    depth_in = np.zeros_like(e_depth)
+    f = np.full_like(e_depth, np.nan)
     W = width/24/P   # Transit Width in phase units
     tm = TransitModel()
     depth_tol = tol*1e-6
-    while abs(e_depth-depth_in) > depth_tol:
-        depth_in = e_depth
-        k = np.clip(np.sqrt(depth_in),1e-6,0.2)
-        pars = tm.make_params(T_0=T_0, P=P, D=depth_in, W=W, b=0,
-                h_1=h_1, h_2=h_2)
-        model = tm.eval(params=pars, t=time)
-
-        # Calculate best-fit transit depth
-        if method == 'scaled':
-            s0, _, _, _ = scaled_transit_fit(flux,flux_err,model)
-            if s0 == 0:
-                s0, _, _, _ = scaled_transit_fit(2-flux,flux_err,model)
-                s0 = -s0
-        else:
-            s0, _ = minerr_transit_fit(flux,flux_err,model)
-            if s0 == 0:
-                s0, _ = minerr_transit_fit(2-flux,flux_err,model)
-                s0 = -s0
-
-        # Subtract off best-fit transit depth and inject model transit
-        _f = flux  - (s0-1)*(model-1) 
-
-        if method == 'scaled':
-            s, f, sigma_s, sigma_f = scaled_transit_fit(_f,flux_err,model)
-        else:
-            s, sigma_s = minerr_transit_fit(_f,flux_err,model)
-
-        # If the input depth is too small then error can be 0, so ..
-        if sigma_s > 0:
-            e_depth = sigma_s*depth_in
-        else:
-            e_depth = depth_in*2
-        #print(it,s0,s, sigma_s, depth_in, e_depth)
+    if method == 'scaled':
+        fit = scaled_transit_fit_batch
+    else:
+        fit = minerr_transit_fit_batch
+    theta = np.zeros([len(T_0), 9])
+    theta[:,0] = T_0
+    theta[:,1] = P
+    theta[:,3] = W
+    theta[:,7] = h_1
+    theta[:,8] = h_2
+    # Windows still to converge, processed in blocks of up to about 4
+    # million model points
+    active = np.isfinite(e_depth)
+    nblock = max(1, 2**22//len(time))
+    while active.any():
+        for k in np.array_split(active.nonzero()[0],
+                1 + (active.sum()-1)//nblock):
+            depth_in[k] = e_depth[k]
+            theta[k,2] = depth_in[k]
+            model = tm.eval_batch(theta[k], time)
+
+            # Calculate best-fit transit depth
+            s0 = fit(flux, flux_err, model)[0]
+            z = s0 == 0
+            if z.any():
+                s0[z] = -fit(2-flux, flux_err, model[z])[0]
+
+            # Subtract off best-fit transit depth and inject model transit
+            _f = flux  - (s0[:,None]-1)*(model-1) 
+
+            if method == 'scaled':
+                s, f[k], sigma_s, sigma_f = fit(_f, flux_err, model)
+            else:
+                s, sigma_s = fit(_f, flux_err, model)
+
+            # If the input depth is too small then error can be 0, so ..
+            e_depth[k] = np.where(sigma_s > 0, sigma_s*depth_in[k],
+                    depth_in[k]*2)
+            active[k] = np.abs(e_depth[k]-depth_in[k]) > depth_tol
         it = it + 1
         if it > ITMAX:
-            warnings.warn ('Algorithm failed to converge.')
+            if active.any():
+                warnings.warn ('Algorithm failed to converge.')
             break
 
+    noise = np.where(np.isfinite(e_depth), 1e6*depth_in, np.nan)
+    if scalar:
+        noise, f = noise[0], f[0]
     if method == 'scaled':
-        return 1e6*depth_in, f
+        return noise, f
     else:
-        return 1e6*depth_in
+        return noise
 
@@ -27,21 +27,349 @@ Models and likelihood functions for use with lmfit
 from __future__ import (absolute_import, division, print_function,
                                 unicode_literals)
 import numpy as np
-from lmfit.model import Model
+from lmfit.model import Model, CompositeModel
 from lmfit.models import COMMON_INIT_DOC, COMMON_GUESS_DOC
-from numba import jit
-from .funcs import t2z, xyz_planet, vrad
+from numba import jit, prange, guvectorize
+from numba.extending import overload
+from .funcs import t2z, xyz_planet, vrad, tzero2tperi
+from .funcs import _t2z_point, _contact_window, OrbitGeometry, kepler_solve
+from .funcs import _cs2z_point, _shift_anomaly, _brent, _brentq
 from warnings import warn
-from scipy.optimize import brent, brentq
 from collections import OrderedDict
+import inspect
+import ast
 from asteval import Interpreter, get_ast_names, valid_symbol_name
+from uncertainties import UFloat
+import operator
+import hashlib
+import itertools
+import weakref
 
 __all__ = ['qpower2', 'ueclipse', 'TransitModel', 'EclipseModel', 
            'FactorModel', 'ThermalPhaseModel', 'ReflectionModel',
            'RVModel', 'RVCompanion','EBLMModel', 'PlanetModel',
-           'scaled_transit_fit', 'minerr_transit_fit']
+           'scaled_transit_fit', 'scaled_transit_fit_batch',
+           'minerr_transit_fit', 'minerr_transit_fit_batch', 'Priors',
+           'Prior']
+
+# Switches for the multi-threaded light curve algorithms. The serial version
+# is always used for arrays with fewer than PARALLEL_MIN_SIZE elements. 
+PARALLEL = False
+PARALLEL_MIN_SIZE = 4096
+FASTMATH = False
+
+# Switch for the cache of orbital phase terms used by the light curve models
+# for fits with a fixed ephemeris. GEOMETRY_CACHE_MAXBYTES is the maximum
+# total size of the cached arrays.
+GEOMETRY_CACHE = True
+GEOMETRY_CACHE_MAXBYTES = 2**28
+
+@jit(nopython=True, nogil=True, inline='always')
+def _qpower2_inside(zt,k,c,a,I_0,g):
+    # Flux for planet fully inside the stellar disc, zt <= 1-k
+    s = 1-zt**2
+    c0 = (1-c+c*s**g)
+    c2 = 0.5*a*c*s**(g-2)*((a-1)*zt**2-1)
+    return 1-I_0*np.pi*k**2*(
+            c0 + 0.25*k**2*c2 - 0.125*a*c*k**2*s**(g-1) )
+
+@jit(nopython=True, nogil=True, inline='always')
+def _qpower2_limb(zt,k,c,a,I_0,g):
+    # Flux for planet partially overlapping the stellar disc, |zt-1| < k
+    d = (zt**2 - k**2 + 1)/(2*zt)
+    ra = 0.5*(zt-k+d)
+    rb = 0.5*(1+d)
+    sa = 1-ra**2
+    sb = 1-rb**2
+    q = min(max(-1.,(zt-d)/k),1.)
+    w2 = k**2-(d-zt)**2
+    w = np.sqrt(w2)
+    b0 = 1 - c + c*sa**g
+    b1 = -a*c*ra*sa**(g-1)
+    b2 = 0.5*a*c*sa**(g-2)*((a-1)*ra**2-1)
+    a0 = b0 + b1*(zt-ra) + b2*(zt-ra)**2
+    a1 = b1+2*b2*(zt-ra)
+    aq = np.arccos(q)
+    J1 = ( (a0*(d-zt)-(2/3)*a1*w2 + 
+        0.25*b2*(d-zt)*(2*(d-zt)**2-k**2))*w
+         + (a0*k**2 + 0.25*b2*k**4)*aq )
+    J2 = a*c*sa**(g-1)*k**4*(
+        0.125*aq + (1/12)*q*(q**2-2.5)*np.sqrt(max(0.,1-q**2)) )
+    d0 = 1 - c + c*sb**g
+    d1 = -a*c*rb*sb**(g-1)
+    K1 = ((d0-rb*d1)*np.arccos(d) + 
+            ((rb*d+(2/3)*(1-d**2))*d1 - d*d0) * 
+            np.sqrt(max(0.,1-d**2)) )
+    K2 = (1/3)*c*a*sb**(g+0.5)*(1-d)
+    return 1 - I_0*(J1 - J2 + K1 - K2)
+
+@jit(nopython=True, nogil=True, inline='always')
+def _qpower2_inside_grad(zt,k,c,a,I_0,g,I_0_c,I_0_a):
+    # _qpower2_inside and its partial derivatives w.r.t. zt, k, c and a.
+    # I_0_c and I_0_a are the partial derivatives of I_0 w.r.t. c and a.
+    s = 1-zt**2
+    s_z = -2*zt
+    ls = np.log(s)
+    p0 = s**g
+    p1 = s**(g-1)
+    p2 = s**(g-2)
+    c0 = 1-c+c*p0
+    c0_z = c*g*p1*s_z
+    c0_c = p0-1
+    c0_a = 0.5*c*p0*ls
+    v = (a-1)*zt**2-1
+    c2 = 0.5*a*c*p2*v
+    c2_z = 0.5*a*c*((g-2)*p2/s*s_z*v + p2*2*(a-1)*zt)
+    c2_c = 0.5*a*p2*v
+    c2_a = 0.5*c*p2*v + 0.5*a*c*(0.5*p2*ls*v + p2*zt**2)
+    T = c0 + 0.25*k**2*c2 - 0.125*a*c*k**2*p1
+    T_z = c0_z + 0.25*k**2*c2_z - 0.125*a*c*k**2*(g-1)*p2*s_z
+    T_k = 0.5*k*c2 - 0.25*a*c*k*p1
+    T_c = c0_c + 0.25*k**2*c2_c - 0.125*a*k**2*p1
+    T_a = c0_a + 0.25*k**2*c2_a - 0.125*c*k**2*(p1 + 0.5*a*p1*ls)
+    f = 1-I_0*np.pi*k**2*T
+    f_z = -I_0*np.pi*k**2*T_z
+    f_k = -I_0*np.pi*(2*k*T + k**2*T_k)
+    f_c = -np.pi*k**2*(I_0_c*T + I_0*T_c)
+    f_a = -np.pi*k**2*(I_0_a*T + I_0*T_a)
+    return f, f_z, f_k, f_c, f_a
+
+@jit(nopython=True, nogil=True, inline='always')
+def _qpower2_limb_grad(zt,k,c,a,I_0,g,I_0_c,I_0_a):
+    # _qpower2_limb and its partial derivatives w.r.t. zt, k, c and a. 
+    # Derivatives are calculated in forward mode - the derivative of each
+    # quantity w.r.t. x is denoted by the suffix _x. Only non-zero
+    # derivatives are calculated, e.g., geometrical quantities do not
+    # depend on c or a.
+    d = (zt**2 - k**2 + 1)/(2*zt)
+    d_z = (zt**2 + k**2 - 1)/(2*zt**2)
+    d_k = -k/zt
+    ra = 0.5*(zt-k+d)
+    ra_z = 0.5*(1+d_z)
+    ra_k = 0.5*(d_k-1)
+    rb = 0.5*(1+d)
+    rb_z = 0.5*d_z
+    rb_k = 0.5*d_k
+    sa = 1-ra**2
+    sa_z = -2*ra*ra_z
+    sa_k = -2*ra*ra_k
+    sb = 1-rb**2
+    sb_z = -2*rb*rb_z
+    sb_k = -2*rb*rb_k
+    q = (zt-d)/k
+    if np.abs(q) < 1:
+        q_z = (1-d_z)/k
+        q_k = (-d_k-q)/k
+    else:
+        q = min(max(-1.,q),1.)
+        q_z = 0.
+        q_k = 0.
+    h = d-zt
+    h_z = d_z-1
+    h_k = d_k
+    w2 = k**2-h**2
+    w2_z = -2*h*h_z
+    w2_k = 2*k - 2*h*h_k
+    w = np.sqrt(w2)
+    if w > 0:
+        w_z = 0.5*w2_z/w
+        w_k = 0.5*w2_k/w
+    else:
+        w_z = 0.
+        w_k = 0.
+    r1 = np.sqrt(max(0.,1-q**2))
+    aq = np.arccos(q)
+    if r1 > 0:
+        aq_z = -q_z/r1
+        aq_k = -q_k/r1
+    else:
+        aq_z = 0.
+        aq_k = 0.
+    lsa = np.log(sa)
+    pa0 = sa**g
+    pa1 = sa**(g-1)
+    pa2 = sa**(g-2)
+    pa0_z, pa0_k, pa0_a = g*pa1*sa_z, g*pa1*sa_k, 0.5*pa0*lsa
+    pa1_z, pa1_k, pa1_a = (g-1)*pa2*sa_z, (g-1)*pa2*sa_k, 0.5*pa1*lsa
+    pa2_z, pa2_k, pa2_a = ((g-2)*pa2/sa*sa_z, (g-2)*pa2/sa*sa_k,
+            0.5*pa2*lsa)
+    lsb = np.log(sb)
+    pb0 = sb**g
+    pb1 = sb**(g-1)
+    pb3 = sb**(g+0.5)
+    pb0_z, pb0_k, pb0_a = g*pb1*sb_z, g*pb1*sb_k, 0.5*pb0*lsb
+    pb1_z, pb1_k, pb1_a = ((g-1)*pb1/sb*sb_z, (g-1)*pb1/sb*sb_k, 
+            0.5*pb1*lsb)
+    pb3_z, pb3_k, pb3_a = ((g+0.5)*pb3/sb*sb_z, (g+0.5)*pb3/sb*sb_k,
+            0.5*pb3*lsb)
+    # b0, b1, b2
+    b0 = 1 - c + c*pa0
+    b0_z, b0_k, b0_c, b0_a = c*pa0_z, c*pa0_k, pa0-1, c*pa0_a
+    b1 = -a*c*ra*pa1
+    b1_z = -a*c*(ra_z*pa1 + ra*pa1_z)
+    b1_k = -a*c*(ra_k*pa1 + ra*pa1_k)
+    b1_c = -a*ra*pa1
+    b1_a = -c*ra*pa1 - a*c*ra*pa1_a
+    V = (a-1)*ra**2-1
+    V_z = 2*(a-1)*ra*ra_z
+    V_k = 2*(a-1)*ra*ra_k
+    b2 = 0.5*a*c*pa2*V
+    b2_z = 0.5*a*c*(pa2_z*V + pa2*V_z)
+    b2_k = 0.5*a*c*(pa2_k*V + pa2*V_k)
+    b2_c = 0.5*a*pa2*V
+    b2_a = 0.5*c*pa2*V + 0.5*a*c*(pa2_a*V + pa2*ra**2)
+    # a0, a1
+    e = zt-ra
+    e_z = 1-ra_z
+    e_k = -ra_k
+    a0 = b0 + b1*e + b2*e**2
+    a0_z = b0_z + b1_z*e + b1*e_z + b2_z*e**2 + 2*b2*e*e_z
+    a0_k = b0_k + b1_k*e + b1*e_k + b2_k*e**2 + 2*b2*e*e_k
+    a0_c = b0_c + b1_c*e + b2_c*e**2
+    a0_a = b0_a + b1_a*e + b2_a*e**2
+    a1 = b1 + 2*b2*e
+    a1_z = b1_z + 2*b2_z*e + 2*b2*e_z
+    a1_k = b1_k + 2*b2_k*e + 2*b2*e_k
+    a1_c = b1_c + 2*b2_c*e
+    a1_a = b1_a + 2*b2_a*e
+    # J1 = A*w + B*aq
+    u = 2*h**2-k**2
+    A = a0*h - (2/3)*a1*w2 + 0.25*b2*h*u
+    A_z = (a0_z*h + a0*h_z - (2/3)*(a1_z*w2 + a1*w2_z) + 
+            0.25*(b2_z*h*u + b2*h_z*u + b2*h*4*h*h_z))
+    A_k = (a0_k*h + a0*h_k - (2/3)*(a1_k*w2 + a1*w2_k) + 
+            0.25*(b2_k*h*u + b2*h_k*u + b2*h*(4*h*h_k - 2*k)))
+    A_c = a0_c*h - (2/3)*a1_c*w2 + 0.25*b2_c*h*u
+    A_a = a0_a*h - (2/3)*a1_a*w2 + 0.25*b2_a*h*u
+    B = a0*k**2 + 0.25*b2*k**4
+    B_z = a0_z*k**2 + 0.25*b2_z*k**4
+    B_k = a0_k*k**2 + 0.25*b2_k*k**4 + 2*k*a0 + b2*k**3
+    B_c = a0_c*k**2 + 0.25*b2_c*k**4
+    B_a = a0_a*k**2 + 0.25*b2_a*k**4
+    J1 = A*w + B*aq
+    J1_z = A_z*w + A*w_z + B_z*aq + B*aq_z
+    J1_k = A_k*w + A*w_k + B_k*aq + B*aq_k
+    J1_c = A_c*w + B_c*aq
+    J1_a = A_a*w + B_a*aq
+    # J2 = a*c*k**4*pa1*Q; dQ/dq = -(1-q**2)**1.5/3
+    Q = 0.125*aq + (1/12)*q*(q**2-2.5)*r1
+    Q_z = -q_z*r1**3/3
+    Q_k = -q_k*r1**3/3
+    J2 = a*c*pa1*k**4*Q
+    J2_z = a*c*k**4*(pa1_z*Q + pa1*Q_z)
+    J2_k = a*c*(k**4*(pa1_k*Q + pa1*Q_k) + 4*k**3*pa1*Q)
+    J2_c = a*pa1*k**4*Q
+    J2_a = c*pa1*k**4*Q + a*c*pa1_a*k**4*Q
+    # K1 = G*ad + H*r2
+    d0 = 1 - c + c*pb0
+    d0_z, d0_k, d0_c, d0_a = c*pb0_z, c*pb0_k, pb0-1, c*pb0_a
+    d1 = -a*c*rb*pb1
+    d1_z = -a*c*(rb_z*pb1 + rb*pb1_z)
+    d1_k = -a*c*(rb_k*pb1 + rb*pb1_k)
+    d1_c = -a*rb*pb1
+    d1_a = -c*rb*pb1 - a*c*rb*pb1_a
+    ad = np.arccos(d)
+    r2 = np.sqrt(max(0.,1-d**2))
+    if r2 > 0:
+        ad_z = -d_z/r2
+        ad_k = -d_k/r2
+        r2_z = -d*d_z/r2
+        r2_k = -d*d_k/r2
+    else:
+        ad_z, ad_k, r2_z, r2_k = 0., 0., 0., 0.
+    G = d0 - rb*d1
+    G_z = d0_z - rb_z*d1 - rb*d1_z
+    G_k = d0_k - rb_k*d1 - rb*d1_k
+    G_c = d0_c - rb*d1_c
+    G_a = d0_a - rb*d1_a
+    Y = rb*d + (2/3)*(1-d**2)
+    Y_z = rb_z*d + rb*d_z - (4/3)*d*d_z
+    Y_k = rb_k*d + rb*d_k - (4/3)*d*d_k
+    H = Y*d1 - d*d0
+    H_z = Y_z*d1 + Y*d1_z - d_z*d0 - d*d0_z
+    H_k = Y_k*d1 + Y*d1_k - d_k*d0 - d*d0_k
+    H_c = Y*d1_c - d*d0_c
+    H_a = Y*d1_a - d*d0_a
+    K1 = G*ad + H*r2
+    K1_z = G_z*ad + G*ad_z + H_z*r2 + H*r2_z
+    K1_k = G_k*ad + G*ad_k + H_k*r2 + H*r2_k
+    K1_c = G_c*ad + H_c*r2
+    K1_a = G_a*ad + H_a*r2
+    # K2
+    K2 = (1/3)*c*a*pb3*(1-d)
+    K2_z = (1/3)*c*a*(pb3_z*(1-d) - pb3*d_z)
+    K2_k = (1/3)*c*a*(pb3_k*(1-d) - pb3*d_k)
+    K2_c = (1/3)*a*pb3*(1-d)
+    K2_a = (1/3)*c*pb3*(1-d) + (1/3)*c*a*pb3_a*(1-d)
+    S = J1 - J2 + K1 - K2
+    f = 1 - I_0*S
+    f_z = -I_0*(J1_z - J2_z + K1_z - K2_z)
+    f_k = -I_0*(J1_k - J2_k + K1_k - K2_k)
+    f_c = -I_0_c*S - I_0*(J1_c - J2_c + K1_c - K2_c)
+    f_a = -I_0_a*S - I_0*(J1_a - J2_a + K1_a - K2_a)
+    return f, f_z, f_k, f_c, f_a
+
+@jit(nopython=True, nogil=True)
+def _qpower2_grad(z,k,c,a):
+    # qpower2 and its partial derivatives w.r.t. z, k, c and a
+    f = np.ones_like(z)
+    f_z = np.zeros_like(z)
+    f_k = np.zeros_like(z)
+    f_c = np.zeros_like(z)
+    f_a = np.zeros_like(z)
+    I_0 = (a+2)/(np.pi*(a-c*a+2))
+    I_0_c = a*(a+2)/(np.pi*(a-c*a+2)**2)
+    I_0_a = 2*c/(np.pi*(a-c*a+2)**2)
+    g = 0.5*a
+    for i,zi in enumerate(z):
+        zt = np.abs(zi)
+        if zt <= (1-k):
+            r = _qpower2_inside_grad(zt,k,c,a,I_0,g,I_0_c,I_0_a)
+        elif np.abs(zt-1) < k:
+            r = _qpower2_limb_grad(zt,k,c,a,I_0,g,I_0_c,I_0_a)
+        else:
+            continue
+        f[i], f_z[i], f_k[i], f_c[i], f_a[i] = r
+        if zi < 0:
+            f_z[i] = -f_z[i]
+    return f, f_z, f_k, f_c, f_a
+
+@jit(nopython=True, nogil=True)
+def _qpower2_serial(z,k,c,a):
+    f = np.ones_like(z)
+    I_0 = (a+2)/(np.pi*(a-c*a+2))
+    g = 0.5*a
+    for i,zi in enumerate(z):
+        # Double-precision arithmetic for single-precision input
+        zt = np.abs(np.float64(zi))
+        if zt <= (1-k):
+            f[i] = _qpower2_inside(zt,k,c,a,I_0,g)
+        elif np.abs(zt-1) < k:
+            f[i] = _qpower2_limb(zt,k,c,a,I_0,g)
+    return f
+
+def _qpower2_parallel_func(z,k,c,a):
+    f = np.ones_like(z)
+    I_0 = (a+2)/(np.pi*(a-c*a+2))
+    g = 0.5*a
+    # Classify the points before doing any arithmetic so that each of the
+    # loops below is free of branches on the position of the planet.
+    zt = np.abs(z)
+    j_in = np.nonzero(zt <= (1-k))[0]
+    j_limb = np.nonzero((zt > (1-k)) & (np.abs(zt-1) < k))[0]
+    for j in prange(len(j_in)):
+        i = j_in[j]
+        f[i] = _qpower2_inside(np.float64(zt[i]),k,c,a,I_0,g)
+    for j in prange(len(j_limb)):
+        i = j_limb[j]
+        f[i] = _qpower2_limb(np.float64(zt[i]),k,c,a,I_0,g)
+    return f
+
+_qpower2_parallel = jit(nopython=True, nogil=True, parallel=True)(
+        _qpower2_parallel_func)
+_qpower2_parallel_fastmath = jit(nopython=True, nogil=True, parallel=True,
+        fastmath=True)(_qpower2_parallel_func)
 
-@jit(nopython=True)
 def qpower2(z,k,c,a):
     r"""
     Fast and accurate transit light curves for the power-2 limb-darkening law
@@ -65,6 +393,23 @@ def qpower2(z,k,c,a):
 
     :returns: light curve (observed flux)  
 
+    For long light curves a multi-threaded version of the algorithm can be
+    selected by setting the module-level switch PARALLEL = True. This version
+    sorts the points into those out of transit, those with the planet fully
+    inside the stellar disc and those at ingress/egress, and then runs a
+    branch-free loop over each class of point. Arrays with fewer than
+    PARALLEL_MIN_SIZE points always use the serial version. If FASTMATH = True
+    the multi-threaded version is compiled with the fastmath option, which
+    gives results that may differ from the serial version at the level of
+    1e-14.
+
+    If z is a single-precision (float32) array, the result is also float32.
+    The calculation is done in double precision so the error relative to
+    the float64 result for the same values of z is less than 6e-8.
+
+    qpower2 can also be called from functions compiled with numba in nopython
+    mode, in which case the serial version is always used.
+
     :Example:
 
     >>> from pycheops.models import qpower2
@@ -87,45 +432,17 @@ def qpower2(z,k,c,a):
     >>> plt.show()
 
     """
-    f = np.ones_like(z)
-    I_0 = (a+2)/(np.pi*(a-c*a+2))
-    g = 0.5*a
-    for i,zi in enumerate(z):
-        zt = np.abs(zi)
-        if zt <= (1-k):
-            s = 1-zt**2
-            c0 = (1-c+c*s**g)
-            c2 = 0.5*a*c*s**(g-2)*((a-1)*zt**2-1)
-            f[i] = 1-I_0*np.pi*k**2*(
-                    c0 + 0.25*k**2*c2 - 0.125*a*c*k**2*s**(g-1) )
-        elif np.abs(zt-1) < k:
-            d = (zt**2 - k**2 + 1)/(2*zt)
-            ra = 0.5*(zt-k+d)
-            rb = 0.5*(1+d)
-            sa = 1-ra**2
-            sb = 1-rb**2
-            q = min(max(-1.,(zt-d)/k),1.)
-            w2 = k**2-(d-zt)**2
-            w = np.sqrt(w2)
-            b0 = 1 - c + c*sa**g
-            b1 = -a*c*ra*sa**(g-1)
-            b2 = 0.5*a*c*sa**(g-2)*((a-1)*ra**2-1)
-            a0 = b0 + b1*(zt-ra) + b2*(zt-ra)**2
-            a1 = b1+2*b2*(zt-ra)
-            aq = np.arccos(q)
-            J1 = ( (a0*(d-zt)-(2/3)*a1*w2 + 
-                0.25*b2*(d-zt)*(2*(d-zt)**2-k**2))*w
-                 + (a0*k**2 + 0.25*b2*k**4)*aq )
-            J2 = a*c*sa**(g-1)*k**4*(
-                0.125*aq + (1/12)*q*(q**2-2.5)*np.sqrt(max(0.,1-q**2)) )
-            d0 = 1 - c + c*sb**g
-            d1 = -a*c*rb*sb**(g-1)
-            K1 = ((d0-rb*d1)*np.arccos(d) + 
-                    ((rb*d+(2/3)*(1-d**2))*d1 - d*d0) * 
-                    np.sqrt(max(0.,1-d**2)) )
-            K2 = (1/3)*c*a*sb**(g+0.5)*(1-d)
-            f[i] = 1 - I_0*(J1 - J2 + K1 - K2)
-    return f
+    z = np.asarray(z)
+    if PARALLEL and (z.size >= PARALLEL_MIN_SIZE):
+        if FASTMATH:
+            return _qpower2_parallel_fastmath(z,k,c,a)
+        return _qpower2_parallel(z,k,c,a)
+    return _qpower2_serial(z,k,c,a)
+
+@overload(qpower2)
+def _qpower2_overload(z,k,c,a):
+    # qpower2 called from compiled code uses the serial version
+    return lambda z,k,c,a: _qpower2_serial(z,k,c,a)
 
 @jit(nopython=True)
 def scaled_transit_fit(flux, sigma, model):
@@ -166,118 +483,1236 @@ def scaled_transit_fit(flux, sigma, model):
         return np.nan, np.nan, np.nan, np.nan
     return s, b, sigma_s, sigma_b
 
-
-def minerr_transit_fit(flux, sigma, model):
+def _scaled_transit_fit_func(flux, sigma, model, s, b, sigma_s, sigma_b):
+    # Same calculation as scaled_transit_fit for a single model without
+    # temporary arrays. The outputs are arrays of length 1. 
+    s[0], b[0], sigma_s[0], sigma_b[0] = np.nan, np.nan, np.nan, np.nan
+    N = len(flux)
+    if N < 3:
+        return
+    _m = 0.0
+    _y = 0.0
+    for i in range(N):
+        w = 1/sigma[i]**2
+        _m += w*(model[i]-1)**2
+        _y += w*(model[i]-1)*(flux[i]-1)
+    if _m == 0:
+        return
+    _s = _y/_m
+    chisq = 0.0
+    for i in range(N):
+        chisq += ((flux[i]-1) - _s*(model[i]-1))**2/sigma[i]**2
+    _b = np.sqrt(chisq/N)
+    _t = 3*chisq/_b**4 - N/_b**2 
+    if _t > 0:
+        s[0] = _s
+        b[0] = _b
+        sigma_s[0] = _b/np.sqrt(_m)
+        sigma_b[0] = 1/np.sqrt(_t)
+
+# The generalized ufuncs are compiled when they are first used
+_gufuncs = {}
+
+def _gufunc(func, nout, size):
+    # Serial or parallel gufunc with nout scalar outputs from func(x,y,z,...)
+    # for 1-d float64 arrays x, y and z
+    target = 'parallel' if PARALLEL and (size >= PARALLEL_MIN_SIZE) else 'cpu'
+    key = (func, target)
+    if key not in _gufuncs:
+        sig = 'void(' + ', '.join(['float64[:]']*(3+nout)) + ')'
+        layout = '(n),(n),(n)->' + ','.join(['()']*nout)
+        _gufuncs[key] = guvectorize([sig], layout, nopython=True,
+                target=target)(func)
+    return _gufuncs[key]
+
+def scaled_transit_fit_batch(flux, sigma, model):
     r"""
-    Optimum scaled transit depth for data with lower bounds on errors
+    Optimum scaled transit depths for many model templates in one call
 
-    Find the value of the scaling factor s that provides the best fit of the
-    model m = 1 + s*(model-1) to the normalised input fluxes. It is assumed
-    that the nominal standard error(s) provided in sigma are lower bounds to
-    the true standard errors on the flux measurements. [1]_ The probability
-    distribution for the true standard errors is assumed to be
+    Equivalent to calling scaled_transit_fit() for each row of model. The
+    fits are done by a compiled generalized ufunc, so flux, sigma and model
+    are broadcast against each other in the usual way apart from the last
+    axis, which is the time axis, e.g., flux can also be an array with the
+    same shape as model to fit different data for every model template.
 
-    .. math::
-        P(\sigma_{\rm true} | \sigma) = \sigma/\sigma_{\rm true}^2 
+    The templates are processed in parallel if the module-level switch
+    PARALLEL is True and model has at least PARALLEL_MIN_SIZE elements.
 
-    :param flux: Array of normalised flux measurements
+     :param flux: Array of normalised flux measurements
 
-    :param sigma: Lower bound(s) on standard error for flux - array or scalar
+     :param sigma: Standard error estimate(s) for flux - array or scalar
 
-    :param model: Transit model to be scaled
+     :param model: Transit models to be scaled, shape (ntemplates, ntime)
 
-    :returns: s, sigma_s
+     :returns: s, b, sigma_s, sigma_b - arrays of length ntemplates
 
-.. rubric References
-.. [1] Sivia, D.S. & Skilling, J., Data Analysis - A Bayesian Tutorial, 2nd
-   ed., section 8.3.1
+    :Example:
+
+    >>> from pycheops.models import TransitModel, scaled_transit_fit_batch
+    >>> tm = TransitModel()
+    >>> theta = [[0, 10, D, 0.01, 0, 0, 0, 0.72, 0.67] for D in (1e-4, 1e-3)]
+    >>> model = tm.eval_batch(theta, t)
+    >>> s, b, sigma_s, sigma_b = scaled_transit_fit_batch(flux, 1e-4, model)
 
     """
+    model = np.asarray(model, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    n = model.shape[-1]
+    sigma = np.asarray(sigma, dtype=float)
+    if sigma.ndim == 0:
+        sigma = np.full(n, sigma)
+    return _gufunc(_scaled_transit_fit_func, 4, model.size)(flux, sigma, model)
+
+
+@jit(nopython=True, nogil=True)
+def _minerr_negloglike(s, flux, sigma, model):
+    # Negative log-likelihood for minerr_transit_fit. The likelihood terms
+    # are accumulated as a product so that the logarithm is only needed when
+    # the product approaches the underflow limit.
+    x = 0.0
+    p = 1.0
+    eps = np.finfo(np.float64).eps
+    for i in range(len(flux)):
+        Rsq = ((1 + s*(model[i]-1) - flux[i])/sigma[i])**2
+        # In the limit Rsq -> 0, likelihood -> 0.5
+        if Rsq > eps:
+            p *= (1-np.exp(-0.5*Rsq))/Rsq
+        else:
+            p *= 0.5
+        if p < 1e-250:
+            x += np.log(p)
+            p = 1.0
+    return -(x + np.log(p))
+
+@jit(nopython=True, nogil=True)
+def _minerr_offset(s, flux, sigma, model, loglike_0):
+    # Zero at the values of s where the log-likelihood is loglike_0
+    return loglike_0 + _minerr_negloglike(s, flux, sigma, model)
+
+@jit(nopython=True, nogil=True)
+def _minerr_transit_fit(flux, sigma, model):
     N = len(flux)
     if N < 3:
         return np.nan, np.nan
-
-    def _negloglike(s, flux, sigma, model):
-        model =  1 + s*(model-1)
-        Rsq = ((model-flux)/sigma)**2
-        # In the limit Rsq -> 0, log-likelihood -> log(0.5)
-        x = np.full_like(Rsq,np.log(0.5))
-        _j = Rsq > np.finfo(0.0).eps
-        x[_j] = np.log((1-np.exp(-0.5*Rsq[_j]))/Rsq[_j])
-        return -np.sum(x)
-
-    def _loglikediff(s, loglike_0, flux, sigma, model):
-        return loglike_0 + _negloglike(s, flux, sigma, model)
-
     if np.min(model) == 1:
-        return 0,0
-    # Bracket the minimum of _negloglike
-    s_min = 0
-    fa = _negloglike(s_min, flux, sigma, model)
-    s_mid = 1
-    fb = _negloglike(s_mid, flux, sigma, model)
-    #print('s_min, fa, s_mid, fb',s_min, fa, s_mid, fb)
+        return 0.0, 0.0
+    # Bracket the minimum of _minerr_negloglike
+    s_min = 0.0
+    fa = _minerr_negloglike(s_min, flux, sigma, model)
+    s_mid = 1.0
+    fb = _minerr_negloglike(s_mid, flux, sigma, model)
     if fb < fa:
-        s_max = 2
-        fc = _negloglike(s_max, flux, sigma, model)
+        s_max = 2.0
+        fc = _minerr_negloglike(s_max, flux, sigma, model)
         while fc < fb:
             s_max = 2*s_max
-            fc = _negloglike(s_max, flux, sigma, model)
+            fc = _minerr_negloglike(s_max, flux, sigma, model)
     else:
         s_max = s_mid
         fc = fb
         s_mid = 0.5
-        fb = _negloglike(s_mid, flux, sigma, model)
+        fb = _minerr_negloglike(s_mid, flux, sigma, model)
         while fb > fa:
             if s_mid < 2**-16:
-                return 0,0
+                return 0.0, 0.0
             s_mid = 0.5*s_mid
-            fb = _negloglike(s_mid, flux, sigma, model)
+            fb = _minerr_negloglike(s_mid, flux, sigma, model)
 
-    #print('s_min, fa, s_mid, fb, s_max, fc',s_min, fa, s_mid, fb, s_max, fc)
-    s_opt, _f, _, _ = brent(_negloglike, args=(flux, sigma, model),
-                       brack=(s_min,s_mid,s_max), full_output=True)
+    args = (flux, sigma, model)
+    s_opt, _f = _brent(_minerr_negloglike, args, s_min, s_mid, s_max)
     loglike_0 = -_f -0.5
     s_hi = s_max
-    f_hi = _loglikediff(s_hi, loglike_0, flux, sigma, model)
+    f_hi = loglike_0 + _minerr_negloglike(s_hi, flux, sigma, model)
     while f_hi < 0:
         s_hi = 2*s_hi
-        f_hi = _loglikediff(s_hi, loglike_0, flux, sigma, model)
-    s_hi = brentq(_loglikediff, s_opt, s_hi,
-                 args = (loglike_0, flux, sigma, model))
+        f_hi = loglike_0 + _minerr_negloglike(s_hi, flux, sigma, model)
+    s_hi = _brentq(_minerr_offset, args+(loglike_0,), s_opt, s_hi)
     s_err = s_hi - s_opt
-    #print('s_opt,  s_err',s_opt, s_err)
     return s_opt, s_err
 
-@jit(nopython=True)
-def ueclipse(z,k):
+def minerr_transit_fit(flux, sigma, model):
+    r"""
+    Optimum scaled transit depth for data with lower bounds on errors
+
+    Find the value of the scaling factor s that provides the best fit of the
+    model m = 1 + s*(model-1) to the normalised input fluxes. It is assumed
+    that the nominal standard error(s) provided in sigma are lower bounds to
+    the true standard errors on the flux measurements. [1]_ The probability
+    distribution for the true standard errors is assumed to be
+
+    .. math::
+        P(\sigma_{\rm true} | \sigma) = \sigma/\sigma_{\rm true}^2 
+
+    :param flux: Array of normalised flux measurements
+
+    :param sigma: Lower bound(s) on standard error for flux - array or scalar
+
+    :param model: Transit model to be scaled
+
+    :returns: s, sigma_s
+
+.. rubric References
+.. [1] Sivia, D.S. & Skilling, J., Data Analysis - A Bayesian Tutorial, 2nd
+   ed., section 8.3.1
+
+    """
+    flux = np.asarray(flux, dtype=float)
+    sigma = np.asarray(sigma, dtype=float)
+    if sigma.ndim == 0:
+        sigma = np.full(len(flux), sigma)
+    return _minerr_transit_fit(flux, sigma, np.asarray(model, dtype=float))
+
+def _minerr_transit_fit_func(flux, sigma, model, s, sigma_s):
+    s[0], sigma_s[0] = _minerr_transit_fit(flux, sigma, model)
+
+
+def minerr_transit_fit_batch(flux, sigma, model):
+    r"""
+    Optimum scaled transit depths for data with lower bounds on errors for
+    many model templates in one call
+
+    Equivalent to calling minerr_transit_fit() for each row of model. The
+    arguments are broadcast against each other apart from the last axis, as
+    for scaled_transit_fit_batch(). The templates are processed in parallel
+    if the module-level switch PARALLEL is True and model has at least
+    PARALLEL_MIN_SIZE elements.
+
+    :param flux: Array of normalised flux measurements
+
+    :param sigma: Lower bound(s) on standard error for flux - array or scalar
+
+    :param model: Transit models to be scaled, shape (ntemplates, ntime)
+
+    :returns: s, sigma_s - arrays of length ntemplates
+
+    """
+    model = np.asarray(model, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    n = model.shape[-1]
+    sigma = np.asarray(sigma, dtype=float)
+    if sigma.ndim == 0:
+        sigma = np.full(n, sigma)
+    return _gufunc(_minerr_transit_fit_func, 2, model.size)(flux, sigma, model)
+
+# Serial and multi-threaded versions of the light curve kernels, indexed by
+# name. Each kernel is a function that loops over the points with prange.
+_KERNELS = {}
+
+def _kernels(func):
+    return (jit(nopython=True, nogil=True)(func),
+            jit(nopython=True, nogil=True, parallel=True)(func))
+
+def _kernel(name, parallel):
+    return _KERNELS[name][bool(parallel)]
+
+@jit(nopython=True, nogil=True, inline='always')
+def _ueclipse_point(zt,k):
+    # Flux from a uniform disc of radius k eclipsed by the star at separation
+    # zt >= 0
+    if zt <= (1-k):
+        return 0.0
+    if np.abs(zt-1) < k:
+        t1 = np.arccos(min(max(-1,(zt**2+k**2-1)/(2*zt*k)),1))
+        t2 = np.arccos(min(max(-1,(zt**2+1-k**2)/(2*zt)),1))
+        t3 = 0.5*np.sqrt(max(0,(1+k-zt)*(zt+k-1)*(zt-k+1)*(zt+k+1)))
+        return 1 - (k**2*t1 + t2 - t3)/(np.pi*k**2)
+    return 1.0
+
+def _ueclipse_func(z,k,out):
+    for i in prange(len(z)):
+        out[i] = _ueclipse_point(np.abs(np.float64(z[i])),k)
+    return out
+
+_KERNELS['ueclipse'] = _kernels(_ueclipse_func)
+
+def ueclipse(z,k,out=None):
     r"""
     Eclipse light curve for a planet with uniform surface brightness by a star
 
     :param z: star-planet separation on the sky cf. star radius (array)
     :param k: planet-star radius ratio (scalar, k<1) 
+    :param out: optional C-contiguous array with the same shape as z and the
+      same dtype as the result for the result. This can be z itself.
 
     :returns: light curve (observed flux from eclipsed source)  
+
+    The calculation is multi-threaded for arrays with at least
+    PARALLEL_MIN_SIZE points if the module-level switch PARALLEL = True.
+    Single-precision (float32) input gives float32 output with an error less
+    than 6e-8 relative to the float64 result.
+
     """
     if (k > 1):
         raise ValueError("ueclipse requires k < 1")
+    z = np.asarray(z)
+    if z.dtype != np.float32:
+        z = z.astype(float, copy=False)
+    if out is None:
+        out = np.empty_like(z)
+    elif out.shape != z.shape:
+        raise ValueError("out must have the same shape as z")
+    elif out.dtype != z.dtype:
+        raise ValueError("out must have dtype {}".format(z.dtype))
+    elif not out.flags.c_contiguous:
+        raise ValueError("out must be C-contiguous")
+    func = _kernel('ueclipse', PARALLEL and (z.size >= PARALLEL_MIN_SIZE))
+    func(z.reshape(-1),k,out.reshape(-1))
+    return out
 
-    fl = np.ones_like(z)
-    for i,zi in enumerate(z):
-        zt = np.abs(zi)
-        if zt <= (1-k):
-            fl[i] = 0
+
+#----------------------
+
+@jit(nopython=True, nogil=True, inline='always')
+def _transit_point(t, T_0, tperi, P, sini, r_star, ecc, sinom, cosom,
+        k, c, a, I_0, g):
+    # Flux at time t from the star-planet separation and qpower2 combined
+    z, m = _t2z_point(t, T_0, tperi, P, sini, r_star, ecc, sinom, cosom)
+    # Planet is behind the star
+    if m: return 1.0
+    zt = np.abs(z)
+    if zt <= (1-k):
+        return _qpower2_inside(zt,k,c,a,I_0,g)
+    if np.abs(zt-1) < k:
+        return _qpower2_limb(zt,k,c,a,I_0,g)
+    return 1.0
+
+@jit(nopython=True, nogil=True, inline='always')
+def _transit_point_int(t, T_0, tperi, P, sini, r_star, ecc, sinom, cosom,
+        k, c, a, I_0, g, texp, nsub, dz):
+    # As _transit_point, but points during ingress or egress, or with z
+    # within dz of a contact point, are integrated over an exposure time texp
+    # using nsub sub-samples
+    z, m = _t2z_point(t, T_0, tperi, P, sini, r_star, ecc, sinom, cosom)
+    if m: return 1.0
+    zt = np.abs(z)
+    if np.abs(zt-1) < k+dz:
+        f = 0.0
+        for i in range(nsub):
+            ti = t + ((i+0.5)/nsub - 0.5)*texp
+            f += _transit_point(ti, T_0, tperi, P, sini, r_star, ecc,
+                    sinom, cosom, k, c, a, I_0, g)
+        return f/nsub
+    if zt <= (1-k):
+        if dz < 0:
+            return _qpower2_inside(zt,k,c,a,I_0,g)
+        # Simpson's rule is used between the contact points unless the
+        # curvature of the light curve is large, e.g. close to the limb
+        f_0 = _qpower2_inside(zt,k,c,a,I_0,g)
+        f_1 = _transit_point(t-0.5*texp, T_0, tperi, P, sini, r_star, ecc,
+                    sinom, cosom, k, c, a, I_0, g)
+        f_2 = _transit_point(t+0.5*texp, T_0, tperi, P, sini, r_star, ecc,
+                    sinom, cosom, k, c, a, I_0, g)
+        if np.abs(f_1 - 2*f_0 + f_2) < 1e-4:
+            return (f_1 + 4*f_0 + f_2)/6
+        f = 0.0
+        for i in range(nsub):
+            ti = t + ((i+0.5)/nsub - 0.5)*texp
+            f += _transit_point(ti, T_0, tperi, P, sini, r_star, ecc,
+                    sinom, cosom, k, c, a, I_0, g)
+        return f/nsub
+    if np.abs(zt-1) < k:
+        return _qpower2_limb(zt,k,c,a,I_0,g)
+    return 1.0
+
+def _exposure_dz(P, r_star, ecc, texp, nsub):
+    # Upper limit to the change in z during half an exposure using the
+    # orbital speed at periastron. Returns -1 if there is no integration.
+    if (texp <= 0) or (nsub <= 1):
+        return -1.0
+    return np.pi*texp*np.sqrt((1+ecc)/(1-ecc))/(P*r_star)
+
+def _transit_flux_func(t, f, T_0, tperi, P, sini, r_star, ecc, omrad, k, c, a,
+        texp, nsub, dz):
+    # Transit light curve with no intermediate arrays, written to f
+    I_0 = (a+2)/(np.pi*(a-c*a+2))
+    g = 0.5*a
+    sinom = np.sin(omrad)
+    cosom = np.cos(omrad)
+    # Points outside this window are out of transit 
+    ph_c, dph = _contact_window(ecc, sinom, cosom, r_star, k)
+    dph += 0.5*texp/P
+    for j in prange(len(t)):
+        ph = (t[j]-tperi)/P - ph_c
+        if np.abs(ph - np.floor(ph+0.5)) > dph:
+            f[j] = 1.0
+        else:
+            f[j] = _transit_point_int(t[j], T_0, tperi, P, sini, r_star, ecc,
+                    sinom, cosom, k, c, a, I_0, g, texp, nsub, dz)
+    return f
+
+_KERNELS['transit_flux'] = _kernels(_transit_flux_func)
+
+def _transit_index_func(t, f, lo, hi, T_0, tperi, P, sini, r_star, ecc, omrad,
+        k, c, a, texp, nsub, dz):
+    # As _transit_flux_func, but only for the points t[lo[i]:hi[i]]. Other
+    # values of f are not changed.
+    I_0 = (a+2)/(np.pi*(a-c*a+2))
+    g = 0.5*a
+    sinom = np.sin(omrad)
+    cosom = np.cos(omrad)
+    for i in range(len(lo)):
+        for j in prange(lo[i], hi[i]):
+            f[j] = _transit_point_int(t[j], T_0, tperi, P, sini, r_star, ecc,
+                    sinom, cosom, k, c, a, I_0, g, texp, nsub, dz)
+    return f
+
+_KERNELS['transit_index'] = _kernels(_transit_index_func)
+
+def _transit_phase_func(cosE, sinE, f, lo, hi, dM, sini, r_star, ecc,
+        sinom, cosom, k, c, a):
+    # As _transit_index_func, but using the values of cos(E) and sin(E) from
+    # _orbit_phase() instead of solving Kepler's equation for each point
+    I_0 = (a+2)/(np.pi*(a-c*a+2))
+    g = 0.5*a
+    for i in range(len(lo)):
+        for j in prange(lo[i], hi[i]):
+            cE, sE = cosE[j], sinE[j]
+            if dM != 0:
+                cE, sE = _shift_anomaly(cE, sE, ecc, dM)
+            z, r, sinwnu = _cs2z_point(cE, sE, sini, r_star, ecc, sinom,
+                    cosom)
+            zt = np.abs(z)
+            if sinwnu*sini < 0:
+                f[j] = 1.0
+            elif zt <= (1-k):
+                f[j] = _qpower2_inside(zt,k,c,a,I_0,g)
+            elif np.abs(zt-1) < k:
+                f[j] = _qpower2_limb(zt,k,c,a,I_0,g)
+            else:
+                f[j] = 1.0
+    return f
+
+_KERNELS['transit_phase'] = _kernels(_transit_phase_func)
+
+def _qpower2_grid(k, c, a, tol):
+    # Grid of z values from 0 to 1+k and the values of qpower2 on this grid
+    # such that the error in linear interpolation of the light curve is
+    # approximately tol or less. Intervals are bisected until the value of
+    # qpower2 at the mid-point of every interval is within tol of the linear
+    # interpolant, so the grid is concentrated near z=1-k and z=1+k where the
+    # curvature of the light curve is large. There are grid points at 1-k and
+    # 1+k, where the gradient of the light curve is discontinuous.
+    z = np.concatenate((np.linspace(0, 1-k, 9)[:-1], 
+        np.linspace(1-k, 1+k, 9)))
+    f = qpower2(z, k, c, a)
+    active = np.ones(len(z)-1, dtype=bool)
+    for _ in range(40):
+        i = np.nonzero(active)[0]
+        zm = 0.5*(z[i]+z[i+1])
+        fm = qpower2(zm, k, c, a)
+        bad = np.abs(fm - 0.5*(f[i]+f[i+1])) > tol
+        if not bad.any():
+            break
+        i = i[bad]
+        z = np.insert(z, i+1, zm[bad])
+        f = np.insert(f, i+1, fm[bad])
+        # Position of each new grid point in the new arrays
+        j = i + 1 + np.arange(len(i))
+        active = np.zeros(len(z)-1, dtype=bool)
+        active[j-1] = True
+        active[j] = True
+    return z, f
+
+def _transit_interp_func(t, cosE, sinE, dM, f, lo, hi, T_0, tperi, P, sini,
+        r_star, ecc, sinom, cosom, k, zg, fg):
+    # Transit light curve for the points t[lo[i]:hi[i]] by linear
+    # interpolation in the values fg tabulated at the sorted values zg. The
+    # values of z are calculated from the cached values of cos(E) and sin(E)
+    # if these are given, otherwise from t. Other values of f are not changed.
+    cached = len(cosE) > 0
+    zmax = zg[-1]
+    for i in range(len(lo)):
+        for j in prange(lo[i], hi[i]):
+            if cached:
+                cE, sE = cosE[j], sinE[j]
+                if dM != 0:
+                    cE, sE = _shift_anomaly(cE, sE, ecc, dM)
+                z, r, sinwnu = _cs2z_point(cE, sE, sini, r_star, ecc,
+                        sinom, cosom)
+                m = sinwnu*sini < 0
+            else:
+                z, m = _t2z_point(t[j], T_0, tperi, P, sini, r_star, ecc,
+                        sinom, cosom)
+            zt = np.abs(z)
+            if m or (zt >= zmax):
+                f[j] = 1.0
+            else:
+                l = min(np.searchsorted(zg, zt, side='right'), len(zg)-1)
+                u = (zt - zg[l-1])/(zg[l] - zg[l-1])
+                f[j] = fg[l-1] + u*(fg[l] - fg[l-1])
+    return f
+
+_KERNELS['transit_interp'] = _kernels(_transit_interp_func)
+
+def _transit_geom_func(z, m, f, k, c, a):
+    # Transit light curve from the arrays z and mask of an OrbitGeometry
+    # object that has already been solved, written to f
+    I_0 = (a+2)/(np.pi*(a-c*a+2))
+    g = 0.5*a
+    for j in prange(len(z)):
+        zt = np.abs(z[j])
+        if m[j]:
+            f[j] = 1.0
+        elif zt <= (1-k):
+            f[j] = _qpower2_inside(zt,k,c,a,I_0,g)
         elif np.abs(zt-1) < k:
-            t1 = np.arccos(min(max(-1,(zt**2+k**2-1)/(2*zt*k)),1))
-            t2 = np.arccos(min(max(-1,(zt**2+1-k**2)/(2*zt)),1))
-            t3 = 0.5*np.sqrt(max(0,(1+k-zt)*(zt+k-1)*(zt-k+1)*(zt+k+1)))
-            fl[i] = 1 - (k**2*t1 + t2 - t3)/(np.pi*k**2)
-    return fl
+            f[j] = _qpower2_limb(zt,k,c,a,I_0,g)
+        else:
+            f[j] = 1.0
+    return f
+
+_KERNELS['transit_geom'] = _kernels(_transit_geom_func)
+
+@jit(nopython=True)
+def _is_sorted(t):
+    # Check whether an array of times is sorted. This is not cached because
+    # the array may have been modified in-place since the last call, and
+    # the check is no slower than a test for such changes would be.
+    for j in range(1, len(t)):
+        if not t[j] >= t[j-1]:
+            return False
+    return True
+
+# Serial numbers for read-only arrays used as cache keys, indexed by id(). The
+# entries are removed when the array is deleted, so an id() that is re-used
+# for a new array gets a new serial number.
+_array_refs = {}
+_array_count = itertools.count()
+
+def _array_key(t):
+    # Cache key for the contents of the array t, so that cached results are
+    # not reused after t has been modified in-place. Read-only arrays that own
+    # their data cannot be modified in-place (without setting them writeable
+    # again), so they are identified by a serial number, shape and end values
+    # instead of a hash of their contents.
+    t = np.ascontiguousarray(t)
+    if (t.size > 0) and t.flags.owndata and not t.flags.writeable:
+        i = id(t)
+        ref, n = _array_refs.get(i, (None, None))
+        if ref is None or ref() is not t:
+            n = next(_array_count)
+            ref = weakref.ref(t, lambda r, i=i: _array_refs.pop(i, None))
+            _array_refs[i] = (ref, n)
+        return (t.shape, t.dtype.str, n, t.flat[0], t.flat[-1])
+    return (t.shape, t.dtype.str, hashlib.blake2b(t, digest_size=16).digest())
+
+# Cache of results from _orbit_phase()
+_phase_cache = OrderedDict()
+_phase_cache_nbytes = 0
+
+def _orbit_phase(g, dt=0):
+    # cos(E) and sin(E) for the eccentric anomaly E at the times g.t-dt for
+    # the orbit in OrbitGeometry object g, and the offset in mean anomaly dM
+    # to apply to E for the time of periastron g.tperi. For circular orbits
+    # E is the phase angle from mid-transit. 
+    #
+    # The arrays depend only on the times, T_0, P, ecc, omega and dt, so they
+    # are stored in a cache and reused while these are fixed, e.g., in fits
+    # where only D, W, b and the limb-darkening vary. The time of periastron
+    # for an eccentric orbit also depends on sini. This is accounted for by
+    # the offset dM relative to the time of periastron used to calculate the
+    # cached arrays. The arrays are only calculated the second time the same
+    # orbit is seen, so there is little overhead if the ephemeris varies.
+    # Entries are discarded in least-recently-used order to keep the total
+    # size below GEOMETRY_CACHE_MAXBYTES. The key for the times is from
+    # _array_key(), so arrays of times can be modified in-place. Returns None
+    # if the cache is not used.
+    global _phase_cache_nbytes
+    if not GEOMETRY_CACHE:
+        return None
+    t = g.t
+    key = _array_key(t) + (g.tzero, g.P, g.ecc, g.sinom, g.cosom, dt)
+    try:
+        entry = _phase_cache[key]
+    except KeyError:
+        entry = None
+        _phase_cache[key] = None
+        while len(_phase_cache) > 64:
+            _, e = _phase_cache.popitem(last=False)
+            if e is not None:
+                _phase_cache_nbytes -= e[0].nbytes + e[1].nbytes
+        return None
+    _phase_cache.move_to_end(key)
+    if entry is None:
+        nbytes = 16*len(t)
+        if nbytes > GEOMETRY_CACHE_MAXBYTES:
+            return None
+        M = 2*np.pi*(t.astype(float)-dt-g.tperi)/g.P
+        E = M if g.ecc == 0 else kepler_solve(M, g.ecc)
+        entry = (np.cos(E), np.sin(E), g.tperi)
+        _phase_cache[key] = entry
+        _phase_cache_nbytes += nbytes
+        for k in list(_phase_cache):
+            if _phase_cache_nbytes <= GEOMETRY_CACHE_MAXBYTES:
+                break
+            e = _phase_cache.pop(k)
+            if e is not None:
+                _phase_cache_nbytes -= e[0].nbytes + e[1].nbytes
+    cosE, sinE, tperi = entry
+    return cosE, sinE, 2*np.pi*(tperi-g.tperi)/g.P
+
+def _contact_index(t, t_ref, P, ph_c, dph):
+    # Index ranges [lo, hi) for the sorted times t within windows of
+    # half-width dph centred on phase ph_c relative to t_ref (in units of P)
+    t_c = t_ref + ph_c*P
+    n = np.arange(np.floor((t[0]-t_c)/P-dph), np.ceil((t[-1]-t_c)/P+dph)+1)
+    lo = np.searchsorted(t, t_c + (n-dph)*P, side='left')
+    hi = np.searchsorted(t, t_c + (n+dph)*P, side='right')
+    return lo, hi
+
+def _transit_flux(g, k, c, a, texp=0, nsub=1, dtype=np.float64, ztol=None):
+    # Transit light curve for the times and orbit in OrbitGeometry object g.
+    # If ztol is not None and there is no exposure time integration, the
+    # light curve is interpolated from a grid of values of z with accuracy
+    # ztol.
+    t = g.t
+    if len(t) == 0:
+        return np.ones(0, dtype)
+    dz = _exposure_dz(g.P, g.rstar, g.ecc, texp, nsub)
+    if dz < 0:
+        texp, nsub = 0.0, 1
+    args = (g.tzero, g.tperi, g.P, g.sini, g.rstar, g.ecc, g.omrad, 
+            k, c, a, texp, nsub, dz)
+    parallel = PARALLEL and (len(t) >= PARALLEL_MIN_SIZE)
+    # Use z and mask if they have already been calculated for another
+    # component of the model and there is no exposure integration
+    if g.solved and (dz < 0):
+        if ztol is not None:
+            zg, fg = _qpower2_grid(k, c, a, ztol)
+            f = np.interp(np.abs(g.z), zg, fg, right=1.0)
+            f[g.mask] = 1.0
+            return f.astype(dtype, copy=False)
+        func = _kernel('transit_geom', parallel)
+        return func(g.z, g.mask, np.empty(len(t), dtype), k, c, a)
+    # Cached orbital phase terms are only used with no exposure integration
+    phase = None if dz > 0 else _orbit_phase(g)
+    lo = None
+    if _is_sorted(t):
+        # Only evaluate the model for points within the contact windows
+        ph_c, dph = g.contact_window(k)
+        dph += 0.5*texp/g.P
+        if dph < 0.5:
+            lo, hi = _contact_index(t, g.tperi, g.P, ph_c, dph)
+    if (ztol is not None) and (dz < 0):
+        if lo is None:
+            lo, hi = np.zeros(1, int), np.full(1, len(t))
+        if phase is None:
+            phase = (np.empty(0), np.empty(0), 0.0)
+        zg, fg = _qpower2_grid(k, c, a, ztol)
+        func = _kernel('transit_interp', parallel)
+        return func(t, *phase, np.ones(len(t), dtype), lo, hi, g.tzero,
+                g.tperi, g.P, g.sini, g.rstar, g.ecc, g.sinom, g.cosom, k,
+                zg, fg)
+    if phase is not None:
+        if lo is None:
+            lo, hi = np.zeros(1, int), np.full(1, len(t))
+        func = _kernel('transit_phase', parallel)
+        return func(*phase[:2], np.ones(len(t), dtype), lo, hi, phase[2],
+                g.sini, g.rstar, g.ecc, g.sinom, g.cosom, k, c, a)
+    if lo is not None:
+        func = _kernel('transit_index', parallel)
+        return func(t, np.ones(len(t), dtype), lo, hi, *args)
+    func = _kernel('transit_flux', parallel)
+    return func(t, np.empty(len(t), dtype), *args)
+
+@jit(nopython=True, nogil=True, inline='always')
+def _eclipse_point_int(t, T_0, tperi, P, sini, r_star, ecc, sinom, cosom,
+        k, texp, nsub, dz):
+    # Flux from a uniform disc eclipsed by the star. Points during ingress or
+    # egress, or with z within dz of a contact point, are integrated over an
+    # exposure time texp using nsub sub-samples
+    z, m = _t2z_point(t, T_0, tperi, P, sini, r_star, ecc, sinom, cosom)
+    # Planet is in front of the star
+    if not m: return 1.0
+    zt = np.abs(z)
+    if np.abs(zt-1) < k+dz:
+        f = 0.0
+        for i in range(nsub):
+            ti = t + ((i+0.5)/nsub - 0.5)*texp
+            z, m = _t2z_point(ti, T_0, tperi, P, sini, r_star, ecc,
+                    sinom, cosom)
+            f += _ueclipse_point(np.abs(z), k) if m else 1.0
+        return f/nsub
+    return _ueclipse_point(zt, k)
+
+def _eclipse_flux_func(t, f, T_0, tperi, P, sini, r_star, ecc, omrad, k,
+        texp, nsub, dz, dt):
+    # Eclipse light curve at times t-dt with no intermediate arrays, written
+    # to f
+    sinom = np.sin(omrad)
+    cosom = np.cos(omrad)
+    for j in prange(len(t)):
+        f[j] = _eclipse_point_int(t[j]-dt, T_0, tperi, P, sini, r_star, ecc,
+                sinom, cosom, k, texp, nsub, dz)
+    return f
+
+_KERNELS['eclipse_flux'] = _kernels(_eclipse_flux_func)
+
+def _eclipse_index_func(t, f, lo, hi, T_0, tperi, P, sini, r_star, ecc, omrad,
+        k, texp, nsub, dz, dt):
+    # As _eclipse_flux_func, but only for the points t[lo[i]:hi[i]]. Other
+    # values of f are not changed.
+    sinom = np.sin(omrad)
+    cosom = np.cos(omrad)
+    for i in range(len(lo)):
+        for j in prange(lo[i], hi[i]):
+            f[j] = _eclipse_point_int(t[j]-dt, T_0, tperi, P, sini, r_star, ecc,
+                    sinom, cosom, k, texp, nsub, dz)
+    return f
+
+_KERNELS['eclipse_index'] = _kernels(_eclipse_index_func)
+
+def _eclipse_phase_func(cosE, sinE, f, lo, hi, dM, sini, r_star, ecc,
+        sinom, cosom, k):
+    # As _eclipse_index_func, but using the values of cos(E) and sin(E) from
+    # _orbit_phase() instead of solving Kepler's equation for each point
+    for i in range(len(lo)):
+        for j in prange(lo[i], hi[i]):
+            cE, sE = cosE[j], sinE[j]
+            if dM != 0:
+                cE, sE = _shift_anomaly(cE, sE, ecc, dM)
+            z, r, sinwnu = _cs2z_point(cE, sE, sini, r_star, ecc, sinom,
+                    cosom)
+            if sinwnu*sini < 0:
+                f[j] = _ueclipse_point(np.abs(z), k)
+            else:
+                f[j] = 1.0
+    return f
+
+_KERNELS['eclipse_phase'] = _kernels(_eclipse_phase_func)
+
+def _eclipse_geom_func(z, m, f, k):
+    # Eclipse light curve from the arrays z and mask of an OrbitGeometry
+    # object that has already been solved, written to f
+    for j in prange(len(z)):
+        if m[j]:
+            f[j] = _ueclipse_point(np.abs(z[j]), k)
+        else:
+            f[j] = 1.0
+    return f
+
+_KERNELS['eclipse_geom'] = _kernels(_eclipse_geom_func)
+
+def _eclipse_flux(g, k, texp=0, nsub=1, dtype=np.float64):
+    # Flux from a uniform disc eclipsed by the star for the times and orbit in
+    # OrbitGeometry object g, including the light travel time correction
+    # g.a_c, integrated over the exposure time for points near the contact
+    # points. If g has already been solved for another component of the model
+    # and there is no exposure integration, the flux is calculated from
+    # g.z_ltt and g.mask_ltt. Otherwise, the kernels solve Kepler's equation
+    # for each point at the time t-a_c.
+    t = g.t
+    if len(t) == 0:
+        return np.ones(0, dtype)
+    dz = _exposure_dz(g.P, g.rstar, g.ecc, texp, nsub)
+    if dz < 0:
+        texp, nsub = 0.0, 1
+    args = (g.tzero, g.tperi, g.P, g.sini, g.rstar, g.ecc, g.omrad, 
+            k, texp, nsub, dz, g.a_c)
+    parallel = PARALLEL and (len(t) >= PARALLEL_MIN_SIZE)
+    if g.solved and (dz < 0):
+        func = _kernel('eclipse_geom', parallel)
+        return func(g.z_ltt, g.mask_ltt, np.empty(len(t), dtype), k)
+    phase = None if dz > 0 else _orbit_phase(g, g.a_c)
+    lo = None
+    if _is_sorted(t):
+        ph_c, dph = g.contact_window(k, eclipse=True)
+        dph += 0.5*texp/g.P
+        if dph < 0.5:
+            lo, hi = _contact_index(t, g.tperi+g.a_c, g.P, ph_c, dph)
+    if phase is not None:
+        if lo is None:
+            lo, hi = np.zeros(1, int), np.full(1, len(t))
+        func = _kernel('eclipse_phase', parallel)
+        return func(*phase[:2], np.ones(len(t), dtype), lo, hi, phase[2],
+                g.sini, g.rstar, g.ecc, g.sinom, g.cosom, k)
+    if lo is not None:
+        func = _kernel('eclipse_index', parallel)
+        return func(t, np.ones(len(t), dtype), lo, hi, *args)
+    func = _kernel('eclipse_flux', parallel)
+    return func(t, np.empty(len(t), dtype), *args)
+
+def _solve_shared(g, k, texp=0, nsub=1):
+    # Solve Kepler's equation for all the times in OrbitGeometry object g if
+    # both the transit and the eclipse would otherwise need one solution per
+    # point, i.e., if the times are not sorted or the contact windows cover
+    # the whole orbit. The eclipse then uses z and mask for the times t-a_c
+    # from a Newton-Raphson correction to these solutions. There is no
+    # advantage if the light curve is integrated over the exposure time.
+    if _exposure_dz(g.P, g.rstar, g.ecc, texp, nsub) > 0:
+        return
+    if _is_sorted(g.t):
+        if ((g.contact_window(k)[1] < 0.5) and
+                (g.contact_window(k, eclipse=True)[1] < 0.5)):
+            return
+    g.solve()
+
+def _transit_batch_func(t, f, T_0, tperi, P, sini, r_star, ecc, omrad, 
+        k, c, a, valid):
+    # Light curves for many sets of transit parameters in one call written to
+    # f, which must be initialised to 1. Each parameter is an array with one
+    # element per parameter set.
+    for i in prange(len(T_0)):
+        if not valid[i]: continue
+        I_0 = (a[i]+2)/(np.pi*(a[i]-c[i]*a[i]+2))
+        g = 0.5*a[i]
+        sinom = np.sin(omrad[i])
+        cosom = np.cos(omrad[i])
+        ph_c, dph = _contact_window(ecc[i], sinom, cosom, r_star[i], k[i])
+        for j in range(len(t)):
+            ph = (t[j]-tperi[i])/P[i] - ph_c
+            if np.abs(ph - np.floor(ph+0.5)) > dph: continue
+            f[i,j] = _transit_point(t[j], T_0[i], tperi[i], P[i], sini[i],
+                    r_star[i], ecc[i], sinom, cosom, k[i], c[i], a[i], I_0, g)
+    return f
 
+_KERNELS['transit_batch'] = _kernels(_transit_batch_func)
 
 #----------------------
 
-class TransitModel(Model):
+def _numeric_partials(model, params, t, names):
+    # Partial derivatives of a (non-composite) model w.r.t. the parameters in
+    # names by central differences, or one-sided differences at the limits of
+    # the allowed range for the parameter
+    kw = model.make_funcargs(params, {'t':t})
+    jac = {}
+    for name in names:
+        arg = name[len(model.prefix):]
+        v = kw[arg]
+        h = 1e-6*(abs(v) + 1e-3)
+        hi = min(v+h, params[name].max)
+        lo = max(v-h, params[name].min)
+        kw[arg] = hi
+        f_hi = model.func(**kw)
+        kw[arg] = lo
+        f_lo = model.func(**kw)
+        kw[arg] = v
+        jac[name] = (f_hi - f_lo)/(hi - lo)
+    return jac
+
+def _model_jacobian(model, params, t, names):
+    # Model value and partial derivatives w.r.t. the parameters in names. 
+    # Components with a jacobian() method provide their own derivatives,
+    # sums, differences, products and ratios of models are handled using the
+    # chain rule and
+    # numerical derivatives are used for other models. Partial derivatives
+    # are returned in a dictionary. Partial derivatives that are 0
+    # everywhere may be missing from this dictionary.
+    if isinstance(model, CompositeModel):
+        f_l, j_l = _model_jacobian(model.left, params, t, names)
+        f_r, j_r = _model_jacobian(model.right, params, t, names)
+        if model.op in (operator.add, operator.sub):
+            f = model.op(f_l, f_r)
+            jac = j_l
+            for n in j_r:
+                jac[n] = model.op(jac.get(n, 0), j_r[n])
+        elif model.op is operator.mul:
+            f = f_l * f_r
+            jac = {n:j_l[n]*f_r for n in j_l}
+            for n in j_r:
+                jac[n] = jac.get(n, 0) + f_l*j_r[n]
+        elif model.op is operator.truediv:
+            f = f_l / f_r
+            jac = {n:j_l[n]/f_r for n in j_l}
+            for n in j_r:
+                jac[n] = jac.get(n, 0) - f*j_r[n]/f_r
+        else:
+            raise ValueError('Unsupported operator {}'.format(model.op))
+        return f, jac
+    names = [n for n in names if n in model.param_names]
+    if len(names) == 0:
+        return model.eval(params, t=t), {}
+    if hasattr(model, 'jacobian'):
+        return model.jacobian(params, t, names)
+    f = model.eval(params, t=t)
+    return f, _numeric_partials(model, params, t, names)
+
+# Node types allowed in constraint expressions that are compiled to Python
+# code by _ModelEvaluator. Other expressions are evaluated with asteval.
+_EXPR_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name,
+        ast.Constant, ast.Load, ast.operator, ast.unaryop, ast.IfExp,
+        ast.Compare, ast.cmpop, ast.BoolOp, ast.boolop)
+
+class _ModelEvaluator(object):
+    # Evaluate a model and the constrained parameters for a flat vector of
+    # parameter values without creating lmfit Parameter objects. 
+    #
+    # The values of all the parameters in params are stored in an array in
+    # the order given by names, with the values of the parameters in vary
+    # at the positions given by the array of indices ivary. Constraint
+    # expressions are compiled once to Python code objects and evaluated in
+    # order of dependency. The model function of each component of model
+    # is called directly with its arguments taken from the array of values
+    # via an array of indices. The parameters in linear are those on which
+    # the model depends linearly, e.g., detrending coefficients.
+    #
+    # Unlike lmfit, the values of constrained parameters are not clipped to
+    # their bounds, so values outside the range (lo, hi) can be rejected.
+
+    def __init__(self, model, params, vary, t, linear=()):
+        self.model = model
+        self.t = t
+        self._params = params
+        self._vary = list(vary)
+        self._lin_names = list(linear)
+        self.names = list(params)
+        self.index = {n:i for i, n in enumerate(self.names)}
+        self.ivary = np.array([self.index[n] for n in vary], dtype=int)
+        self.ilin = np.array([self.index[n] for n in linear], dtype=int)
+        self.value = np.array([params[n].value for n in self.names],
+                dtype=float)
+        self.lo = np.array([params[n].min for n in self.names], dtype=float)
+        self.hi = np.array([params[n].max for n in self.names], dtype=float)
+        u = [params[n].user_data for n in self.names]
+        # Gaussian priors on the other parameters. The priors on the linear
+        # parameters apply to their optimum values, not to the values in v.
+        self.iprior = np.array([i for i, x in enumerate(u)
+            if isinstance(x, UFloat) and i not in self.ilin], dtype=int)
+        self.prior_mu = np.array([u[i].n for i in self.iprior])
+        self.prior_sigma = np.array([u[i].s for i in self.iprior])
+        # Gaussian priors on the linear parameters, sigma=inf if there is none
+        self.lin_mu = np.array([u[i].n if isinstance(u[i], UFloat) else 0
+            for i in self.ilin], dtype=float)
+        self.lin_sigma = np.array([u[i].s if isinstance(u[i], UFloat)
+            else np.inf for i in self.ilin], dtype=float)
+
+        # Constraint expressions, sorted so that each expression only depends
+        # on parameters that are independent or evaluated earlier
+        symtable = params._asteval.symtable
+        self._symbols = {k:v for k, v in symtable.items()
+                if k not in self.index}
+        self._symbols['__builtins__'] = {}
+        exprs = {n:params[n].expr for n in self.names
+                if params[n].expr is not None}
+        self._exprs = []
+        done = set()
+        def _add(n, stack=()):
+            if n in done or n not in exprs:
+                return
+            if n in stack:
+                raise ValueError('Circular constraint for {}'.format(n))
+            node = ast.parse(exprs[n], mode='eval')
+            deps = [d for d in OrderedDict.fromkeys(get_ast_names(node))
+                    if d in self.index]
+            for d in deps:
+                _add(d, stack+(n,))
+            if all(isinstance(x, _EXPR_NODES) for x in ast.walk(node)):
+                code = compile(node, '<{}>'.format(n), 'eval')
+            else:
+                code = None
+            self._exprs.append((self.index[n], code, params._asteval.parse(
+                exprs[n]), [(d, self.index[d]) for d in deps]))
+            done.add(n)
+        for n in exprs:
+            _add(n)
+        self._asteval = params._asteval
+
+        # If all the expressions can be compiled, they are combined into a
+        # single function that updates the array of values in place.
+        self._update = None
+        if all(code is not None for _, code, _, _ in self._exprs):
+            lines = ['def _update(v):']
+            loaded = set()
+            for i, _, _, deps in self._exprs:
+                for d, j in deps:
+                    if d not in loaded:
+                        lines.append('    {} = v[{}]'.format(d, j))
+                        loaded.add(d)
+                n = self.names[i]
+                lines.append('    {} = ({})'.format(n, exprs[n]))
+                lines.append('    v[{}] = {}'.format(i, n))
+                loaded.add(n)
+            lines.append('    return v')
+            ns = {}
+            exec(compile('\n'.join(lines), '<constraints>', 'exec'),
+                    self._symbols, ns)
+            self._update = ns['_update']
+
+        # The constraints can be evaluated for arrays of values unless they
+        # use conditional expressions or Python built-in functions such as
+        # max() that do not act element-wise on arrays.
+        def _elementwise(node):
+            for x in ast.walk(node):
+                if isinstance(x, (ast.IfExp, ast.Compare, ast.BoolOp)):
+                    return False
+                if isinstance(x, ast.Call):
+                    if not isinstance(x.func, ast.Name):
+                        return False
+                    f = symtable.get(x.func.id)
+                    if getattr(f, '__module__', None) == 'builtins':
+                        return False
+            return True
+        self._elementwise = all(_elementwise(ast.parse(exprs[self.names[i]],
+            mode='eval')) for i, _, _, _ in self._exprs)
+
+        # Function arguments of the model components 
+        self._leaves = []
+        self._tree = self._make_tree(model, params)
+
+    def __reduce__(self):
+        # Code objects cannot be pickled and nor can lmfit CompositeModel
+        # objects, so the evaluator is created again from the model
+        # components and params when it is unpickled.
+        def _components(model):
+            if isinstance(model, CompositeModel):
+                return (model.op, _components(model.left),
+                        _components(model.right))
+            return model
+        return (_unpickle_evaluator, (_components(self.model), self._params,
+            self._vary, self.t, self._lin_names), {'value':self.value})
+
+    def _make_tree(self, model, params):
+        if isinstance(model, CompositeModel):
+            return (model.op, self._make_tree(model.left, params),
+                    self._make_tree(model.right, params))
+        kw = model.make_funcargs(params, {'t':self.t})
+        args = []
+        for arg in kw:
+            for name in (model.prefix+arg, arg):
+                if name in self.index:
+                    args.append((arg, self.index[name]))
+                    break
+        ilin = list(self.ilin)
+        lin = [(arg, ilin.index(j)) for arg, j in args if j in ilin]
+        leaf = len(self._leaves)
+        self._leaves.append((model, kw, args, lin))
+        return leaf
+
+    def values(self, x):
+        """
+        Array of all parameter values for the values x of the free parameters
+        """
+        v = self.value.copy()
+        v[self.ivary] = x
+        self.update(v)
+        return v
+
+    def update(self, v):
+        """
+        Evaluate the constrained parameters in the array of values v
+        """
+        ns = self._symbols
+        with np.errstate(all='ignore'):
+            if self._update is not None:
+                return self._update(v)
+            for i, code, node, deps in self._exprs:
+                for d, j in deps:
+                    ns[d] = v[j]
+                if code is None:
+                    for d, j in deps:
+                        self._asteval.symtable[d] = v[j]
+                    v[i] = self._asteval.run(node)
+                else:
+                    v[i] = eval(code, ns)
+        return v
+
+    def values_batch(self, X):
+        """
+        Array of parameter values with one row for each row of the array X
+        of values for the free parameters
+        """
+        V = np.tile(self.value, (len(X), 1))
+        V[:,self.ivary] = X
+        return self.update_batch(V)
+
+    def update_batch(self, V):
+        """
+        Evaluate the constrained parameters for each row of the array V
+        """
+        if self._elementwise:
+            # Column j of V is V.T[j], so update() works on all rows at once
+            self.update(V.T)
+        else:
+            for v in V:
+                self.update(v)
+        return V
+
+    def valuesdict(self, v):
+        """Dictionary of parameter values keyed by name"""
+        return dict(zip(self.names, v))
+
+    def _eval_leaf(self, leaf, v, x=None):
+        model, kw, args, _ = self._leaves[leaf]
+        kw = kw.copy()
+        for arg, j in args:
+            kw[arg] = v[j]
+        if x is not None:
+            kw.update(x)
+        f = model.func(**kw)
+        return np.asarray(f, dtype=getattr(model, 'dtype', float))
+
+    def _eval_leaf_batch(self, leaf, V, x=None):
+        # Model component for each row of V. Components with a method
+        # eval_batch(), e.g., TransitModel, are evaluated for all rows in one
+        # call, otherwise the model function is called once for each distinct
+        # set of values of its arguments.
+        model, kw, args, _ = self._leaves[leaf]
+        if hasattr(model, 'eval_batch'):
+            cols = dict(args)
+            theta = np.empty((len(V), len(model.param_names)))
+            for k, name in enumerate(model.param_names):
+                arg = name[len(model.prefix):]
+                if (x is not None) and (arg in x):
+                    theta[:,k] = x[arg]
+                elif arg in cols:
+                    theta[:,k] = V[:,cols[arg]]
+                elif arg in kw:
+                    theta[:,k] = kw[arg]
+                else:
+                    theta[:,k] = model.def_vals[arg]
+            return model.eval_batch(theta, self.t)
+        shape = (len(V), len(self.t))
+        j = [j for _, j in args]
+        if len(j) == 0 or len(V) == 0:
+            f = self._eval_leaf(leaf, self.value, x)
+            return np.broadcast_to(f, shape).copy()
+        _, i, inv = np.unique(V[:,j], axis=0, return_index=True,
+                return_inverse=True)
+        f = np.empty((len(i), len(self.t)), 
+                dtype=getattr(model, 'dtype', float))
+        for k, r in enumerate(i):
+            f[k] = self._eval_leaf(leaf, V[r], x)
+        return f[inv.ravel()]
+
+    def eval(self, v):
+        """Model for the array of parameter values v"""
+        def _eval(node):
+            if isinstance(node, tuple):
+                op, left, right = node
+                return op(_eval(left), _eval(right))
+            return self._eval_leaf(node, v)
+        return _eval(self._tree)
+
+    def eval_batch(self, V):
+        """
+        Model for each row of the array of parameter values V
+
+        Returns an array with shape (len(V), len(t)).
+        """
+        def _eval(node):
+            if isinstance(node, tuple):
+                op, left, right = node
+                return op(_eval(left), _eval(right))
+            return self._eval_leaf_batch(node, V)
+        return _eval(self._tree)
+
+    def linear(self, v):
+        """
+        Model and its partial derivatives w.r.t. the linear parameters
+
+        Returns the model for values v and an array with one column per
+        linear parameter. For each model component, the partial derivatives
+        are calculated from the difference between the component evaluated
+        with one linear parameter equal to 1 and all of them equal to 0.
+
+        """
+        return self._linear(v, self._eval_leaf, (len(self.t),))
+
+    def linear_batch(self, V):
+        """
+        As linear() for each row of the array of parameter values V
+
+        Returns arrays with shapes (len(V), len(t)) and (len(V), len(t), m)
+        for m linear parameters.
+        """
+        return self._linear(V, self._eval_leaf_batch, (len(V), len(self.t)))
+
+    def _linear(self, v, eval_leaf, shape):
+        # The partial derivatives are None for components that do not depend
+        # on any linear parameter.
+        n = len(self.ilin)
+        def _eval(node):
+            if isinstance(node, tuple):
+                op, left, right = node
+                f_l, j_l = _eval(left)
+                f_r, j_r = _eval(right)
+                f = op(f_l, f_r)
+                if j_l is None and j_r is None:
+                    jac = None
+                elif op in (operator.add, operator.sub):
+                    if j_r is None:
+                        jac = j_l
+                    elif j_l is None:
+                        jac = op(0, j_r)
+                    else:
+                        jac = op(j_l, j_r)
+                elif op is operator.mul:
+                    if j_r is None:
+                        jac = j_l*f_r[...,None]
+                    elif j_l is None:
+                        jac = f_l[...,None]*j_r
+                    else:
+                        jac = j_l*f_r[...,None] + f_l[...,None]*j_r
+                elif op is operator.truediv:
+                    if j_r is None:
+                        jac = j_l/f_r[...,None]
+                    elif j_l is None:
+                        jac = -f[...,None]*j_r/f_r[...,None]
+                    else:
+                        jac = (j_l - f[...,None]*j_r)/f_r[...,None]
+                else:
+                    raise ValueError('Unsupported operator {}'.format(op))
+                return f, jac
+            f = eval_leaf(node, v)
+            if f.ndim == 0:
+                f = np.full(shape, f)
+            lin = self._leaves[node][3]
+            if not lin:
+                return f, None
+            jac = np.zeros(shape + (n,))
+            zero = {arg:0.0 for arg, _ in lin}
+            f_0 = eval_leaf(node, v, zero)
+            for arg, k in lin:
+                x = zero.copy()
+                x[arg] = 1.0
+                jac[...,k] = eval_leaf(node, v, x) - f_0
+            return f, jac
+        f, jac = _eval(self._tree)
+        if jac is None:
+            jac = np.zeros(shape + (n,))
+        return f, jac
+
+def _unpickle_evaluator(components, params, vary, t, linear):
+    def _model(node):
+        if isinstance(node, tuple):
+            op, left, right = node
+            return CompositeModel(_model(left), _model(right), op)
+        return node
+    return _ModelEvaluator(_model(components), params, vary, t, linear)
+
+class _PicklableModel(Model):
+    # The model functions of the models in this module are closures that
+    # cannot be pickled, so these models are pickled with the arguments used
+    # to create them, e.g., to send them to the processes of a
+    # multiprocessing pool. The model is created again from these arguments
+    # when it is unpickled and then the other attributes, e.g., param_hints,
+    # are restored. Cached design matrices are not included.
+
+    def __new__(cls, *args, **kwargs):
+        self = super(_PicklableModel, cls).__new__(cls)
+        self._init_args = (args, kwargs)
+        return self
+
+    def __reduce__(self):
+        args, kwargs = self._init_args
+        state = {k:v for k, v in self.__dict__.items()
+                if k not in ('func', '_init_args', '_design_cache')}
+        return (_unpickle_model, (type(self), args, kwargs), state)
+
+def _unpickle_model(cls, args, kwargs):
+    return cls(*args, **kwargs)
+
+class _ModelDtype(_PicklableModel):
+    # Model for which eval() returns an array with the data type given by the
+    # attribute dtype, e.g., np.float32, rather than np.float64.
+
+    def eval(self, params=None, **kwargs):
+        f = self.func(**self.make_funcargs(params, kwargs))
+        return np.asarray(f, dtype=self.dtype)
+
+    eval.__doc__ = Model.eval.__doc__
+
+class TransitModel(_ModelDtype):
     r"""Light curve model for the transit of a spherical star by an opaque
     spherical body (planet).
 
@@ -318,12 +1753,56 @@ class TransitModel(Model):
     If the input parameters are invalid or k>0.5 the model is returned as an
     array of value 1 everywhere.
 
+    If the array of times is sorted, the model is only evaluated for points
+    within a window around each transit found using a binary search. The
+    flux for all other points is set to 1 with no further calculation.
+
+    To integrate the light curve over the exposure time, set the keyword
+    arguments exptime (same units as t) and supersample (number of samples
+    per exposure). Points close to the contact points or where the light
+    curve is strongly curved are integrated using supersample samples per
+    exposure. Simpson's rule is used for other points in transit and points
+    out of transit are evaluated once, so the cost of the calculation
+    depends mostly on the number of points close to the contact points.
+
+    For large arrays the light curve can be returned as a single-precision
+    array by setting the keyword argument dtype=np.float32. This halves the
+    size of the output array, e.g., for injection-recovery tests. The
+    calculation is done in double precision so the error in the light curve
+    is less than 1e-7. The array of times can also be single precision, in
+    which case there is an additional error due to the rounding of t of up to
+    6e-8*max(|t|)*max(|df/dt|), i.e., about 2e-6 for a 0.01-day ingress 30
+    days from the time origin.
+
+    If the model is evaluated more than once for the same array of times with
+    the same values of T_0, P, f_c and f_s, e.g., in a fit where only D, W, b
+    and the limb-darkening parameters vary, the orbital phase terms for each
+    time are taken from a cache instead of being recalculated. The cache can
+    be disabled by setting the module-level switch GEOMETRY_CACHE = False,
+    and its maximum size in bytes is GEOMETRY_CACHE_MAXBYTES. The cache is not
+    used if the light curve is integrated over the exposure time.
+
+    For very long time series, set the keyword argument ztol, e.g., ztol=1e-6,
+    to calculate the light curve by linear interpolation in a table of
+    qpower2 values. The table covers the range 0 <= z <= 1+k on a grid that
+    is refined adaptively until the interpolation error is approximately ztol
+    or less, so the grid is concentrated near the contact points z=1-k and
+    z=1+k. A few hundred evaluations of qpower2 are usually enough, so the
+    cost of the calculation is almost independent of the number of points.
+    This option is ignored if the light curve is integrated over the exposure
+    time.
+
     """
 
     def __init__(self, independent_vars=['t'], prefix='', nan_policy='raise',
+                 exptime=0, supersample=1, dtype=np.float64, ztol=None,
                  **kwargs):
         kwargs.update({'prefix': prefix, 'nan_policy': nan_policy,
                        'independent_vars': independent_vars})
+        self.exptime = exptime
+        self.supersample = supersample
+        self.dtype = dtype
+        self.ztol = ztol
 
         def _transit_func(t, T_0, P, D, W, b, f_c, f_s, h_1, h_2):
 
@@ -347,14 +1826,136 @@ class TransitModel(Model):
             om = np.arctan2(f_s, f_c)*180/np.pi
             c2 = 1 - h_1 + h_2
             a2 = np.log2(c2/h_2)
-            z,m = t2z(t, T_0, P, sini, r_star, ecc, om, returnMask = True)
-            # Set z values where planet is behind star to a large nominal value
-            z[m]  = 100
-            return qpower2(z, k, c2, a2)
+            g = OrbitGeometry(t, T_0, P, sini, r_star, ecc, om)
+            return _transit_flux(g, k, c2, a2, self.exptime, self.supersample,
+                    self.dtype, self.ztol)
 
         super(TransitModel, self).__init__(_transit_func, **kwargs)
         self._set_paramhints_prefix()
 
+    def eval_batch(self, theta, t):
+        """
+        Evaluate the light curve for many sets of parameters in one call
+
+        The columns of theta are the parameters T_0, P, D, W, b, f_c, f_s, h_1
+        and h_2 in the order given by self.param_names. The calculation of the
+        star-planet separation and the flux for all parameter sets is done in
+        a single compiled function, e.g., to evaluate the model for all the
+        walkers in an emcee sampler at once. The parameter sets are processed
+        in parallel if the module-level switch PARALLEL is True.
+
+        As for the eval() method, the model for invalid parameter sets is 1
+        everywhere. Light curves integrated over the exposure time are
+        calculated for each set of parameters in turn. The option ztol is
+        not used by this method.
+
+        :param theta: array of parameter values, shape (nsets, nparams)
+        :param t: array of times
+
+        :returns: array of fluxes, shape (nsets, len(t)), with the data type
+          given by the dtype keyword argument used to create the model
+
+        """
+        theta = np.atleast_2d(np.asarray(theta, dtype=float))
+        t = np.asarray(t)
+        if t.dtype != np.float32:
+            t = t.astype(float, copy=False)
+        if (self.exptime > 0) and (self.supersample > 1):
+            f = np.empty((len(theta), len(t)), self.dtype)
+            for i, p in enumerate(theta):
+                f[i] = self.func(t, *p)
+            return f
+        T_0, P, D, W, b, f_c, f_s, h_1, h_2 = theta.T
+        with np.errstate(all='ignore'):
+            k = np.sqrt(D)
+            q = (1+k)**2 - b**2
+            r_star = np.pi*W/np.sqrt(q)
+            sini = np.sqrt(1-b**2*r_star**2)
+            ecc = f_c**2 + f_s**2
+            om = np.arctan2(f_s, f_c)*180/np.pi
+            q1 = (1-h_2)**2
+            q2 = (h_1-h_2)/(1-h_2)
+            c2 = 1 - h_1 + h_2
+            a2 = np.log2(c2/h_2)
+            valid = ((D > 0) & (D <= 0.25) & (W > 0) & (b >= 0) &
+                    (np.abs(f_c) < 1) & (np.abs(f_s) < 1) & 
+                    (q1 > 0) & (q1 < 1) & (q2 > 0) & (q2 < 1) & (q > 0) &
+                    (b**2*r_star**2 < 1) & (ecc <= 0.95))
+        tperi = T_0.copy()
+        i = valid & (ecc > 0)
+        if i.any():
+            tperi[i] = tzero2tperi(T_0[i], P[i], sini[i], ecc[i], om[i])
+        func = _kernel('transit_batch', PARALLEL)
+        f = np.ones((len(T_0), len(t)), self.dtype)
+        return func(t, f, T_0, tperi, P, sini, r_star, ecc, om*np.pi/180,
+                k, c2, a2, valid)
+
+    def jacobian(self, params, t, names=None):
+        """
+        Light curve and its partial derivatives w.r.t. the model parameters
+
+        For circular orbits the partial derivatives w.r.t. T_0, P, D, W, b,
+        h_1 and h_2 are calculated analytically from the partial derivatives
+        of qpower2 w.r.t. z, k, c and alpha. Partial derivatives w.r.t. f_c
+        and f_s, and all partial derivatives for eccentric orbits or if the
+        light curve is integrated over the exposure time, are calculated
+        numerically.
+
+        :param params: lmfit Parameters object
+        :param t: array of times
+        :param names: names of the parameters (including prefix) for which
+          partial derivatives are required. Default is all parameters.
+
+        :returns: flux, dict of partial derivatives keyed by parameter name
+
+        """
+        if names is None:
+            names = self.param_names
+        t = np.asarray(t, dtype=float)
+        kw = self.make_funcargs(params)
+        T_0, P, D, W, b, f_c, f_s, h_1, h_2 = [kw[n] for n in 
+                ('T_0', 'P', 'D', 'W', 'b', 'f_c', 'f_s', 'h_1', 'h_2')]
+        f = self.func(t, **kw)
+        ecc = f_c**2 + f_s**2
+        if (ecc > 0) or ((self.exptime > 0) and (self.supersample > 1)):
+            return f, _numeric_partials(self, params, t, names)
+        p = self.prefix
+        jac = _numeric_partials(self, params, t, 
+                [n for n in names if n in (p+'f_c', p+'f_s')])
+        # Model is 1 everywhere for invalid parameters 
+        if np.all(f == 1):
+            return f, jac
+        k = np.sqrt(D)
+        q = (1+k)**2 - b**2
+        r_star = np.pi*W/np.sqrt(q)
+        sini = np.sqrt(1-b**2*r_star**2)
+        c2 = 1 - h_1 + h_2
+        a2 = np.log2(c2/h_2)
+        nu = 2*np.pi*(t-T_0)/P
+        cosnu = np.cos(nu)
+        sinnu = np.sin(nu)
+        zr = np.sqrt(1-cosnu**2*sini**2)
+        z = np.where(cosnu*sini < 0, 100, zr/r_star)
+        f, f_z, f_k, f_c, f_a = _qpower2_grad(z, k, c2, a2)
+        # Partial derivatives of z w.r.t. nu, sini and r_star
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z_nu = np.where(zr > 0, cosnu*sinnu*sini**2/zr/r_star, 0)
+            z_sini = np.where(zr > 0, -cosnu**2*sini/zr/r_star, 0)
+        f_nu = f_z*z_nu
+        # Partial derivative w.r.t. r_star at fixed b including sini(r_star)
+        f_r = f_z*(-z/r_star - z_sini*b**2*r_star/sini)
+        d = {'T_0': -f_nu*2*np.pi/P,
+             'P': -f_nu*nu/P,
+             'D': (f_k - f_r*r_star*(1+k)/q)/(2*k),
+             'W': f_r*r_star/W,
+             'b': f_r*r_star*b/q - f_z*z_sini*b*r_star**2/sini,
+             'h_1': -f_c - f_a/(c2*np.log(2)),
+             'h_2': f_c + f_a*(1/c2 - 1/h_2)/np.log(2)}
+        for n in names:
+            if n[len(p):] in d:
+                jac[n] = d[n[len(p):]]
+        return f, jac
+
     def _set_paramhints_prefix(self):
         self.set_param_hint('P', min=1e-15)
         self.set_param_hint('D', min=0, max=0.25)
@@ -375,7 +1976,7 @@ class TransitModel(Model):
 
 #----------------------
 
-class EclipseModel(Model):
+class EclipseModel(_ModelDtype):
     r"""Light curve model for the eclipse by a spherical star of a spherical
     body (planet) with no limb darkening.
 
@@ -412,12 +2013,21 @@ class EclipseModel(Model):
     :param f_s: - sqrt(ecc).sin(omega)
     :param a_c: - correction for light travel time across the orbit
 
+    The light curve can be integrated over the exposure time for points close
+    to the contact points using the keyword arguments exptime and supersample,
+    and evaluated in single precision with dtype=np.float32, as for
+    TransitModel. Orbital phase terms for fits with a fixed ephemeris are
+    cached as described for TransitModel.
+
     """
 
     def __init__(self, independent_vars=['t'], prefix='', nan_policy='raise',
-                 **kwargs):
+                 exptime=0, supersample=1, dtype=np.float64, **kwargs):
         kwargs.update({'prefix': prefix, 'nan_policy': nan_policy,
                        'independent_vars': independent_vars})
+        self.exptime = exptime
+        self.supersample = supersample
+        self.dtype = dtype
 
         def _eclipse_func(t, T_0, P, D, W, b, L, f_c, f_s, a_c):
             if (D <= 0) or (D > 0.25) or (W <= 0) or (b < 0):
@@ -436,14 +2046,40 @@ class EclipseModel(Model):
             ecc = f_c**2 + f_s**2
             if ecc > 0.95 : return np.ones_like(t)
             om = np.arctan2(f_s, f_c)*180/np.pi
-            z,m = t2z(t-a_c, T_0, P, sini, r_star, ecc, om, returnMask=True)
-            # Set z values where star is behind planet to a large nominal value
-            z[~m]  = 100
-            return 1 + L*(ueclipse(z, k)-1)
+            g = OrbitGeometry(t, T_0, P, sini, r_star, ecc, om, a_c)
+            fl = _eclipse_flux(g, k, self.exptime, self.supersample,
+                    self.dtype)
+            return 1 + L*(fl-1)
 
         super(EclipseModel, self).__init__(_eclipse_func, **kwargs)
         self._set_paramhints_prefix()
 
+    def jacobian(self, params, t, names=None):
+        """
+        Light curve and its partial derivatives w.r.t. the model parameters
+
+        The partial derivative w.r.t. L is calculated analytically. Other
+        partial derivatives are calculated numerically.
+
+        :param params: lmfit Parameters object
+        :param t: array of times
+        :param names: names of the parameters (including prefix) for which
+          partial derivatives are required. Default is all parameters.
+
+        :returns: flux, dict of partial derivatives keyed by parameter name
+
+        """
+        if names is None:
+            names = self.param_names
+        t = np.asarray(t, dtype=float)
+        kw = self.make_funcargs(params)
+        f = self.func(t, **kw)
+        L = self.prefix+'L'
+        jac = _numeric_partials(self, params, t, [n for n in names if n!=L])
+        if L in names:
+            jac[L] = (f-1)/kw['L'] if kw['L'] > 0 else np.zeros_like(f)
+        return f, jac
+
     def _set_paramhints_prefix(self):
         self.set_param_hint('P', min=1e-15)
         self.set_param_hint('D', min=0, max=0.25)
@@ -465,7 +2101,7 @@ class EclipseModel(Model):
 
 #----------------------
 
-class FactorModel(Model):
+class FactorModel(_PicklableModel):
     r"""Flux scaling and trend factor model
 
     f = c*(1 + dfdt*dt + d2fdt2*dt**2 + dfdbg*bg(t)  + dfdcontam*contam(t) +
@@ -487,46 +2123,52 @@ class FactorModel(Model):
     The time trend decribed by dfdt and d2fdt2 is calculated using the
     variable dt = t - median(t).
 
+    Harmonics of the roll angle higher than 3 can be included using the
+    keyword argument nphi, e.g., nphi=5 adds the coefficients dfdsin4phi,
+    dfdcos4phi, dfdsin5phi and dfdcos5phi to the model.
+
+    The functions dx(t), dy(t), etc. are evaluated once for each array of
+    times and the results are stored as the rows of a design matrix, so the
+    trend for a given set of coefficients is calculated as a single
+    matrix-vector product. The design matrices for the most recently used
+    arrays of times are kept in a cache, so the functions are only called
+    again for a new array of times, e.g., to predict the trend at times
+    different from the times of observation. The cache is keyed on the
+    values of the times, so an array of times modified in-place is treated
+    as a new array.
+
     """
 
     def __init__(self, independent_vars=['t'], prefix='', nan_policy='raise',
                  dx=None, dy=None, sinphi=None, cosphi=None, bg=None,
-                 contam=None,  **kwargs):
+                 contam=None, nphi=3, **kwargs):
         kwargs.update({'prefix': prefix, 'nan_policy': nan_policy,
                        'independent_vars': independent_vars})
-
-        def factor(t, c=1.0,dfdt=0, d2fdt2=0, dfdbg=0, dfdcontam=0,
-                dfdx=0, dfdy=0, d2fdxdy=0, d2fdx2=0, d2fdy2=0,
-                dfdcosphi=0, dfdsinphi=0, dfdcos2phi=0, dfdsin2phi=0,
-                dfdcos3phi=0, dfdsin3phi=0):
-
-            dt = t - np.median(t)
-            trend = 1 + dfdt*dt + d2fdt2*dt**2 
-            if dfdbg != 0:
-                trend += dfdbg*self.bg(t)
-            if dfdcontam != 0:
-                trend += dfdcontam*self.contam(t)
-            if dfdx != 0 or d2fdx2 != 0:
-                trend += dfdx*self.dx(t) + d2fdx2*self.dx(t)**2
-            if dfdy != 0 or d2fdy2 != 0:
-                trend += dfdy*self.dy(t) + d2fdy2*self.dy(t)**2
-            if d2fdxdy != 0 :
-                trend += d2fdxdy*self.dx(t)*self.dy(t)
-            if (dfdsinphi != 0 or dfdsin2phi != 0 or dfdsin3phi != 0 or
-                dfdcosphi != 0 or dfdcos2phi != 0 or dfdcos3phi != 0):
-                sinphit = self.sinphi(t)
-                cosphit = self.cosphi(t)
-                trend += dfdsinphi*sinphit + dfdcosphi*cosphit
-                if dfdsin2phi != 0:
-                    trend += dfdsin2phi*(2*sinphit*cosphit)
-                if dfdcos2phi != 0:
-                    trend += dfdcos2phi*(2*cosphit**2 - 1)
-                if dfdsin3phi != 0:
-                    trend += dfdsin3phi*(3*sinphit - 4* sinphit**3)
-                if dfdcos3phi != 0:
-                    trend += dfdcos3phi*(4*cosphit**3 - 3*cosphit)
-
-            return c*trend
+        self.nphi = max(3, int(nphi))
+        names = ['dfdt', 'd2fdt2', 'dfdbg', 'dfdcontam',
+                'dfdx', 'dfdy', 'd2fdxdy', 'd2fdx2', 'd2fdy2']
+        for n in range(1, self.nphi+1):
+            s = '' if n == 1 else str(n)
+            names += ['dfdcos{}phi'.format(s), 'dfdsin{}phi'.format(s)]
+        self._coeff_names = names
+        self._design_cache = OrderedDict()
+
+        def factor(t, c=1.0, **coeffs):
+            v = np.array([coeffs.get(n, 0) for n in self._coeff_names],
+                    dtype=float)
+            if not v.any():
+                return c*np.ones_like(t, dtype=float)
+            B, ok = self._design(t)
+            if not ok[v != 0].all():
+                n = [n for n,vi,o in zip(names,v,ok) if vi != 0 and not o]
+                raise ValueError('No function for {}'.format(', '.join(n)))
+            return c*(1 + v @ B)
+
+        # Signature of factor() used by lmfit to find the parameter names
+        P_ = inspect.signature(factor).parameters
+        factor.__signature__ = inspect.Signature([P_['t'], P_['c']] + 
+                [inspect.Parameter(n, inspect.Parameter.POSITIONAL_OR_KEYWORD,
+                    default=0) for n in names])
 
         super(FactorModel, self).__init__(factor, **kwargs)
 
@@ -537,12 +2179,129 @@ class FactorModel(Model):
         self.sinphi = sinphi
         self.cosphi = cosphi
         self.set_param_hint('c', min=0)
-        for p in ['dfdt', 'd2fdt2', 'dfdbg', 'dfdcontam',
-                  'dfdx', 'dfdy', 'd2fdx2', 'd2fdxdy',  'd2fdy2', 
-                  'dfdsinphi', 'dfdcosphi', 'dfdcos2phi', 'dfdsin2phi',
-                  'dfdcos3phi', 'dfdsin3phi']:
+        for p in names:
             self.set_param_hint(p, value=0, vary=False)
 
+    def _design(self, t):
+        # Design matrix with one row per detrending coefficient in the order
+        # given by self._coeff_names for the array of times t, and a
+        # boolean array that is False for rows that cannot be calculated
+        # because the function required is not available. 
+        t = np.asarray(t)
+        key = _array_key(t)
+        try:
+            self._design_cache.move_to_end(key)
+            return self._design_cache[key]
+        except KeyError:
+            pass
+        B = np.zeros((len(self._coeff_names), len(t)))
+        ok = np.zeros(len(self._coeff_names), dtype=bool)
+        row = dict(zip(self._coeff_names, range(len(B))))
+        def _set(name, x):
+            B[row[name]] = x
+            ok[row[name]] = True
+        dt = t - np.median(t)
+        _set('dfdt', dt)
+        _set('d2fdt2', dt**2)
+        if self.bg is not None:
+            _set('dfdbg', self.bg(t))
+        if self.contam is not None:
+            _set('dfdcontam', self.contam(t))
+        if self.dx is not None:
+            dx = self.dx(t)
+            _set('dfdx', dx)
+            _set('d2fdx2', dx**2)
+        if self.dy is not None:
+            dy = self.dy(t)
+            _set('dfdy', dy)
+            _set('d2fdy2', dy**2)
+        if (self.dx is not None) and (self.dy is not None):
+            _set('d2fdxdy', dx*dy)
+        if (self.sinphi is not None) and (self.cosphi is not None):
+            s1 = self.sinphi(t)
+            c1 = self.cosphi(t)
+            _set('dfdsinphi', s1)
+            _set('dfdcosphi', c1)
+            _set('dfdsin2phi', 2*s1*c1)
+            _set('dfdcos2phi', 2*c1**2 - 1)
+            _set('dfdsin3phi', 3*s1 - 4*s1**3)
+            _set('dfdcos3phi', 4*c1**3 - 3*c1)
+            # Higher harmonics from the recurrence relations
+            # sin(n.phi) = 2.cos(phi).sin((n-1).phi) - sin((n-2).phi), etc.
+            for n in range(4, self.nphi+1):
+                for f in ('sin', 'cos'):
+                    fn = 'dfd{}{}phi'.format
+                    _set(fn(f, n), 2*c1*B[row[fn(f, n-1)]] - 
+                            B[row[fn(f, n-2)]])
+        self._design_cache[key] = (B, ok)
+        if len(self._design_cache) > 4:
+            self._design_cache.popitem(last=False)
+        return B, ok
+
+    def _basis(self, t, name):
+        # Function multiplying the detrending coefficient name in the trend
+        if name not in self._coeff_names:
+            raise ValueError('No detrending coefficient {}'.format(name))
+        B, ok = self._design(t)
+        i = self._coeff_names.index(name)
+        if not ok[i]:
+            raise ValueError('No function for {}'.format(name))
+        return B[i]
+
+    def jacobian(self, params, t, names=None):
+        """
+        Model and its partial derivatives w.r.t. the model parameters
+
+        The model is linear in all its parameters so the partial derivatives
+        are calculated exactly.
+
+        :param params: lmfit Parameters object
+        :param t: array of times
+        :param names: names of the parameters (including prefix) for which
+          partial derivatives are required. Default is all parameters.
+
+        :returns: flux, dict of partial derivatives keyed by parameter name
+
+        """
+        if names is None:
+            names = self.param_names
+        t = np.asarray(t, dtype=float)
+        kw = self.make_funcargs(params)
+        c = kw.pop('c')
+        f = self.func(t, c=1.0, **kw)
+        jac = {}
+        for n in names:
+            arg = n[len(self.prefix):]
+            jac[n] = f if arg == 'c' else c*self._basis(t, arg)
+        return c*f, jac
+
+    def eval_batch(self, theta, t):
+        """
+        Evaluate the model for many sets of parameters in one call
+
+        The columns of theta are the parameters c, dfdt, d2fdt2, etc. in the
+        order given by self.param_names. The trends for all parameter sets
+        are calculated as a single matrix product with the design matrix.
+
+        :param theta: array of parameter values, shape (nsets, nparams)
+        :param t: array of times
+
+        :returns: array of fluxes, shape (nsets, len(t))
+
+        """
+        theta = np.atleast_2d(np.asarray(theta, dtype=float))
+        t = np.asarray(t)
+        c = theta[:,:1]
+        v = theta[:,1:]
+        if not v.any():
+            return c*np.ones(len(t))
+        B, ok = self._design(t)
+        bad = (v != 0).any(axis=0) & ~ok
+        if bad.any():
+            n = [n for n, b in zip(self._coeff_names, bad) if b]
+            raise ValueError('No function for {}'.format(', '.join(n)))
+        return c*(1 + v @ B)
+
     def guess(self, data, **kwargs):
         r"""Estimate initial model parameter values from data."""
         pars = self.make_params()
@@ -560,7 +2319,7 @@ class FactorModel(Model):
 
 #----------------------
 
-class ThermalPhaseModel(Model):
+class ThermalPhaseModel(_PicklableModel):
     r"""Thermal phase model for a tidally-locked planet
 
     .. math::
@@ -615,7 +2374,7 @@ class ThermalPhaseModel(Model):
 
 #----------------------
 
-class ReflectionModel(Model):
+class ReflectionModel(_PicklableModel):
     r"""Reflected stellar light from a planet with a Lambertian phase function.
 
     The fraction of the stellar flux reflected from the planet of radius
@@ -648,11 +2407,11 @@ class ReflectionModel(Model):
             ecc = f_c**2 + f_s**2
             if ecc > 0.95 : return np.zeros_like(t)
             om = np.arctan2(f_s, f_c)*180/np.pi
-            x,y,z = xyz_planet(t, T_0, P, sini, ecc, om)
-            r = np.sqrt(x**2+y**2+z**2)
-            beta = np.arccos(-z/r)
+            # z is not used so rstar is arbitrary
+            g = OrbitGeometry(t, T_0, P, sini, 1, ecc, om)
+            beta = g.beta
             Phi_L = (np.sin(beta) + (np.pi-beta)*np.cos(beta) )/np.pi
-            return A_g*(r_p/r)**2*Phi_L
+            return A_g*(r_p/g.r)**2*Phi_L
 
         super(ReflectionModel, self).__init__(_reflection, **kwargs)
         self._set_paramhints_prefix()
@@ -670,7 +2429,7 @@ class ReflectionModel(Model):
 
 #----------------------
 
-class RVModel(Model):
+class RVModel(_PicklableModel):
     r"""Radial velocity in a Keplerian orbit
 
     :param t:    - independent variable (time)
@@ -716,7 +2475,7 @@ class RVModel(Model):
 
 #----------------------
 
-class RVCompanion(Model):
+class RVCompanion(_PicklableModel):
     r"""Radial velocity in a Keplerian orbit for the companion
 
 
@@ -761,7 +2520,7 @@ class RVCompanion(Model):
 
 #----------------------
 
-class PlanetModel(Model):
+class PlanetModel(_ModelDtype):
     r"""Light curve model for a transiting exoplanet including transits,
     eclipses, and a thermal phase curve for the planet with an offset.
 
@@ -824,12 +2583,20 @@ class PlanetModel(Model):
     :param h_2:    - I(0.5) - I(0) = c*0.5**alpha
     :param a_c:    - correction for light travel time across the orbit
 
+    The light curve is returned in single precision if the keyword argument
+    dtype=np.float32 is used. The error is less than 2e-7 of the stellar flux
+    for double-precision input times, cf. TransitModel. The transit light
+    curve is interpolated from a table of values with accuracy ztol if this
+    keyword argument is set, as for TransitModel.
+
     """
 
     def __init__(self, independent_vars=['t'], prefix='', nan_policy='raise',
-                 **kwargs):
+                 dtype=np.float64, ztol=None, **kwargs):
         kwargs.update({'prefix': prefix, 'nan_policy': nan_policy,
                        'independent_vars': independent_vars})
+        self.dtype = dtype
+        self.ztol = ztol
 
         def _planet_func(t, T_0, P, D, W, b, F_min, F_max, ph_off, f_c, f_s,
                 h_1, h_2, a_c):
@@ -856,20 +2623,18 @@ class PlanetModel(Model):
             ecc = f_c**2 + f_s**2
             if ecc > 0.95 : return np.ones_like(t)
             om = np.arctan2(f_s, f_c)*180/np.pi
-            # Star-planet apparent separation and mask eclipses/transits
-            z,m = t2z(t, T_0, P, sini, r_star, ecc, om, returnMask=True)
-            # Set z values where planet is behind star  1 to a large nominal
-            # value for calculation of the transit
-            zt = z + 0   # copy 
-            zt[m] = 100
+            # Orbit geometry shared by the transit and the eclipse
+            g = OrbitGeometry(t, T_0, P, sini, r_star, ecc, om)
+            _solve_shared(g, k)
             # Flux from the star including transits
-            f_star = qpower2(zt, k, c2, a2)
+            f_star = _transit_flux(g, k, c2, a2, dtype=self.dtype,
+                    ztol=self.ztol)
             # thermal phase effect
             A = F_max - F_min
-            f_th = F_min + A*(1-np.cos(2*np.pi*((t-T_0)/P-ph_off)))/2
+            f_th = F_min + A*(1-np.cos(2*np.pi*((g.t-T_0)/P-ph_off)))/2
+            f_th = f_th.astype(self.dtype, copy=False)
             # Flux from planet including eclipses
-            z[~m]  = 100
-            f_planet = f_th * ueclipse(z, k)
+            f_planet = f_th * _eclipse_flux(g, k, dtype=self.dtype)
             return f_star + f_planet
 
         super(PlanetModel, self).__init__(_planet_func, **kwargs)
@@ -898,7 +2663,7 @@ class PlanetModel(Model):
 
 #----------------------
 
-class EBLMModel(Model):
+class EBLMModel(_ModelDtype):
     r"""Light curve model for the mutual eclipses by spherical stars in an
     eclipsing binary with one low-mass companion, e.g., F/G-star + M-dwarf.
 
@@ -934,12 +2699,21 @@ class EBLMModel(Model):
     :param h_2:  - I(0.5) - I(0) = c*0.5**alpha
     :param a_c: - correction for light travel time across the orbit
 
+    The light curve can be integrated over the exposure time for points close
+    to the contact points using the keyword arguments exptime and supersample,
+    and evaluated in single precision with dtype=np.float32, as for
+    TransitModel. Orbital phase terms for fits with a fixed ephemeris are
+    cached as described for TransitModel.
+
     """
 
     def __init__(self, independent_vars=['t'], prefix='', nan_policy='raise',
-                 **kwargs):
+                 exptime=0, supersample=1, dtype=np.float64, **kwargs):
         kwargs.update({'prefix': prefix, 'nan_policy': nan_policy,
                        'independent_vars': independent_vars})
+        self.exptime = exptime
+        self.supersample = supersample
+        self.dtype = dtype
 
         def _eblm_func(t, T_0, P, D, W, b, L, f_c, f_s, h_1, h_2, a_c):
             if (D <= 0) or (D > 0.25) or (W <= 0) or (b < 0):
@@ -964,16 +2738,14 @@ class EBLMModel(Model):
             ecc = f_c**2 + f_s**2
             if ecc > 0.95 : return np.ones_like(t)
             om = np.arctan2(f_s, f_c)*180/np.pi
-            z,m = t2z(t, T_0, P, sini, r_star, ecc, om, returnMask=True)
-            # Set z values where star 2 is behind star  1 to a large nominal
-            # value for calculation of the transit
-            z[m] = 100
-            lc =  qpower2(z, k, c2, a2)
-            z,m = t2z(t-a_c, T_0, P, sini, r_star, ecc, om, returnMask=True)
-            # Set z values where star  1 is behind star 2 to a large nominal
-            # value for calculation of the eclipse
-            z[~m]  = 100
-            return (lc + L*ueclipse(z, k))/(1+L)
+            # Orbit geometry shared by the transit and the eclipse
+            g = OrbitGeometry(t, T_0, P, sini, r_star, ecc, om, a_c)
+            _solve_shared(g, k, self.exptime, self.supersample)
+            lc = _transit_flux(g, k, c2, a2, self.exptime, self.supersample,
+                    self.dtype)
+            fl = _eclipse_flux(g, k, self.exptime, self.supersample,
+                    self.dtype)
+            return (lc + L*fl)/(1+L)
 
         super(EBLMModel, self).__init__(_eblm_func, **kwargs)
         self._set_paramhints_prefix()
@@ -1005,10 +2777,24 @@ class Priors(OrderedDict):
 
     All values of a Priors() instance must be Prior objects.
 
-    A Priors() instance includes an asteval interpreter used for
-    evaluation of constrained Parameters.
-
-    ToDo: copying, pickling and serialization
+    Each prior expression is compiled once to a Python function when the
+    Prior is added. The hyper-parameters of the Prior and the symbols of an
+    :class:`asteval.Interpreter`, e.g., pi or log, are bound to the function
+    at the same time, so evaluating the log-prior only requires the values
+    of the model parameters. Expressions are restricted to arithmetic,
+    comparisons and calls to these symbols.
+
+    The parameter values can be scalars or arrays, so the log-prior for a
+    batch of parameter sets, e.g., all the walkers in an emcee ensemble, is
+    evaluated with a single call to log_prior().
+
+    Example
+    -------
+    >>> priors = Priors()
+    >>> priors.add('D', '-0.5*((D-mu)/sigma)**2', {'mu':0.01, 'sigma':0.001})
+    >>> priors.add('b', 'log(1-b**2)')
+    >>> priors.log_prior({'D':np.array([0.01,0.011]), 'b':np.array([0,0.5])})
+    array([ 0.        , -0.78768207])
 
     """
 
@@ -1016,15 +2802,189 @@ class Priors(OrderedDict):
         """
         Arguments
         ---------
-        usersyms : dictionary of symbols to add to the
+        usersyms : dictionary of symbols to add to the symbols of the
             :class:`asteval.Interpreter`.
 
         """
 
-        super(Parameters, self).__init__(self)
-        self._asteval = Interpreter(usersyms=usersyms)
+        super(Priors, self).__init__()
+        self._usersyms = usersyms
+        self._symbols = dict(Interpreter().symtable)
+        if usersyms is not None:
+            self._symbols.update(usersyms)
+        self._compiled = {}
+
+    def __setitem__(self, key, prior):
+        if not isinstance(prior, Prior):
+            raise ValueError("'{}' is not a Prior".format(prior))
+        if not valid_symbol_name(key):
+            raise KeyError("'{}' is not a valid Prior name".format(key))
+        prior.name = key
+        self._compiled[key] = self._compile(prior)
+        super(Priors, self).__setitem__(key, prior)
+
+    def __delitem__(self, key):
+        super(Priors, self).__delitem__(key)
+        del self._compiled[key]
+
+    def __reduce__(self):
+        # The symbols and the compiled expressions are rebuilt by
+        # __setitem__ for each item when the object is unpickled or copied.
+        return (self.__class__, (self._usersyms,), None, None,
+                iter(self.items()))
+
+    def _compile(self, prior):
+        # Compile expr to a Python function of the parameter values with the
+        # hyper-parameters and the built-in symbols, e.g., pi or log, bound
+        # in the namespace of the function. The function does not change
+        # any shared state, so it can be called from more than one thread.
+        if not isinstance(prior.expr, str):
+            raise ValueError("Prior {} has no expression".format(prior.name))
+        try:
+            node = ast.parse(prior.expr.strip(), mode='eval')
+        except SyntaxError:
+            node = None
+        if node is None or not all(isinstance(x, _EXPR_NODES)
+                for x in ast.walk(node)):
+            raise ValueError("Invalid expression for Prior {}: {}".format(
+                prior.name, prior.expr))
+        hyper = dict(prior.hyper) if prior.hyper is not None else {}
+        names = [n for n in OrderedDict.fromkeys(get_ast_names(node))
+                if n not in hyper]
+        # Names of symbols that must be supplied as parameter values, i.e.,
+        # everything that is not a hyper-parameter or a built-in symbol,
+        # unless it is the name of the Prior. Parameter values take
+        # precedence over built-in symbols with the same name.
+        required = [n for n in names
+                if n not in self._symbols or n == prior.name]
+        optional = [n for n in names if n not in required]
+        ns = dict(self._symbols)
+        ns.update(hyper)
+        ns['__builtins__'] = {}
+        code = 'lambda {}: ({})'.format(', '.join(required + optional),
+                prior.expr.strip())
+        func = eval(compile(code, '<Prior {}>'.format(prior.name), 'eval'), ns)
+        func.__defaults__ = tuple(self._symbols[n] for n in optional)
+
+        def _log_prior(values):
+            kw = {}
+            for n in names:
+                if n in values:
+                    v = values[n]
+                    kw[n] = getattr(v, 'value', v)
+                elif n in required:
+                    raise KeyError("Prior {} requires a value for {}".format(
+                        prior.name, n))
+            return func(**kw)
+
+        _log_prior.names = required
+        return _log_prior
+
+    def add(self, name, expr=None, hyper=None):
+        """
+        Add a Prior
 
+        Arguments
+        ---------
+        name : str or Prior
+            Name of the Parameter to which the Prior is applied, or a Prior
+            object.
+        expr : str
+            Mathematical expression used to evaluate the prior log-value
+        hyper : dict
+            A dictionary of hyper-parameters.
+
+        """
+        if isinstance(name, Prior):
+            self.__setitem__(name.name, name)
+        else:
+            self.__setitem__(name, Prior(name, expr, hyper))
+
+    @property
+    def names(self):
+        """Names of the parameters required to evaluate the priors"""
+        names = []
+        for key in self:
+            names += self._compiled[key].names
+        return list(OrderedDict.fromkeys(names))
+
+    def log_priors(self, values):
+        """
+        Log-value of each prior 
+
+        Arguments
+        ---------
+        values : dict or lmfit Parameters 
+            Values of the parameters named in the prior expressions. Values
+            can be scalars or arrays of the same shape.
+
+        Returns
+        -------
+        list of the log-prior values in the order of the Priors
+
+        """
+        return [self._compiled[key](values) for key in self]
 
+    def log_prior(self, values):
+        """
+        Sum of the log-values of all the priors
+
+        Values of the log-prior that are not finite, e.g., NaN for parameter
+        values outside the domain of a function in the expression, are
+        replaced by -inf.
+
+        Arguments
+        ---------
+        values : dict or lmfit Parameters 
+            Values of the parameters named in the prior expressions. Values
+            can be scalars or arrays of the same shape.
+
+        Returns
+        -------
+        log-prior value, float or array with the same shape as the input
+        values
+
+        """
+        lp = 0.0
+        with np.errstate(all='ignore'):
+            for key in self:
+                lp = lp + self._compiled[key](values)
+        lp = np.where(np.isfinite(lp), lp, -np.inf)
+        return lp if lp.ndim > 0 else float(lp)
+
+    __call__ = log_prior
+
+    def residual(self, values):
+        """
+        Priors as residuals for least-squares fitting
+
+        The residual for a prior with log-value lnp is sqrt(-2*lnp), so the
+        sum of the squared residuals is -2 times the log-prior. This requires
+        that the log-value of each prior is not greater than 0, e.g., the
+        log-prior for a Gaussian should be -0.5*((x-mu)/sigma)**2. A
+        ValueError is raised if the log-value of a prior is greater than 0 or
+        is not finite.
+
+        Arguments
+        ---------
+        values : dict or lmfit Parameters 
+            Values of the parameters named in the prior expressions.
+
+        Returns
+        -------
+        array of residuals, one per prior
+
+        """
+        with np.errstate(all='ignore'):
+            lp = np.array([self._compiled[key](values) for key in self],
+                    dtype=float)
+        for key, v in zip(self, lp):
+            if not np.isfinite(v):
+                raise ValueError("Log-value of Prior {} is {}".format(key, v))
+            if v > 0:
+                raise ValueError("Log-value of Prior {} is greater than 0, "
+                        "{}".format(key, v))
+        return np.sqrt(-2*lp)
 
 
 #----------------------
@@ -1039,9 +2999,13 @@ class Prior(object):
     given parameter value is evaluated using the mathemetical expression
     provided in `expr`, e.g., for a Gaussian with mean mu and standard
     deviation sigma, the contribution to the total log-likelihood for a
-    parameter with value x is -0.5*(mu-x)**2/sigma**2. The constants mu and
-    sigma are hyper-parameters, i.e., parameters of the prior model, not of
-    the data model.
+    parameter x is -0.5*(mu-x)**2/sigma**2. The constants mu and sigma are
+    hyper-parameters, i.e., parameters of the prior model, not of the data
+    model.
+
+    The expression can refer to the values of other parameters by name, so
+    joint priors on more than one parameter are also possible. Hyper-parameters
+    take precedence over parameters with the same name.
 
     """
 
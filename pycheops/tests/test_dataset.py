@@ -0,0 +1,316 @@
+from unittest import TestCase, mock, skipIf
+import os
+from multiprocessing import get_context
+import tempfile
+
+import numpy as np
+from scipy.stats import norm, truncnorm
+from uncertainties import ufloat
+
+import pycheops.models as models
+import pycheops.dataset as dataset
+from pycheops.dataset import Dataset, _log_posterior, _log_posterior_batch
+from pycheops.dataset import _LogPosterior
+
+def _dataset(n=400, seed=1):
+    # Dataset with a simulated light curve, i.e., without CHEOPS data files
+    rng = np.random.default_rng(seed)
+    t = np.linspace(-0.25, 0.25, n)
+    tm = models.TransitModel()
+    p = tm.make_params(T_0=0.01, P=3, D=0.008, W=0.04, b=0.4, h_1=0.72,
+                       h_2=0.67, f_c=0, f_s=0)
+    x = rng.normal(0, 0.01, n).cumsum()
+    y = np.sin(20*t)
+    flux = tm.eval(p, t=t)*(1 + 1e-4*x/np.ptp(x)) + rng.normal(0, 2e-4, n)
+    d = object.__new__(Dataset)
+    d.lc = {'time':t, 'flux':flux, 'flux_err':np.full(n, 2e-4), 'xoff':x,
+            'yoff':y, 'roll_angle':np.linspace(0, 2880, n) % 360,
+            'bg':np.abs(y)+1, 'contam':0.01+0.001*y}
+    d.lmfit_transit(T_0=(-0.05, 0, 0.05), P=3, D=(0, 0.008, 0.02),
+                    W=(0.02, 0.04, 0.06), b=(0, 0.4, 0.9), dfdx=(-1, 1))
+    return d
+
+class TestLinear(TestCase):
+
+    def test_lmfit_linear(self):
+        # Solving for the detrending coefficients by linear least-squares
+        # gives the same best fit as varying them with the other parameters
+        d = _dataset()
+        kw = dict(T_0=(-0.05, 0, 0.05), P=3, D=(0, 0.008, 0.02),
+                  W=(0.02, 0.04, 0.06), b=(0, 0.4, 0.9), dfdx=(-1, 1),
+                  dfdt=(-1, 1))
+        r_0 = d.lmfit_transit(**kw)
+        r_1 = d.lmfit_transit(linear=True, **kw)
+        for n in ('T_0', 'D', 'W', 'b', 'c', 'dfdx', 'dfdt'):
+            p_0, p_1 = r_0.params[n], r_1.params[n]
+            assert abs(p_1.value - p_0.value) < 0.001*p_0.stderr
+            # Standard errors of the linear parameters are conditional on
+            # the values of the other parameters
+            if n not in ('dfdx', 'dfdt'):
+                assert np.isclose(p_1.stderr, p_0.stderr, rtol=0.01)
+
+    def test_marginalise(self):
+        # Analytic marginal likelihood for one linear parameter with a flat
+        # prior compared to the numerical integral over this parameter
+        d = _dataset()
+        t, flux = d.lc['time'], d.lc['flux']
+        flux_err = d.lc['flux_err']
+        model = models.TransitModel()*models.FactorModel()
+        params = model.make_params(T_0=0.01, P=3, D=0.008, W=0.04, b=0.4,
+                                   f_c=0, f_s=0, h_1=0.72, h_2=0.67, c=1,
+                                   dfdt=0)
+        params['dfdt'].set(vary=True, min=-np.inf, max=np.inf)
+        params.add('log_sigma', value=np.log(1e-4))
+        vn = ['D', 'W', 'b']
+        pos = np.array([0.008, 0.04, 0.4])
+        ev = models._ModelEvaluator(model, params, vn, t, ['dfdt'])
+        lp = _log_posterior(pos, ev, flux, flux_err, None, False,
+                            marginalise=True)
+        ev = models._ModelEvaluator(model, params, vn+['dfdt'], t)
+        grid = np.linspace(-0.005, 0.005, 4001)
+        lp_a = [_log_posterior(np.append(pos, v), ev, flux, flux_err, None,
+                               False) for v in grid]
+        lp_a = np.array(lp_a)
+        lp_max = lp_a.max()
+        h = grid[1] - grid[0]
+        lp_num = lp_max + np.log(h*np.sum(np.exp(lp_a - lp_max)))
+        assert np.exp(lp_a[[0, -1]] - lp_max).max() < 1e-12
+        assert np.isclose(lp, lp_num, rtol=0, atol=1e-6)
+
+class TestJacobian(TestCase):
+
+    def test_lmfit(self):
+        # Analytic and numerical derivatives give the same best fit, with
+        # and without linear parameters and priors in a Priors object
+        d = _dataset()
+        t = d.lc['time']
+        em = models.EclipseModel()
+        # Eclipse at T_0 + P/2
+        p = em.make_params(T_0=-1.49, P=3, D=0.008, W=0.04, b=0.4, L=2e-3,
+                           f_c=0, f_s=0, a_c=0)
+        rng = np.random.default_rng(2)
+        flux_ecl = em.eval(p, t=t) + rng.normal(0, 2e-4, len(t))
+        priors = models.Priors()
+        priors.add('b', 'log(1-b**2)')
+        priors.add('aR', '-0.5*((aR-mu)/sigma)**2', {'mu':25, 'sigma':2})
+        kw = dict(T_0=(-0.05, 0, 0.05), P=3, D=(0, 0.008, 0.02),
+                  W=(0.02, 0.04, 0.06), b=(0, 0.4, 0.9), dfdx=(-1, 1),
+                  dfdt=ufloat(0, 1e-3))
+        for method in ('lmfit_transit', 'lmfit_eclipse'):
+            if method == 'lmfit_eclipse':
+                d.lc['flux'] = flux_ecl
+                kw.update(T_0=(-1.55, -1.5, -1.45), D=0.008,
+                          L=(0, 2e-3, 0.01))
+            fit = getattr(d, method)
+            for linear in (False, True):
+                r_0 = fit(jacobian=False, linear=linear, priors=priors, **kw)
+                r_1 = fit(jacobian=True, linear=linear, priors=priors, **kw)
+                assert r_1.nfev < r_0.nfev
+                assert r_1.npriors == r_0.npriors == 3
+                assert np.isclose(r_1.chisqr, r_0.chisqr, rtol=1e-6)
+                for n in r_0.var_names:
+                    p_0, p_1 = r_0.params[n], r_1.params[n]
+                    assert abs(p_1.value - p_0.value) < 0.01*p_0.stderr
+
+    def test_jacobian(self):
+        # Analytic derivatives of the eclipse model, the Gaussian prior on
+        # a constrained parameter and the priors in a Priors object compared
+        # to numerical derivatives of the residuals
+        d = _dataset()
+        t, flux, flux_err = d.lc['time'], d.lc['flux'], d.lc['flux_err']
+        model = models.EclipseModel()*models.FactorModel()
+        params = model.make_params(T_0=-1.49, P=3, D=0.008, W=0.04, b=0.4,
+                                   L=2e-3, f_c=0, f_s=0, a_c=0, c=1, dfdt=0)
+        for n in ('T_0', 'D', 'W', 'b', 'L', 'c', 'dfdt'):
+            params[n].set(vary=True)
+        params.add('aR', expr='sqrt((1+sqrt(D))**2-b**2)/W/pi')
+        params['aR'].user_data = ufloat(25, 2)
+        priors = models.Priors()
+        priors.add('b', 'log(1-b**2)')
+        priors.add('L', '-0.5*((L/D-mu)/sigma)**2', {'mu':0.2, 'sigma':0.05})
+        def _residual(pars):
+            r = (flux - model.eval(pars, t=t))/flux_err
+            u = pars['aR'].user_data
+            r = np.append(r, (u.n - pars['aR'].value)/u.s)
+            return np.append(r, priors.residual(pars.valuesdict()))
+        J = dataset._chisq_prior_jacobian(params, model, t, flux, flux_err,
+                                          priors=priors)
+        vn = [n for n in params if params[n].vary]
+        assert J.shape == (len(t)+3, len(vn))
+        for j, n in enumerate(vn):
+            h = 1e-6*(abs(params[n].value) + 1e-3)
+            p_hi, p_lo = params.copy(), params.copy()
+            p_hi[n].value += h
+            p_lo[n].value -= h
+            p_hi.update_constraints()
+            p_lo.update_constraints()
+            dr = (_residual(p_hi) - _residual(p_lo))/(2*h)
+            assert np.allclose(J[:,j], dr, rtol=1e-4,
+                               atol=1e-4*np.max(np.abs(dr)))
+
+class TestLogPosterior(TestCase):
+
+    def test_linear_prior(self):
+        # The prior on a linear parameter applies to its optimum value, so
+        # the log-posterior does not depend on the value stored in params
+        t = np.linspace(-0.2, 0.2, 501)
+        model = models.TransitModel()*models.FactorModel()
+        rng = np.random.default_rng(1)
+        x = np.array([0.011, 0.045, 0.2])
+        lnpost = []
+        for dfdt in (2e-4, -1e-2):
+            params = model.make_params(T_0=0.01, P=3, D=0.01, W=0.04, b=0.3,
+                                       f_c=0, f_s=0, h_1=0.72, h_2=0.67,
+                                       c=1, dfdt=dfdt)
+            params.add('log_sigma', value=-9)
+            params['dfdt'].user_data = ufloat(1e-4, 1e-4)
+            ev = models._ModelEvaluator(model, params, ['D', 'W', 'b'], t,
+                                        ['dfdt'])
+            if not lnpost:
+                flux = ev.eval(ev.values(x)) + rng.normal(0, 1e-4, len(t))
+                flux_err = np.full(len(t), 1e-4)
+            lp = _log_posterior(x, ev, flux, flux_err, None, False)
+            lp_b = _log_posterior_batch(np.array([x, x]), ev, flux, flux_err,
+                                        None, False)
+            assert np.allclose(lp_b, lp, rtol=1e-12)
+            lnpost.append(lp)
+        assert np.isfinite(lnpost[0])
+        assert np.isclose(lnpost[0], lnpost[1], rtol=1e-12)
+
+    def test_prior_transform(self):
+        t = np.linspace(-0.2, 0.2, 501)
+        model = models.TransitModel()
+        params = model.make_params(T_0=0.01, P=3, D=0.01, W=0.04, b=0.3,
+                                   f_c=0, f_s=0, h_1=0.72, h_2=0.67)
+        params['D'].set(min=0.005, max=0.02)
+        params['W'].set(min=0.02, max=0.06)
+        params['T_0'].set(min=-np.inf, max=np.inf)
+        params['T_0'].user_data = ufloat(0.01, 0.001)
+        params['h_1'].set(min=0.7, max=0.9)
+        params['h_1'].user_data = ufloat(0.72, 0.05)
+        vn = ['T_0', 'D', 'W', 'b', 'h_1']
+        ev = models._ModelEvaluator(model, params, vn, t)
+        posterior = _LogPosterior((ev, None, None, None, False), {})
+        u = np.array([[0, 0, 0, 0, 0], [1, 1, 1, 1, 1],
+                      [0.5, 0.25, 0.5, 0.75, 0.5],
+                      [norm.cdf(1), 0.5, 0.5, 0.5, 0.9]])
+        x = posterior.prior_transform(u)
+        assert np.array_equal(x[0,1:4], [0.005, 0.02, 0])
+        assert np.array_equal(x[1,1:4], [0.02, 0.06, 1])
+        assert np.allclose(x[2,1:4], [0.00875, 0.04, 0.75], rtol=1e-12)
+        # Gaussian prior on T_0 and truncated Gaussian prior on h_1
+        assert x[0,0] == -np.inf and x[1,0] == np.inf
+        assert np.isclose(x[2,0], 0.01, rtol=1e-12)
+        assert np.isclose(x[3,0], 0.011, rtol=1e-12)
+        assert np.allclose(x[:2,4], [0.7, 0.9], rtol=1e-12)
+        a, b = (0.7-0.72)/0.05, (0.9-0.72)/0.05
+        h_1 = truncnorm.ppf(u[2:,4], a, b, loc=0.72, scale=0.05)
+        assert np.allclose(x[2:,4], h_1, rtol=1e-12)
+        assert np.allclose(posterior.prior_transform(u[3]), x[3], rtol=0)
+        # Parameters without a Gaussian prior must have finite bounds
+        params['b'].set(max=np.inf)
+        ev = models._ModelEvaluator(model, params, vn, t)
+        posterior = _LogPosterior((ev, None, None, None, False), {})
+        with self.assertRaises(ValueError):
+            posterior.prior_transform(u)
+
+class TestEmceeSampler(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.d = _dataset()
+        cls.kw = dict(burn=40, thin=2, nwalkers=16, checkpoint=7,
+                      progress=False)
+
+    def _sample(self, seed, **kwargs):
+        np.random.seed(seed)
+        kw = dict(self.kw, steps=20)
+        kw.update(kwargs)
+        return self.d.emcee_sampler(**kw)
+
+    def test_resume(self):
+        chain = self._sample(5).chain
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        backend = os.path.join(tmpdir.name, 'chain.dat')
+        assert np.array_equal(self._sample(5, backend=backend).chain, chain)
+        # Runs interrupted during burn-in and during sampling, resumed with
+        # a different random number seed
+        write = dataset._ChainStore.write
+        for stop in (lambda s: s.info.get('burn') == 28,
+                     lambda s: s.iteration >= 14):
+            def _write(store, **info):
+                write(store, **info)
+                if stop(store):
+                    raise KeyboardInterrupt
+            with mock.patch.object(dataset._ChainStore, 'write', _write):
+                with self.assertRaises(KeyboardInterrupt):
+                    self._sample(5, backend=backend)
+            r = self._sample(99, backend=backend, resume=True)
+            assert np.array_equal(r.chain, chain)
+        # Chain extended after it has finished
+        self._sample(5, backend=backend, steps=10)
+        r = self._sample(99, backend=backend, steps=20, resume=True)
+        assert np.array_equal(r.chain, chain)
+        # Chain for a different number of walkers, thinning or parameters
+        for kw in (dict(nwalkers=18), dict(thin=3)):
+            with self.assertRaises(ValueError):
+                self._sample(5, backend=backend, resume=True, **kw)
+        params = self.d.lmfit.params.copy()
+        params['b'].set(vary=False)
+        with self.assertRaises(ValueError):
+            self._sample(5, backend=backend, resume=True, params=params)
+
+    def test_pool(self):
+        # Walkers evaluated in parallel processes give the same chain
+        chain = self._sample(5).chain
+        r = self._sample(5, nprocs=2)
+        assert np.array_equal(r.chain, chain)
+        with get_context('spawn').Pool(2) as pool:
+            r = self._sample(5, pool=pool)
+        assert np.array_equal(r.chain, chain)
+        # Processes are started with spawn once numba has started threads
+        parallel, size = models.PARALLEL, models.PARALLEL_MIN_SIZE
+        try:
+            models.PARALLEL, models.PARALLEL_MIN_SIZE = True, 1
+            models.qpower2(np.linspace(0, 1.2, 64), 0.1, 0.6, 0.7)
+        finally:
+            models.PARALLEL, models.PARALLEL_MIN_SIZE = parallel, size
+        assert dataset._pool_context().get_start_method() == 'spawn'
+        r = self._sample(5, nprocs=2)
+        assert np.array_equal(r.chain, chain)
+
+    def test_adaptive(self):
+        nwalkers = self.kw['nwalkers']
+        r = self._sample(5, adaptive=True, ntau=10, check=50, max_steps=5000)
+        n = self.d.sampler.iteration
+        assert r.converged
+        assert n < 5000 and n % 50 == 0
+        assert r.tau.shape == (len(r.var_names),)
+        assert np.all(r.tau > 1) and 10*np.max(r.tau) < n
+        assert r.burn == int(np.ceil(2*np.max(r.tau)))
+        assert r.thin == max(1, int(0.5*np.min(r.tau)))
+        assert np.allclose(r.ess, nwalkers*(n - r.burn)/r.tau)
+        # emcee keeps every thin-th step, ending with the last one
+        m = len(range(r.burn+r.thin-1, n, r.thin))
+        assert r.chain.shape == (nwalkers*m, len(r.var_names))
+        # Chain that does not converge within max_steps
+        r = self._sample(5, adaptive=True, check=50, max_steps=200)
+        assert r.converged is False
+        assert self.d.sampler.iteration == 200
+        assert r.burn <= 100
+
+    @skipIf(dataset.dynesty is None, 'requires dynesty')
+    def test_nested(self):
+        np.random.seed(5)
+        r = self.d.nested_sampler(nlive=50, dlogz=1, progress=False)
+        assert r.method == 'nested'
+        assert np.isfinite(r.logz) and 0 < r.logzerr < 10
+        assert r.chain.shape[1] == len(r.var_names)
+        assert len(r.chain) > 50 and np.all(np.isfinite(r.chain))
+        # Samples are within the bounds of the uniform priors
+        for n, x in zip(r.var_names, r.chain.T):
+            p = r.params[n]
+            assert np.all(x >= p.min) and np.all(x <= p.max)
+        assert np.isclose(np.median(r.chain[:,r.var_names.index('D')]),
+                          0.008, rtol=0.2)
@@ -0,0 +1,584 @@
+from unittest import TestCase
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numba import jit
+
+import pycheops.models as models
+from pycheops.models import qpower2
+
+class TestQpower2(TestCase):
+
+    def test_parallel(self):
+        z = np.linspace(-1.3, 1.3, 20001)
+        k, c, a = 0.1, 0.6, 0.7
+        f_0 = qpower2(z, k, c, a)
+        parallel = models.PARALLEL
+        size = models.PARALLEL_MIN_SIZE
+        try:
+            models.PARALLEL = True
+            models.PARALLEL_MIN_SIZE = 1
+            f_1 = qpower2(z, k, c, a)
+        finally:
+            models.PARALLEL = parallel
+            models.PARALLEL_MIN_SIZE = size
+        assert np.max(np.abs(f_1 - f_0)) < 1e-12
+
+    def test_jit(self):
+        @jit(nopython=True)
+        def depth(z, k, c, a):
+            return 1 - qpower2(z, k, c, a).min()
+        z = np.linspace(-1.3, 1.3, 2001)
+        k, c, a = 0.1, 0.6, 0.7
+        assert depth(z, k, c, a) == 1 - qpower2(z, k, c, a).min()
+
+class TestTransitModel(TestCase):
+
+    def test_eval_batch(self):
+        tm = models.TransitModel()
+        t = np.linspace(-0.2, 0.2, 1001)
+        theta = np.array([[0.001, 1.3, 0.010, 0.04, 0.3, 0.0, 0.0, 0.72, 0.67],
+                          [0.000, 1.3, 0.012, 0.04, 0.5, 0.2, 0.3, 0.72, 0.67],
+                          [0.000, 1.3, -0.01, 0.04, 0.5, 0.0, 0.0, 0.72, 0.67]])
+        f = tm.eval_batch(theta, t)
+        assert f.shape == (3, len(t))
+        for i in range(3):
+            pars = tm.make_params(**dict(zip(tm.param_names, theta[i])))
+            assert np.max(np.abs(f[i] - tm.eval(pars, t=t))) < 1e-10
+
+    def test_fused_kernel(self):
+        from pycheops.funcs import t2z
+        tm = models.TransitModel()
+        t = np.linspace(-2, 2, 20001)
+        k, b, W, h_1, h_2 = 0.1, 0.4, 0.04, 0.72, 0.67
+        r_star = np.pi*W/np.sqrt((1+k)**2 - b**2)
+        sini = np.sqrt(1 - (b*r_star)**2)
+        c, a = 1 - h_1 + h_2, np.log2((1 - h_1 + h_2)/h_2)
+        for f_c, f_s in ((0, 0), (0.3, -0.2)):
+            ecc = f_c**2 + f_s**2
+            om = np.arctan2(f_s, f_c)*180/np.pi
+            z, m = t2z(t, 0.1, 1.3, sini, r_star, ecc, om, returnMask=True)
+            z[m] = 100
+            pars = tm.make_params(T_0=0.1, P=1.3, D=k**2, W=W, b=b, 
+                                  f_c=f_c, f_s=f_s, h_1=h_1, h_2=h_2)
+            f = tm.eval(pars, t=t)
+            assert np.max(np.abs(f - qpower2(z, k, c, a))) < 1e-10
+
+    def test_contact_index(self):
+        tm = models.TransitModel()
+        t = np.linspace(0, 27, 19441)
+        i = np.random.default_rng(1).permutation(len(t))
+        for f_c, f_s in ((0, 0), (0.3, -0.2)):
+            pars = tm.make_params(T_0=0.1, P=3.1, D=0.01, W=0.02, b=0.3,
+                                  f_c=f_c, f_s=f_s, h_1=0.72, h_2=0.67)
+            f = tm.eval(pars, t=t)
+            assert min(f) < 0.99
+            assert np.max(np.abs(f[i] - tm.eval(pars, t=t[i]))) < 1e-12
+        # Array of times shuffled in-place with the same end values
+        cache = models.GEOMETRY_CACHE
+        try:
+            models.GEOMETRY_CACHE = False
+            tt = t.copy()
+            f = tm.eval(pars, t=tt)
+            tt[1:-1] = tt[1:-1][i[i < len(t)-2]]
+            assert np.max(np.abs(tm.eval(pars, t=tt) - 
+                                 tm.eval(pars, t=tt.copy()))) == 0
+        finally:
+            models.GEOMETRY_CACHE = cache
+
+    def test_geometry_cache(self):
+        tm = models.TransitModel()
+        em = models.EclipseModel()
+        t = np.linspace(0, 27, 19441)
+        i = np.random.default_rng(1).permutation(len(t))
+        for f_c, f_s in ((0, 0), (0.3, -0.2)):
+            for b in (0.3, 0.3, 0.5, 0.3):
+                for m, tt in ((tm, t), (tm, t[i]), (em, t)):
+                    v = dict(T_0=0.1, P=3.1, D=0.01, W=0.02, b=b, f_c=f_c,
+                            f_s=f_s, h_1=0.72, h_2=0.67, L=0.001, a_c=0.001)
+                    pars = m.make_params(**{n:v[n] for n in m.param_names
+                                             if n in v})
+                    f_1 = m.eval(pars, t=tt)
+                    cache = models.GEOMETRY_CACHE
+                    try:
+                        models.GEOMETRY_CACHE = False
+                        f_0 = m.eval(pars, t=tt)
+                    finally:
+                        models.GEOMETRY_CACHE = cache
+                    assert np.max(np.abs(f_1 - f_0)) < 1e-12
+        assert any(e is not None for e in models._phase_cache.values())
+        # Times modified in-place after the phase terms have been cached
+        pars = tm.make_params(T_0=0.1, P=3.1, D=0.01, W=0.02, b=0.3,
+                h_1=0.72, h_2=0.67)
+        tt = t.copy()
+        for _ in range(2):
+            tm.eval(pars, t=tt)
+        j = slice(1, len(t)//2)
+        tt[j] = tt[j][::-1]
+        f_1 = tm.eval(pars, t=tt)
+        cache = models.GEOMETRY_CACHE
+        try:
+            models.GEOMETRY_CACHE = False
+            assert np.max(np.abs(f_1 - tm.eval(pars, t=tt))) < 1e-12
+        finally:
+            models.GEOMETRY_CACHE = cache
+
+    def test_array_key(self):
+        t = np.linspace(0, 27, 19441).copy()
+        t.flags.writeable = False
+        key = models._array_key(t)
+        assert key == models._array_key(t)
+        assert key != models._array_key(t.copy())
+        # Arrays that can be modified in-place are identified by their contents
+        tt = t.copy()
+        assert models._array_key(tt) == models._array_key(tt.copy())
+        assert models._array_key(t[1:]) == models._array_key(tt[1:])
+        # Serial numbers are not re-used for new arrays
+        n = len(models._array_refs)
+        for _ in range(3):
+            u = t.copy()
+            u.flags.writeable = False
+            assert models._array_key(u) != key
+            del u
+        assert len(models._array_refs) == n
+        tm = models.TransitModel()
+        pars = tm.make_params(T_0=0.1, P=3.1, D=0.01, W=0.02, b=0.3,
+                h_1=0.72, h_2=0.67)
+        for _ in range(2):
+            f_1 = tm.eval(pars, t=t)
+        cache = models.GEOMETRY_CACHE
+        try:
+            models.GEOMETRY_CACHE = False
+            assert np.max(np.abs(f_1 - tm.eval(pars, t=t))) < 1e-12
+        finally:
+            models.GEOMETRY_CACHE = cache
+
+    def test_ztol(self):
+        t = np.linspace(0, 27, 19441)
+        i = np.random.default_rng(1).permutation(len(t))
+        tm = models.TransitModel()
+        ti = models.TransitModel(ztol=1e-7)
+        pm = models.PlanetModel(ztol=1e-7)
+        for f_c, f_s in ((0, 0), (0.3, -0.2)):
+            pars = tm.make_params(T_0=0.1, P=3.1, D=0.01, W=0.02, b=0.3,
+                                  f_c=f_c, f_s=f_s, h_1=0.72, h_2=0.67)
+            f = tm.eval(pars, t=t)
+            assert np.max(np.abs(ti.eval(pars, t=t) - f)) < 2e-7
+            assert np.max(np.abs(ti.eval(pars, t=t[i]) - f[i])) < 2e-7
+            pars = pm.make_params(T_0=0.1, P=3.1, D=0.01, W=0.02, b=0.3,
+                                  F_min=0, F_max=0, ph_off=0, f_c=f_c,
+                                  f_s=f_s, h_1=0.72, h_2=0.67, a_c=0)
+            assert np.max(np.abs(pm.eval(pars, t=t) - f)) < 2e-7
+        z, f = models._qpower2_grid(0.1, 0.6, 0.7, 1e-6)
+        assert len(z) < 1000
+        zm = 0.5*(z[1:]+z[:-1])
+        fm = models.qpower2(zm, 0.1, 0.6, 0.7)
+        assert np.max(np.abs(fm - 0.5*(f[1:]+f[:-1]))) <= 1e-6
+
+    def test_exptime(self):
+        texp, n = 30/1440, 15
+        t = np.linspace(-0.3, 0.3, 601)
+        dt = ((np.arange(n) + 0.5)/n - 0.5)*texp
+        tm = models.TransitModel()
+        ti = models.TransitModel(exptime=texp, supersample=n)
+        # Short ingress, and long ingress for a large planet
+        for D, W, b in ((0.01, 0.04, 0.3), (0.0225, 0.1, 0)):
+            pars = tm.make_params(T_0=0, P=2.1, D=D, W=W, b=b, 
+                                  f_c=0, f_s=0, h_1=0.72, h_2=0.67)
+            f = tm.eval(pars, t=(t[:,None] + dt).ravel()).reshape(len(t), n)
+            assert np.max(np.abs(ti.eval(pars, t=t) - f.mean(axis=1))) < 1e-6
+
+
+    def test_jacobian(self):
+        t = np.linspace(-0.1, 0.1, 801)
+        fm = models.FactorModel(dx=lambda t: np.interp(t, [-0.1,0.1], 
+                                                        [-0.5, 0.5]))
+        m = models.TransitModel()*fm
+        pars = m.make_params(T_0=0.01, P=2.1, D=0.01, W=0.04, b=0.3, 
+                             f_c=0, f_s=0, h_1=0.72, h_2=0.67, c=1.01,
+                             dfdx=1e-3, dfdt=1e-3)
+        names = ['T_0', 'P', 'D', 'W', 'b', 'h_1', 'h_2', 'c', 'dfdx', 'dfdt']
+        f, jac = models._model_jacobian(m, pars, t, names)
+        assert np.max(np.abs(f - m.eval(pars, t=t))) < 1e-12
+        for n in names:
+            h = 1e-6
+            p_hi, p_lo = pars.copy(), pars.copy()
+            p_hi[n].value += h
+            p_lo[n].value -= h
+            d = (m.eval(p_hi, t=t) - m.eval(p_lo, t=t))/(2*h)
+            assert np.max(np.abs(jac[n] - d)) < 1e-4*np.max(np.abs(d))
+
+class TestFactorModel(TestCase):
+
+    def test_design_matrix(self):
+        t = np.linspace(0, 1, 1001)
+        phi = 2*np.pi*t*15
+        calls = []
+        def sinphi(t):
+            calls.append(len(t))
+            return np.interp(t, t_, np.sin(phi))
+        t_ = t.copy()
+        fm = models.FactorModel(sinphi=sinphi, 
+                cosphi=lambda t: np.interp(t, t_, np.cos(phi)),
+                bg=lambda t: t**2, nphi=5)
+        v = dict(c=1.01, dfdt=1e-3, d2fdt2=-1e-3, dfdbg=2e-4, dfdsinphi=1e-4,
+                 dfdcos2phi=-1e-4, dfdsin3phi=1e-4, dfdcos5phi=3e-4)
+        pars = fm.make_params(**v)
+        assert 'dfdsin5phi' in pars
+        dt = t - np.median(t)
+        f_0 = v['c']*(1 + v['dfdt']*dt + v['d2fdt2']*dt**2 + v['dfdbg']*t**2
+                + v['dfdsinphi']*np.sin(phi) + v['dfdcos2phi']*np.cos(2*phi)
+                + v['dfdsin3phi']*np.sin(3*phi) 
+                + v['dfdcos5phi']*np.cos(5*phi))
+        for _ in range(3):
+            assert np.max(np.abs(fm.eval(pars, t=t) - f_0)) < 1e-12
+        assert len(calls) == 1
+        # Times modified in-place
+        tt = t.copy()
+        fm.eval(pars, t=tt)
+        tt[1:-1] = tt[1:-1][::-1]
+        f_1 = fm.eval(pars, t=tt)
+        assert np.max(np.abs(f_1[1:-1] - f_0[-2:0:-1])) < 1e-12
+        pars['dfdx'].value = 1e-3
+        with self.assertRaises(ValueError):
+            fm.eval(pars, t=t)
+
+class TestEclipseModel(TestCase):
+
+    def test_exptime(self):
+        texp, n = 30/1440, 15
+        t = 1.05 + np.linspace(-0.3, 0.3, 601)
+        dt = ((np.arange(n) + 0.5)/n - 0.5)*texp
+        em = models.EclipseModel()
+        ei = models.EclipseModel(exptime=texp, supersample=n)
+        # Short ingress, and long ingress for a large planet
+        for D, W, b in ((0.01, 0.04, 0.3), (0.0225, 0.1, 0)):
+            pars = em.make_params(T_0=0, P=2.1, D=D, W=W, b=b, L=0.001,
+                                  f_c=0, f_s=0, a_c=0)
+            f = em.eval(pars, t=(t[:,None] + dt).ravel()).reshape(len(t), n)
+            assert np.max(np.abs(ei.eval(pars, t=t) - f.mean(axis=1))) < 1e-9
+
+    def test_ueclipse_out(self):
+        z = np.linspace(-1.3, 1.3, 20001)
+        f_0 = models.ueclipse(z, 0.1)
+        out = np.empty_like(z)
+        parallel = models.PARALLEL
+        size = models.PARALLEL_MIN_SIZE
+        try:
+            models.PARALLEL = True
+            models.PARALLEL_MIN_SIZE = 1
+            f_1 = models.ueclipse(z, 0.1, out=out)
+        finally:
+            models.PARALLEL = parallel
+            models.PARALLEL_MIN_SIZE = size
+        assert f_1 is out
+        assert np.max(np.abs(f_1 - f_0)) < 1e-12
+        # Wrong dtype, and not contiguous
+        for out in (np.empty(len(z), np.float32),
+                    np.empty((len(z), 2))[:,0]):
+            with self.assertRaises(ValueError):
+                models.ueclipse(z, 0.1, out=out)
+
+    def test_compiled_eclipse(self):
+        from pycheops.funcs import t2z
+        em = models.EclipseModel()
+        t = np.linspace(0, 27, 19441)
+        i = np.random.default_rng(1).permutation(len(t))
+        k, b, W, P, T_0, L = 0.1, 0.4, 0.04, 3.1, 0.1, 0.001
+        r_star = np.pi*W/np.sqrt((1+k)**2 - b**2)
+        sini = np.sqrt(1 - (b*r_star)**2)
+        for f_c, f_s in ((0, 0), (0.3, -0.2)):
+            ecc = f_c**2 + f_s**2
+            om = np.arctan2(f_s, f_c)*180/np.pi
+            z, m = t2z(t, T_0, P, sini, r_star, ecc, om, returnMask=True)
+            z[~m] = 100
+            pars = em.make_params(T_0=T_0, P=P, D=k**2, W=W, b=b, L=L,
+                                  f_c=f_c, f_s=f_s, a_c=0)
+            f = em.eval(pars, t=t)
+            assert min(f) < 1 - 0.5*L
+            assert np.max(np.abs(f - 1 - L*(models.ueclipse(z,k)-1))) < 1e-12
+            assert np.max(np.abs(f[i] - em.eval(pars, t=t[i]))) < 1e-12
+
+class TestOrbitGeometry(TestCase):
+
+    def test_reflection(self):
+        from pycheops.funcs import xyz_planet
+        rm = models.ReflectionModel()
+        t = np.linspace(0, 3, 3001)
+        for f_c, f_s in ((0, 0), (0.5, 0.3)):
+            pars = rm.make_params(T_0=0.1, P=1.3, A_g=0.3, r_p=0.01, 
+                                  f_c=f_c, f_s=f_s, sini=0.99)
+            ecc = f_c**2 + f_s**2
+            om = np.arctan2(f_s, f_c)*180/np.pi
+            x, y, z = xyz_planet(t, 0.1, 1.3, 0.99, ecc, om)
+            r = np.sqrt(x**2 + y**2 + z**2)
+            beta = np.arccos(-z/r)
+            f = 0.3*(0.01/r)**2*(np.sin(beta) + (np.pi-beta)*np.cos(beta))/np.pi
+            assert np.max(np.abs(rm.eval(pars, t=t) - f)) < 1e-15
+
+    def test_light_travel_time(self):
+        from pycheops.funcs import OrbitGeometry, t2z
+        t = np.linspace(0, 3, 3001)
+        a_c = 60/86400
+        for ecc, om in ((0, 90), (0.5, 250), (0.9, 100)):
+            g = OrbitGeometry(t, 0.1, 1.3, 0.99, 0.1, ecc, om, a_c=a_c)
+            z, m = t2z(t-a_c, 0.1, 1.3, 0.99, 0.1, ecc, om, returnMask=True)
+            assert np.max(np.abs(g.z_ltt - z)) < 1e-10
+            assert np.all(g.mask_ltt[z < 9] == m[z < 9])
+
+    def test_shared_solve(self):
+        t = np.linspace(0, 3, 3001)
+        i = np.random.default_rng(1).permutation(len(t))
+        for f_c, f_s in ((0, 0), (0.5, 0.3)):
+            m = models.EBLMModel()
+            pars = m.make_params(T_0=0.1, P=1.3, D=0.01, W=0.05, b=0.5,
+                    L=0.2, f_c=f_c, f_s=f_s, a_c=0.001)
+            f = m.eval(pars, t=t)
+            assert np.max(np.abs(m.eval(pars, t=t[i]) - f[i])) < 1e-12
+            m = models.PlanetModel()
+            pars = m.make_params(T_0=0.1, P=1.3, D=0.01, W=0.05, b=0.5,
+                    F_min=1e-4, F_max=2e-4, ph_off=0, f_c=f_c, f_s=f_s,
+                    a_c=0.001)
+            f = m.eval(pars, t=t)
+            assert np.max(np.abs(m.eval(pars, t=t[i]) - f[i])) < 1e-12
+            # PlanetModel does not apply a_c to the eclipse
+            pars['a_c'].set(value=0)
+            assert np.max(np.abs(m.eval(pars, t=t) - f)) < 1e-15
+
+    def test_tzero2tperi(self):
+        from pycheops.funcs import tzero2tperi, t2z
+        sini = np.array([0.987, 0.99, 0.6001377, 0.95, 1.0])
+        ecc = np.array([0.123, 0.5, 0.5961066, 0.9, 0.3])
+        om = np.array([89.01, 250, 269.75133, 100, 10])
+        tperi = tzero2tperi(0.1, 1.3, sini, ecc, om)
+        for i in range(len(sini)):
+            assert abs(tperi[i] - tzero2tperi(0.1, 1.3, sini[i], ecc[i],
+                                              om[i])) < 1e-12
+            t = 0.1 + np.array([-1e-4, 0, 1e-4])
+            z = t2z(t, 0.1, 1.3, sini[i], 0.1, ecc[i], om[i])
+            assert (z[1] < z[0]) and (z[1] < z[2])
+        assert abs(tzero2tperi(54321.6789,1.23456,0.987,0.123,89.01) - 
+                   54321.6762764) < 1e-7
+
+    def test_kepler_solve(self):
+        from pycheops.funcs import kepler_solve, esolve, vrad
+        import pycheops.funcs as funcs
+        rng = np.random.default_rng(1)
+        M = rng.uniform(-2*np.pi, 4*np.pi, 10000)
+        ecc = rng.uniform(0, 0.99, 10000)
+        E_0 = esolve(M, ecc)
+        for solver in ('exact', 'parallel', 'table', 'auto'):
+            E = kepler_solve(M, ecc, solver=solver)
+            assert np.max(np.abs(E - E_0)) < 1e-11
+            E = kepler_solve(M, 0.9, solver=solver)
+            assert np.max(np.abs(E - esolve(M, 0.9))) < 1e-11
+        t = np.linspace(0, 30, 20001)
+        v_0 = vrad(t, 0.1, 1.3, 10, 0.6, 40, 0.9)
+        solver = funcs.KEPLER_SOLVER
+        try:
+            funcs.KEPLER_SOLVER = 'table'
+            v_1 = vrad(t, 0.1, 1.3, 10, 0.6, 40, 0.9)
+        finally:
+            funcs.KEPLER_SOLVER = solver
+        assert np.max(np.abs(v_1 - v_0)) < 1e-9
+
+class TestFloat32(TestCase):
+
+    def test_float32(self):
+        t = np.linspace(-0.5, 27, 100001)
+        for M, kw in ((models.TransitModel, dict(h_1=0.72, h_2=0.67)),
+                      (models.EBLMModel, dict(L=0.01, h_1=0.72, h_2=0.67,
+                                              a_c=0.001))):
+            m_64, m_32 = M(), M(dtype=np.float32)
+            pars = m_64.make_params(T_0=0.1, P=1.3, D=0.01, W=0.04, b=0.3,
+                                    f_c=0.3, f_s=0.1, **kw)
+            f_64 = m_64.eval(pars, t=t)
+            f_32 = m_32.eval(pars, t=t)
+            assert f_32.dtype == np.float32
+            assert np.max(np.abs(f_32 - f_64)) < 2e-7
+            f_32 = m_32.eval(pars, t=t.astype(np.float32))
+            assert np.max(np.abs(f_32 - f_64)) < 5e-6
+        z = np.linspace(0, 1.2, 10001, dtype=np.float32)
+        for f_32, f_64 in ((models.ueclipse(z, 0.1), 
+                            models.ueclipse(z.astype(float), 0.1)),
+                           (qpower2(z, 0.1, 0.6, 0.7),
+                            qpower2(z.astype(float), 0.1, 0.6, 0.7))):
+            assert f_32.dtype == np.float32
+            assert np.max(np.abs(f_32 - f_64)) < 6e-8
+
+class TestPriors(TestCase):
+
+    def test_priors(self):
+        priors = models.Priors()
+        priors.add('D', '-0.5*((D-mu)/sigma)**2', {'mu':0.01, 'sigma':0.001})
+        priors.add('b', 'log(1-b**2)')
+        priors['aR'] = models.Prior(expr='-0.5*((aR*W-w)/sigma)**2', 
+                                    hyper={'w':0.2, 'sigma':0.05})
+        assert priors.names == ['D', 'b', 'aR', 'W']
+        D = np.array([0.01, 0.011, 0.012])
+        b = np.array([0, 0.5, 1.5])
+        aR = np.array([10, 12, 8])
+        W = np.array([0.02, 0.02, 0.025])
+        lp = priors.log_prior({'D':D, 'b':b, 'aR':aR, 'W':W})
+        for i in range(3):
+            v = {'D':D[i], 'b':b[i], 'aR':aR[i], 'W':W[i]}
+            assert priors.log_prior(v) == lp[i]
+        assert lp[2] == -np.inf
+        assert np.isclose(lp[1], -0.5+np.log(0.75)-0.5*(0.04/0.05)**2)
+        r = priors.residual({'D':D[1], 'b':b[1], 'aR':aR[1], 'W':W[1]})
+        assert np.isclose(np.sum(r**2), -2*lp[1])
+        # Residuals are not defined for log-values > 0 or not finite
+        for b_i in (1.5, np.nan):
+            with self.assertRaises(ValueError):
+                priors.residual({'D':D[1], 'b':b_i, 'aR':aR[1], 'W':W[1]})
+        q = models.Priors()
+        q.add('D', '-0.5*((D-mu)/sigma)**2 + 1', {'mu':0.01, 'sigma':0.001})
+        self.assertRaises(ValueError, q.residual, {'D':0.01})
+        p = pickle.loads(pickle.dumps(priors))
+        assert p.log_prior({'D':D, 'b':b, 'aR':aR, 'W':W})[1] == lp[1]
+        self.assertRaises(KeyError, priors.log_prior, {'D':D})
+        self.assertRaises(ValueError, priors.add, 'b', 'log(1-')
+        # Hyper-parameters do not change the built-in symbols
+        priors = models.Priors()
+        priors.add('x', '-(x-pi)**2')
+        priors.add('y', '-(y-pi)**2', {'pi':0})
+        for _ in range(2):
+            lp = priors.log_priors({'x':np.pi, 'y':1})
+            assert lp[0] == 0 and lp[1] == -1
+        # Expressions are compiled, so attribute access, subscripts, etc.
+        # are not allowed
+        for expr in ('x.__class__', 'x[0]', '[x for x in y]', 'lambda: x'):
+            self.assertRaises(ValueError, priors.add, 'x', expr)
+        # No shared state, so priors can be evaluated in parallel threads
+        x = np.linspace(0, 2*np.pi, 64)
+        with ThreadPoolExecutor(4) as pool:
+            lp = list(pool.map(lambda v: priors.log_prior({'x':v, 'y':v}), x))
+        assert np.array_equal(lp, -(x-np.pi)**2 - x**2)
+
+class TestScaledTransitFit(TestCase):
+
+    def test_batch(self):
+        rng = np.random.default_rng(1)
+        t = np.linspace(-0.2, 0.2, 2001)
+        tm = models.TransitModel()
+        theta = [[T_0, 10, 1e-3, 0.01, 0, 0, 0, 0.72, 0.67]
+                for T_0 in np.linspace(-0.15, 0.15, 31)]
+        model = tm.eval_batch(theta, t)
+        model[0] = 1
+        flux = model[15] - 1e-3*(model[15]-1) + rng.normal(0, 2e-4, len(t))
+        for sigma in (1e-4, np.full_like(t, 1e-4)):
+            for parallel in (False, True):
+                cache = models.PARALLEL
+                try:
+                    models.PARALLEL = parallel
+                    r = models.scaled_transit_fit_batch(flux, sigma, model)
+                finally:
+                    models.PARALLEL = cache
+                for i in range(len(theta)):
+                    r_i = models.scaled_transit_fit(flux, sigma, model[i])
+                    assert np.allclose([v[i] for v in r], r_i, equal_nan=True,
+                            rtol=1e-12, atol=0)
+        assert np.all(np.isnan([v[0] for v in r]))
+        assert abs(r[0][15] - 0.999) < 3*r[2][15]
+
+class TestMinerrTransitFit(TestCase):
+
+    def test_minerr(self):
+        rng = np.random.default_rng(2)
+        t = np.linspace(-0.2, 0.2, 2001)
+        tm = models.TransitModel()
+        theta = [[T_0, 10, 1e-3, 0.01, 0, 0, 0, 0.72, 0.67]
+                for T_0 in np.linspace(-0.15, 0.15, 7)]
+        model = tm.eval_batch(theta, t)
+        flux = model[3] - 0.2*(model[3]-1) + rng.normal(0, 2e-4, len(t))
+        sigma = np.full_like(t, 1e-4)
+        s, sigma_s = models.minerr_transit_fit(flux, sigma, model[3])
+        assert abs(s - 0.8) < 3*sigma_s
+        f = models._minerr_negloglike
+        f_0 = f(s, flux, sigma, model[3])
+        assert f(s-1e-4, flux, sigma, model[3]) > f_0
+        assert f(s+1e-4, flux, sigma, model[3]) > f_0
+        assert np.isclose(f(s+sigma_s, flux, sigma, model[3]) - f_0, 0.5)
+        for parallel in (False, True):
+            cache = models.PARALLEL
+            try:
+                models.PARALLEL = parallel
+                r = models.minerr_transit_fit_batch(flux, 1e-4, model)
+            finally:
+                models.PARALLEL = cache
+            for i in range(len(theta)):
+                r_i = models.minerr_transit_fit(flux, 1e-4, model[i])
+                assert np.allclose([v[i] for v in r], r_i, rtol=1e-12)
+        assert models.minerr_transit_fit(flux, sigma, np.ones_like(t)) == (0,0)
+
+class TestModelEvaluator(TestCase):
+
+    def test_evaluator(self):
+        t = np.linspace(-0.2, 0.2, 501)
+        fm = models.FactorModel(dx=lambda t: np.sin(9*t))
+        model = models.TransitModel()*fm
+        params = model.make_params(T_0=0.01, P=3, D=0.01, W=0.04, b=0.3,
+                                   f_c=0, f_s=0, h_1=0.72, h_2=0.67, c=1,
+                                   dfdx=1e-3, dfdt=2e-4)
+        params.add('aR', expr='sqrt((1+k)**2-b**2)/W/pi', min=1)
+        params.add('sini', expr='sqrt(1 - (b/aR)**2)')
+        vn = ['T_0', 'D', 'W', 'b']
+        ev = models._ModelEvaluator(model, params, vn, t, ['dfdx', 'dfdt'])
+        x = [0.02, 0.011, 0.045, 0.2]
+        v = ev.values(x)
+        for n, xi in zip(vn, x):
+            params[n].value = xi
+        for n in params:
+            assert np.isclose(v[ev.index[n]], params[n].value, rtol=1e-12)
+        assert np.allclose(ev.eval(v), model.eval(params, t=t), rtol=1e-14)
+        f, X = ev.linear(v)
+        _, jac = models._model_jacobian(model, params, t, ['dfdx', 'dfdt'])
+        assert np.allclose(f, model.eval(params, t=t), rtol=1e-14)
+        assert np.allclose(X, np.array([jac['dfdx'], jac['dfdt']]).T,
+                           rtol=1e-9, atol=1e-15)
+
+    def test_evaluator_batch(self):
+        t = np.linspace(-0.2, 0.2, 501)
+        fm = models.FactorModel(dx=lambda t: np.sin(9*t))
+        model = models.TransitModel()*fm + models.Model(lambda t, g: g*t)
+        params = model.make_params(T_0=0.01, P=3, D=0.01, W=0.04, b=0.3,
+                                   f_c=0, f_s=0, h_1=0.72, h_2=0.67, c=1,
+                                   dfdx=1e-3, dfdt=2e-4, g=1e-4)
+        params.add('aR', expr='sqrt((1+k)**2-b**2)/W/pi', min=1)
+        vn = ['T_0', 'D', 'W', 'b', 'g']
+        ev = models._ModelEvaluator(model, params, vn, t, ['dfdx', 'dfdt'])
+        X = [[0.02, 0.011, 0.045, 0.2, 1e-4], [0.0, 0.009, 0.04, 0.4, 1e-4],
+             [0.01, 0.01, 0.05, 0.1, 2e-4]]
+        V = ev.values_batch(X)
+        f, J = ev.linear_batch(V)
+        assert np.allclose(ev.eval_batch(V), f, rtol=1e-14)
+        for x, v, f_i, J_i in zip(X, V, f, J):
+            assert np.allclose(v, ev.values(x), rtol=1e-14)
+            f_1, J_1 = ev.linear(v)
+            assert np.allclose(f_i, f_1, rtol=1e-12)
+            assert np.allclose(J_i, J_1, rtol=1e-9, atol=1e-15)
+        fm = models.FactorModel(dy=lambda t: t)
+        theta = np.array([[1, 0, 0, 1e-3] + [0]*(len(fm.param_names)-4)])
+        with self.assertRaises(ValueError):
+            fm.eval_batch(theta, t)
+
+    def test_evaluator_pickle(self):
+        t = np.linspace(-0.2, 0.2, 501)
+        fm = models.FactorModel(dx=np.sin, prefix='x_')
+        model = models.TransitModel()*fm
+        model.set_param_hint('x_dfdx', vary=True)
+        params = model.make_params(T_0=0.01, P=3, D=0.01, W=0.04, b=0.3,
+                                   f_c=0, f_s=0, h_1=0.72, h_2=0.67, x_c=1,
+                                   x_dfdx=1e-3)
+        params.add('aR', expr='sqrt((1+k)**2-b**2)/W/pi', min=1)
+        fm2 = pickle.loads(pickle.dumps(fm))
+        assert fm2.param_hints == fm.param_hints
+        assert fm2.prefix == 'x_'
+        ev = models._ModelEvaluator(model, params, ['D', 'W', 'b'], t,
+                                    ['x_dfdx'])
+        ev2 = pickle.loads(pickle.dumps(ev))
+        v = ev.values([0.011, 0.045, 0.2])
+        assert np.array_equal(v, ev2.values([0.011, 0.045, 0.2]))
+        assert np.array_equal(ev.eval(v), ev2.eval(v))
+        assert np.array_equal(ev.linear(v)[1], ev2.linear(v)[1])
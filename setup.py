@@ -82,7 +82,7 @@ setup(
             'astropy>=3.2.2',
             'emcee>=3.0.0',
             'astroquery',
-            'numba>=0.44.1',
+            'numba>=0.49.0',
             'lmfit>=0.9.14', 
             'corner', 
             'photutils',
@@ -97,6 +97,9 @@ setup(
     #    'dev': ['check-manifest'],
     #    'test': ['coverage'],
     #},
+    extras_require={
+        'nested': ['dynesty>=2.0'],
+    },
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these